@@ -1,10 +1,20 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 import os
 from pathlib import Path
 
-from app.routers import download, process, assets
+from app.routers import download, process, assets, broker
+from app.services.metrics import registry, disk_usage
+from app.services.resources import render_budget
+from app.services.asset_catalog import asset_catalog
+from app.services.upload_sessions import upload_sessions
+from app.services.storage import storage
+from app.services.bg_removal import background_remover
+from app.services.text_layers import text_layers
+from app.services.render_broker import render_broker
+from app.services.uploads import UploadSizeLimit, MB, MAX_OVERLAY_UPLOAD_MB, MAX_AUDIO_UPLOAD_MB, MAX_VIDEO_UPLOAD_MB
 
 app = FastAPI(
     title="DinoSave Marketing Studio API",
@@ -12,6 +22,17 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Limite di dimensione degli upload mentre il body arriva.
+# Aggiunto prima del CORS così anche il 413 ha gli header CORS.
+app.add_middleware(
+    UploadSizeLimit,
+    limits={
+        "/api/assets/overlays/upload": MAX_OVERLAY_UPLOAD_MB * MB,
+        "/api/assets/audio/upload": MAX_AUDIO_UPLOAD_MB * MB,
+        "/api/process/upload-video": MAX_VIDEO_UPLOAD_MB * MB,
+    },
+)
+
 # CORS per il frontend
 app.add_middleware(
     CORSMiddleware,
@@ -44,6 +65,35 @@ app.mount("/assets", StaticFiles(directory="assets"), name="assets")
 app.include_router(download.router, prefix="/api/download", tags=["Download"])
 app.include_router(process.router, prefix="/api/process", tags=["Process"])
 app.include_router(assets.router, prefix="/api/assets", tags=["Assets"])
+app.include_router(broker.router, prefix="/api/broker", tags=["Broker"])
+
+@app.on_event("startup")
+async def start_workers():
+    # Avvia il pool di worker per i render in coda
+    for queue in process.job_queues():
+        await queue.start()
+    # Indice in memoria degli asset + riallineamento periodico con il disco
+    asset_catalog.start()
+    # Pulizia delle sessioni di upload riprendibili abbandonate
+    upload_sessions.start()
+    # Indice dei file in temp/ e output/ + eviction periodica per quota e TTL
+    storage.start()
+    # Font dei testi caricati una volta sola
+    text_layers.load_fonts()
+    # Broker dei render su worker separati: job dei worker morti rimessi in coda
+    if render_broker is not None:
+        render_broker.start()
+
+@app.on_event("shutdown")
+async def stop_workers():
+    for queue in process.job_queues():
+        await queue.stop()
+    await asset_catalog.stop()
+    await upload_sessions.stop()
+    await storage.stop()
+    await background_remover.close()
+    if render_broker is not None:
+        await render_broker.stop()
 
 @app.get("/")
 async def root():
@@ -52,3 +102,25 @@ async def root():
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
+
+# Gauge calcolati a ogni scrape di /metrics
+registry.gauge("render_queue_depth", "Render in attesa nella coda",
+               lambda: sum(queue.queued for queue in process.job_queues()))
+registry.gauge("render_queue_running", "Render in esecuzione",
+               lambda: sum(queue.running for queue in process.job_queues()))
+registry.gauge("renders_inflight", "Chiavi di render in corso (singoli e varianti di batch)",
+               lambda: len(process.active_render_keys()))
+registry.gauge("render_memory_reserved_bytes", "Memoria stimata riservata dai render in corso",
+               lambda: render_budget.reserved_mb * 1024 * 1024)
+registry.gauge("render_memory_budget_bytes", "Budget di memoria per i render",
+               lambda: render_budget.budget_mb * 1024 * 1024)
+registry.gauge("disk_usage_bytes", "Spazio occupato per cartella",
+               lambda: disk_usage({"temp": TEMP_DIR, "output": OUTPUT_DIR, "assets": ASSETS_DIR}), ["dir"])
+registry.gauge("storage_tracked_bytes", "Byte dei file gestiti dal gestore dello spazio", storage.used_bytes, ["dir"])
+registry.gauge("storage_quota_bytes", "Quota per cartella del gestore dello spazio",
+               lambda: {root.name: root.max_bytes for root in (storage.temp, storage.output)}, ["dir"])
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Metriche in formato Prometheus (sync: l'uso disco gira nel threadpool)"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,17 +1,16 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File
-from typing import List
+from fastapi import APIRouter, HTTPException, UploadFile, File, BackgroundTasks, Request, Response
+from typing import List, Optional
 from pathlib import Path
 import shutil
-import os
-from PIL import Image
-from io import BytesIO
 import asyncio
-import httpx
+from pydantic import BaseModel
 
-# Rimozione sfondo: solo remove.bg API (gratuita 50 img/mese)
-# rembg rimosso perché causa OUT OF MEMORY su Render free tier
-REMOVEBG_API_KEY = os.environ.get("REMOVEBG_API_KEY", "")
-REMBG_AVAILABLE = False
+from app.services.overlay_cache import overlay_cache
+from app.services.key_detect import key_detector
+from app.services.asset_catalog import asset_catalog, KIND_OVERLAYS, KIND_AUDIO
+from app.services.media_index import probe_media
+from app.services.bg_removal import background_remover, BackgroundRemovalError, VIDEO_EXTENSIONS
+from app.services.uploads import store_content_addressed, MB, MAX_OVERLAY_UPLOAD_MB, MAX_AUDIO_UPLOAD_MB
 
 router = APIRouter()
 
@@ -26,40 +25,42 @@ class AssetInfo:
         self.size = size
         self.asset_type = asset_type
 
+def list_assets(kind: str, key: str, request: Request, response: Response, offset: int, limit: Optional[int]):
+    """Lista paginata dal catalogo, con ETag (304 se il client ha già questa versione)"""
+    if offset < 0 or (limit is not None and limit < 1):
+        raise HTTPException(status_code=400, detail="offset/limit non validi")
+    entries, etag = asset_catalog.listing(kind)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    page = entries[offset:offset + limit if limit is not None else None]
+    return {key: page, "total": len(entries), "offset": offset, "limit": limit}
+
+def probe_asset(kind: str, path: Path):
+    """Metadati del probe (durata, dimensioni, codec) nel catalogo, in background"""
+    try:
+        info = probe_media(path)
+        info.pop("keyframes", None)
+        asset_catalog.set_probe(kind, path.name, info)
+    except Exception as e:
+        print(f"[Assets] Probe fallito per {path.name}: {e}")
+
 @router.get("/overlays")
-async def list_overlays():
+async def list_overlays(request: Request, response: Response, offset: int = 0, limit: Optional[int] = None):
     """Lista tutti gli overlay disponibili (dino, etc.)"""
-    overlays = []
-    if OVERLAYS_DIR.exists():
-        for file_path in OVERLAYS_DIR.iterdir():
-            if file_path.is_file() and file_path.suffix.lower() in ['.mov', '.mp4', '.webm', '.gif', '.png']:
-                overlays.append({
-                    "id": file_path.stem,
-                    "filename": file_path.name,
-                    "url": f"/assets/overlays/{file_path.name}",
-                    "size": file_path.stat().st_size,
-                    "type": "video" if file_path.suffix.lower() in ['.mov', '.mp4', '.webm', '.gif'] else "image"
-                })
-    return {"overlays": overlays}
+    return list_assets(KIND_OVERLAYS, "overlays", request, response, offset, limit)
 
 @router.get("/audio")
-async def list_audio():
+async def list_audio(request: Request, response: Response, offset: int = 0, limit: Optional[int] = None):
     """Lista tutte le tracce audio disponibili"""
-    audio_files = []
-    if AUDIO_DIR.exists():
-        for file_path in AUDIO_DIR.iterdir():
-            if file_path.is_file() and file_path.suffix.lower() in ['.mp3', '.wav', '.m4a', '.aac']:
-                audio_files.append({
-                    "id": file_path.name,
-                    "filename": file_path.name,
-                    "url": f"/assets/audio/{file_path.name}",
-                    "size": file_path.stat().st_size,
-                })
-    return {"audio": audio_files}
+    return list_assets(KIND_AUDIO, "audio", request, response, offset, limit)
 
 @router.post("/overlays/upload")
-async def upload_overlay(file: UploadFile = File(...)):
-    """Carica un nuovo overlay (es. dino danzante)"""
+async def upload_overlay(background_tasks: BackgroundTasks, file: UploadFile = File(...), warmup: bool = False):
+    """
+    Carica un nuovo overlay (es. dino danzante).
+    warmup=true prepara subito in background gli intermedi keyati per il remix.
+    """
     if not file.filename:
         raise HTTPException(status_code=400, detail="Nome file mancante")
     
@@ -72,24 +73,34 @@ async def upload_overlay(file: UploadFile = File(...)):
             detail=f"Formato non supportato. Usa: {', '.join(allowed_extensions)}"
         )
     
-    file_path = OVERLAYS_DIR / file.filename
-    
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Salvato come <hash><ext>: lo stesso contenuto non viene mai riscritto,
+        # quindi gli intermedi già preparati restano validi
+        file_path, _, created = await store_content_addressed(
+            file, OVERLAYS_DIR, ext, MAX_OVERLAY_UPLOAD_MB * MB)
+        entry = asset_catalog.add(KIND_OVERLAYS, file_path, file.filename)
+        if created and entry["type"] == "video":
+            background_tasks.add_task(probe_asset, KIND_OVERLAYS, file_path)
+            # Colore di key pronto per il primo remix in green screen
+            background_tasks.add_task(key_detector.params, file_path)
+        if warmup:
+            background_tasks.add_task(overlay_cache.warm_up, file_path)
         
         return {
             "success": True,
-            "id": file_path.stem,
-            "filename": file.filename,
-            "url": f"/assets/overlays/{file.filename}",
-            "message": "Overlay caricato con successo!"
+            "id": entry["id"],
+            "filename": entry["filename"],
+            "url": entry["url"],
+            "deduplicated": not created,
+            "message": "Overlay caricato con successo!" if created else "Overlay già presente, riutilizzato"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/audio/upload")
-async def upload_audio(file: UploadFile = File(...)):
+async def upload_audio(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """Carica una nuova traccia audio"""
     if not file.filename:
         raise HTTPException(status_code=400, detail="Nome file mancante")
@@ -103,143 +114,144 @@ async def upload_audio(file: UploadFile = File(...)):
             detail=f"Formato non supportato. Usa: {', '.join(allowed_extensions)}"
         )
     
-    file_path = AUDIO_DIR / file.filename
-    
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        file_path, _, created = await store_content_addressed(
+            file, AUDIO_DIR, ext, MAX_AUDIO_UPLOAD_MB * MB)
+        entry = asset_catalog.add(KIND_AUDIO, file_path, file.filename)
+        if created:
+            background_tasks.add_task(probe_asset, KIND_AUDIO, file_path)
         
         return {
             "success": True,
-            "id": file.filename,
-            "filename": file.filename,
-            "url": f"/assets/audio/{file.filename}",
-            "message": "Audio caricato con successo!"
+            "id": entry["id"],
+            "filename": entry["filename"],
+            "url": entry["url"],
+            "deduplicated": not created,
+            "message": "Audio caricato con successo!" if created else "Audio già presente, riutilizzato"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/overlays/{overlay_id}")
 async def delete_overlay(overlay_id: str):
     """Elimina un overlay"""
-    for ext in ['.mov', '.mp4', '.webm', '.gif', '.png', '']:
-        file_path = OVERLAYS_DIR / f"{overlay_id}{ext}"
-        if file_path.exists():
-            file_path.unlink()
-            return {"success": True, "message": "Overlay eliminato"}
+    file_path = asset_catalog.resolve(KIND_OVERLAYS, overlay_id)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Overlay non trovato")
     
-    raise HTTPException(status_code=404, detail="Overlay non trovato")
+    file_path.unlink(missing_ok=True)
+    asset_catalog.remove(KIND_OVERLAYS, file_path)
+    overlay_cache.invalidate(file_path)
+    return {"success": True, "message": "Overlay eliminato"}
 
 @router.delete("/audio/{audio_id}")
 async def delete_audio(audio_id: str):
     """Elimina una traccia audio"""
-    file_path = AUDIO_DIR / audio_id
-    if file_path.exists():
-        file_path.unlink()
-        return {"success": True, "message": "Audio eliminato"}
+    file_path = asset_catalog.resolve(KIND_AUDIO, audio_id)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Audio non trovato")
     
-    raise HTTPException(status_code=404, detail="Audio non trovato")
+    file_path.unlink(missing_ok=True)
+    asset_catalog.remove(KIND_AUDIO, file_path)
+    return {"success": True, "message": "Audio eliminato"}
 
 
-@router.post("/overlays/{overlay_id:path}/remove-background")
-async def remove_overlay_background(overlay_id: str):
-    """Rimuove lo sfondo da un overlay usando remove.bg API o rembg locale."""
+@router.get("/overlays/{overlay_id:path}/key")
+async def get_overlay_key(overlay_id: str):
+    """
+    Colore di key, similarity e blend rilevati sull'overlay (usati dal remix
+    con remove_green_screen e auto_key). reliable=false: si usa il key fisso 0x00FF00.
+    """
+    overlay_path = asset_catalog.resolve(KIND_OVERLAYS, overlay_id)
+    if overlay_path is None:
+        raise HTTPException(status_code=404, detail=f"Overlay '{overlay_id}' non trovato")
+    try:
+        return await key_detector.get(overlay_path)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analisi fallita: {str(e)}")
+
+class RemoveBackgroundBatch(BaseModel):
+    ids: List[str]
+
+def find_overlay_for_removal(overlay_id: str) -> dict:
+    """Entry dell'overlay (immagini prima dei video, nome anche senza maiuscole)"""
+    entry = asset_catalog.lookup(
+        KIND_OVERLAYS, overlay_id,
+        order=['.png', '.jpg', '.jpeg', '.webp', '.gif', '.mp4', '.mov', '.webm'],
+        case_insensitive=True
+    )
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Overlay '{overlay_id}' non trovato")
+    return entry
+
+async def remove_background(entry: dict) -> dict:
+    """Rimuove lo sfondo (o lo prende dalla cache) e pubblica il PNG come nuovo overlay"""
+    overlay_path = asset_catalog.path(entry)
+    is_video = overlay_path.suffix.lower() in VIDEO_EXTENSIONS
+    try:
+        result_path, cached = await background_remover.remove(overlay_path)
+    except BackgroundRemovalError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+    
+    # Salva PNG
+    output_filename = f"{overlay_path.stem}_nobg.png"
+    output_path = OVERLAYS_DIR / output_filename
+    shutil.copyfile(result_path, output_path)
+    overlay_cache.invalidate(output_path)
+    output_entry = asset_catalog.add(
+        KIND_OVERLAYS, output_path, f"{Path(entry['filename']).stem}_nobg.png")
     
-    # Verifica disponibilità metodi
-    if not REMOVEBG_API_KEY and not REMBG_AVAILABLE:
+    method = "dalla cache" if cached else f"con {background_remover.provider.name}"
+    return {
+        "success": True,
+        "id": output_entry["id"],
+        "filename": output_entry["filename"],
+        "url": output_entry["url"],
+        "cached": cached,
+        "message": f"Sfondo rimosso {method}!" + (" (da video)" if is_video else "")
+    }
+
+def require_background_remover():
+    if not background_remover.available():
         raise HTTPException(
             status_code=503, 
-            detail="Configura REMOVEBG_API_KEY su Render (gratuita: https://www.remove.bg/api)"
+            detail="Configura REMOVEBG_API_KEY su Render (gratuita: https://www.remove.bg/api) "
+                   "oppure BG_REMOVAL_PROVIDER=local"
         )
+
+@router.post("/overlays/remove-background")
+async def remove_overlays_background(batch: RemoveBackgroundBatch):
+    """
+    Rimuove lo sfondo da più overlay: al massimo BG_REMOVAL_CONCURRENCY chiamate
+    al provider alla volta, contenuti già elaborati serviti dalla cache.
+    """
+    require_background_remover()
+    if not batch.ids:
+        raise HTTPException(status_code=400, detail="Nessun overlay indicato")
     
-    # Decodifica l'ID
-    from urllib.parse import unquote
-    overlay_id = unquote(overlay_id)
-    
-    # Trova l'overlay
-    overlay_path = None
-    is_video = False
-    
-    for ext in ['.png', '.jpg', '.jpeg', '.webp', '.gif']:
-        test_path = OVERLAYS_DIR / f"{overlay_id}{ext}"
-        if test_path.exists():
-            overlay_path = test_path
-            break
-    
-    if not overlay_path:
-        for ext in ['.mp4', '.mov', '.webm']:
-            test_path = OVERLAYS_DIR / f"{overlay_id}{ext}"
-            if test_path.exists():
-                overlay_path = test_path
-                is_video = True
-                break
-    
-    if not overlay_path:
-        for file in OVERLAYS_DIR.iterdir():
-            if file.stem.lower() == overlay_id.lower() or file.stem == overlay_id:
-                overlay_path = file
-                is_video = file.suffix.lower() in ['.mp4', '.mov', '.webm']
-                break
+    async def _one(overlay_id: str) -> dict:
+        try:
+            return {"source_id": overlay_id, **await remove_background(find_overlay_for_removal(overlay_id))}
+        except HTTPException as e:
+            return {"source_id": overlay_id, "success": False, "status": e.status_code, "error": e.detail}
     
-    if not overlay_path:
-        raise HTTPException(status_code=404, detail=f"Overlay '{overlay_id}' non trovato")
+    results = await asyncio.gather(*[_one(overlay_id) for overlay_id in batch.ids])
+    done = sum(1 for r in results if r["success"])
+    return {
+        "success": done == len(results),
+        "results": results,
+        "message": f"Sfondo rimosso da {done}/{len(results)} overlay"
+    }
+
+@router.post("/overlays/{overlay_id:path}/remove-background")
+async def remove_overlay_background(overlay_id: str):
+    """Rimuove lo sfondo da un overlay con il provider configurato (remove.bg o locale)."""
+    require_background_remover()
     
-    try:
-        # Se video, estrai primo frame
-        if is_video:
-            from moviepy.editor import VideoFileClip
-            clip = VideoFileClip(str(overlay_path))
-            frame = clip.get_frame(0)
-            clip.close()
-            img = Image.fromarray(frame)
-            buffer = BytesIO()
-            img.save(buffer, format='PNG')
-            input_data = buffer.getvalue()
-        else:
-            with open(overlay_path, "rb") as f:
-                input_data = f.read()
-        
-        output_data = None
-        method_used = ""
-        
-        # Metodo 1: remove.bg API (leggera, gratuita 50 img/mese)
-        if REMOVEBG_API_KEY:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.remove.bg/v1.0/removebg",
-                    headers={"X-Api-Key": REMOVEBG_API_KEY},
-                    files={"image_file": ("image.png", input_data, "image/png")},
-                    data={"size": "auto"},
-                    timeout=60.0
-                )
-                if response.status_code == 200:
-                    output_data = response.content
-                    method_used = "remove.bg"
-                else:
-                    error = response.json().get("errors", [{}])[0].get("title", "Errore")
-                    raise HTTPException(status_code=500, detail=f"remove.bg: {error}")
-        
-        # Metodo 2: rembg locale (fallback)
-        elif REMBG_AVAILABLE:
-            loop = asyncio.get_event_loop()
-            output_data = await loop.run_in_executor(None, remove, input_data)
-            method_used = "rembg"
-        
-        # Salva PNG
-        output_filename = f"{overlay_id}_nobg.png"
-        output_path = OVERLAYS_DIR / output_filename
-        
-        with open(output_path, "wb") as f:
-            f.write(output_data)
-        
-        return {
-            "success": True,
-            "id": f"{overlay_id}_nobg",
-            "filename": output_filename,
-            "url": f"/assets/overlays/{output_filename}",
-            "message": f"Sfondo rimosso con {method_used}!" + (" (da video)" if is_video else "")
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+    # Decodifica l'ID
+    from urllib.parse import unquote
+    return await remove_background(find_overlay_for_removal(unquote(overlay_id)))
@@ -0,0 +1,132 @@
+"""
+Broker dei render per i worker remoti (RENDER_BROKER=sqlite sull'API).
+
+I worker con RENDER_BROKER=http prendono i job, inviano heartbeat e chiudono
+i job da qui; scaricano sorgenti e asset e caricano l'output nella cache dei
+render dell'API (storage condiviso via HTTP). Tutte le chiamate richiedono
+l'header X-Broker-Token uguale a RENDER_BROKER_TOKEN.
+"""
+import secrets
+from pathlib import Path
+from typing import Any, Optional
+
+import aiofiles
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+
+from app.services.asset_catalog import asset_catalog, KIND_OVERLAYS, KIND_AUDIO
+from app.services.jobs import JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+from app.services.render_broker import render_broker, SqliteQueue, RENDER_BROKER_TOKEN
+from app.services.render_cache import render_cache
+from app.services.storage import storage
+
+router = APIRouter()
+
+FILE_KINDS = {"overlays": KIND_OVERLAYS, "audio": KIND_AUDIO}
+
+
+class ClaimRequest(BaseModel):
+    worker: str
+    info: Optional[dict] = None
+
+
+class HeartbeatRequest(BaseModel):
+    worker: str
+    job_id: Optional[str] = None
+    progress: Optional[dict] = None
+    info: Optional[dict] = None
+
+
+class FinishRequest(BaseModel):
+    worker: str
+    status: str
+    result: Optional[Any] = None
+    error: Optional[str] = None
+
+
+def require_broker(x_broker_token: str = Header("")) -> SqliteQueue:
+    """Il broker va ospitato dall'API (sqlite) e serve il token condiviso"""
+    if not isinstance(render_broker, SqliteQueue) or not RENDER_BROKER_TOKEN:
+        raise HTTPException(status_code=503, detail="Broker dei render non configurato (RENDER_BROKER=sqlite e RENDER_BROKER_TOKEN)")
+    if not secrets.compare_digest(x_broker_token, RENDER_BROKER_TOKEN):
+        raise HTTPException(status_code=403, detail="Token del broker non valido")
+    return render_broker
+
+
+async def get_owned_job(broker: SqliteQueue, job_id: str, worker: str) -> dict:
+    """Job in esecuzione assegnato a worker (409 se è stato riassegnato o chiuso)"""
+    job = await broker.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    if job["worker"] != worker or job["status"] != JOB_RUNNING:
+        raise HTTPException(status_code=409, detail="Job non più assegnato a questo worker")
+    return job
+
+
+@router.post("/claim")
+async def claim_job(body: ClaimRequest, broker: SqliteQueue = Depends(require_broker)):
+    """Prossimo job per il worker (null se la coda è vuota)"""
+    return await broker.claim(body.worker, body.info)
+
+
+@router.post("/heartbeat")
+async def worker_heartbeat(body: HeartbeatRequest, broker: SqliteQueue = Depends(require_broker)):
+    return await broker.heartbeat(body.worker, body.job_id, body.progress, body.info)
+
+
+@router.post("/jobs/{job_id}/finish")
+async def finish_job(job_id: str, body: FinishRequest, broker: SqliteQueue = Depends(require_broker)):
+    if body.status not in (JOB_DONE, JOB_FAILED, JOB_CANCELLED):
+        raise HTTPException(status_code=400, detail=f"Stato finale non valido: {body.status}")
+    accepted = await broker.finish(job_id, body.worker, body.status, body.result, body.error)
+    return {"accepted": accepted}
+
+
+@router.put("/jobs/{job_id}/output")
+async def upload_output(job_id: str, request: Request, x_worker_id: str = Header(...),
+                        broker: SqliteQueue = Depends(require_broker)):
+    """Output del render caricato dal worker: scritto a chunk e promosso nella cache dei render"""
+    job = await get_owned_job(broker, job_id, x_worker_id)
+    cache_key = job["payload"]["cache_key"]
+    part_path = render_cache.temp_path(cache_key)
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+    size = 0
+    try:
+        async with aiofiles.open(part_path, "wb") as out:
+            async for chunk in request.stream():
+                size += len(chunk)
+                await out.write(chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Output vuoto")
+        output_path = render_cache.commit(cache_key, job["payload"]["request"]["video_id"])
+    finally:
+        render_cache.discard(cache_key)
+    print(f"[Broker] Output del job {job_id} ricevuto da {x_worker_id} ({size} byte)")
+    return {"output_filename": output_path.name, "size": size}
+
+
+@router.get("/files/source/{name}")
+async def get_source_file(name: str, broker: SqliteQueue = Depends(require_broker)):
+    """Video sorgente (temp/<video_id>.<ext>) per i worker"""
+    path = storage.source(Path(name).stem)
+    if path is None or path.name != name:
+        raise HTTPException(status_code=404, detail="Video sorgente non trovato")
+    return FileResponse(path)
+
+
+@router.get("/files/{kind}/{name}")
+async def get_asset_file(kind: str, name: str, broker: SqliteQueue = Depends(require_broker)):
+    """Overlay o traccia audio per i worker (solo file presenti nel catalogo)"""
+    if kind not in FILE_KINDS:
+        raise HTTPException(status_code=404, detail="Tipo di file sconosciuto")
+    path = asset_catalog.resolve(FILE_KINDS[kind], name)
+    if path is None or path.name != name:
+        raise HTTPException(status_code=404, detail="File non trovato")
+    return FileResponse(path)
+
+
+@router.get("/stats")
+async def broker_stats(broker: SqliteQueue = Depends(require_broker)):
+    """Job per stato e worker visti di recente (vivo, occupato, ultimo heartbeat)"""
+    return await broker.stats()
@@ -1,21 +1,45 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import yt_dlp
 import os
 import uuid
 from pathlib import Path
 import asyncio
-from typing import Optional
+import json
+from typing import List, Optional, Tuple
+
+from app.services.ingest import on_video_ingested
+from app.services.proxies import proxy_manager
+from app.services.media_index import media_index
+from app.services.filmstrip import filmstrip_cache, MAX_FRAMES, MAX_TILE_HEIGHT
+from app.services.download_cache import download_cache, canonicalize_url, static_video_key, info_video_key
+from app.services.rate_limit import HostRateLimiter, host_key, backoff_delay
+from app.services.metrics import Trace, requests_total
+from app.services.storage import storage
 
 router = APIRouter()
 
 TEMP_DIR = Path("temp")
 TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
+# Download massivo: limiti globali, per piattaforma e retry sui rate limit
+BULK_DOWNLOAD_CONCURRENCY = int(os.environ.get("BULK_DOWNLOAD_CONCURRENCY", "4"))
+BULK_DOWNLOAD_PER_HOST = int(os.environ.get("BULK_DOWNLOAD_PER_HOST", "2"))
+BULK_DOWNLOAD_HOST_INTERVAL = float(os.environ.get("BULK_DOWNLOAD_HOST_INTERVAL", "1.0"))
+BULK_DOWNLOAD_RETRIES = int(os.environ.get("BULK_DOWNLOAD_RETRIES", "2"))
+BULK_DOWNLOAD_MAX_URLS = int(os.environ.get("BULK_DOWNLOAD_MAX_URLS", "50"))
+
+bulk_limiter = HostRateLimiter(BULK_DOWNLOAD_CONCURRENCY, BULK_DOWNLOAD_PER_HOST, BULK_DOWNLOAD_HOST_INTERVAL)
+
 class DownloadRequest(BaseModel):
     url: str
     remove_watermark: bool = True
 
+class BulkDownloadRequest(BaseModel):
+    urls: List[str]
+    remove_watermark: bool = True
+
 class DownloadResponse(BaseModel):
     success: bool
     video_id: str
@@ -23,6 +47,7 @@ class DownloadResponse(BaseModel):
     duration: Optional[float] = None
     thumbnail: Optional[str] = None
     title: Optional[str] = None
+    cached: bool = False
     message: str
 
 def get_yt_dlp_options(video_id: str):
@@ -56,72 +81,253 @@ def get_yt_dlp_options(video_id: str):
         'socket_timeout': 30,
     }
 
-async def download_video_async(url: str, video_id: str) -> dict:
-    """Scarica video in modo asincrono usando yt-dlp"""
+async def resolve_and_download(url: str, url_key: str) -> dict:
+    """
+    Risolve l'URL all'id del video sulla piattaforma (senza scaricare) e
+    scarica solo se quel video non è già in cache. Ritorna l'entry di cache.
+    """
+    video_id = str(uuid.uuid4())[:8]
     options = get_yt_dlp_options(video_id)
     
-    def _download():
+    def _extract():
         with yt_dlp.YoutubeDL(options) as ydl:
-            info = ydl.extract_info(url, download=True)
-            return info
+            return ydl.extract_info(url, download=False)
+    
+    def _download(info: dict):
+        # Riusa l'estrazione già fatta: niente seconda richiesta alla piattaforma
+        with yt_dlp.YoutubeDL(options) as ydl:
+            return ydl.process_ie_result(info, download=True)
     
     loop = asyncio.get_event_loop()
-    info = await loop.run_in_executor(None, _download)
-    return info
+    trace = Trace("download", video_id)
+    result = "error"
+    try:
+        with trace.stage("extract_info"):
+            info = await loop.run_in_executor(None, _extract)
+        id_key = info_video_key(info)
+        cached = download_cache.lookup(id_key) if id_key else None
+        if cached:
+            # Link diverso (short link, altro formato) per un video già scaricato
+            download_cache.store(cached, url_key)
+            result = "cached"
+            return cached
+        
+        with trace.stage("download"):
+            info = await loop.run_in_executor(None, _download, info)
+        
+        # Trova il file scaricato
+        downloaded_files = list(TEMP_DIR.glob(f"{video_id}.*"))
+        if not downloaded_files:
+            raise HTTPException(status_code=500, detail="Download fallito: file non trovato")
+        trace.record_output(downloaded_files[0])
+        result = "ok"
+    finally:
+        trace.finish(result)
+    
+    # Probe e proxy di anteprima in background
+    on_video_ingested(video_id, downloaded_files[0])
+    
+    entry = {
+        "video_id": video_id,
+        "filename": downloaded_files[0].name,
+        "duration": info.get('duration'),
+        "thumbnail": info.get('thumbnail'),
+        "title": info.get('title', 'Video'),
+    }
+    download_cache.store(entry, url_key, id_key)
+    return entry
+
+async def fetch_video(url: str) -> Tuple[dict, bool]:
+    """Scarica (o recupera dalla cache) il video di un URL. Ritorna (entry, cached)."""
+    canonical_url = canonicalize_url(url)
+    url_key = static_video_key(canonical_url) or f"url:{canonical_url}"
+    
+    entry = download_cache.lookup(url_key)
+    if entry is not None:
+        requests_total.inc(pipeline="download", result="cached")
+        return entry, True
+    return await download_cache.run_once(
+        url_key, lambda: resolve_and_download(canonical_url, url_key)
+    )
+
+def to_http_error(e: Exception) -> HTTPException:
+    """Converte un errore di download nella risposta HTTP da mostrare all'utente"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, yt_dlp.DownloadError):
+        error_msg = str(e)
+        if "Sign in" in error_msg or "login" in error_msg.lower():
+            return HTTPException(status_code=400, detail="Questo video richiede login. Prova con un video pubblico.")
+        return HTTPException(status_code=400, detail=f"Errore download: {error_msg}")
+    return HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+
+def is_retryable(e: Exception) -> bool:
+    """Errori temporanei (rate limit, timeout) per cui ha senso riprovare"""
+    if not isinstance(e, yt_dlp.DownloadError):
+        return False
+    error_msg = str(e).lower()
+    return any(marker in error_msg for marker in ["429", "too many requests", "rate", "timed out", "temporarily"])
+
+def to_download_response(entry: dict, cached: bool) -> DownloadResponse:
+    return DownloadResponse(
+        success=True,
+        video_id=entry["video_id"],
+        filename=entry["filename"],
+        duration=entry.get("duration"),
+        thumbnail=entry.get("thumbnail"),
+        title=entry.get("title", "Video"),
+        cached=cached,
+        message="Video già scaricato!" if cached else "Video scaricato con successo!"
+    )
 
 @router.post("/", response_model=DownloadResponse)
 async def download_video(request: DownloadRequest):
     """
     Scarica un video da TikTok, Instagram, YouTube, etc.
     Usa yt-dlp con configurazione ottimizzata.
+    Lo stesso video (anche da link diversi) viene scaricato una sola volta.
     """
-    video_id = str(uuid.uuid4())[:8]
-    
     try:
-        info = await download_video_async(request.url, video_id)
-        
-        # Trova il file scaricato
-        downloaded_files = list(TEMP_DIR.glob(f"{video_id}.*"))
-        if not downloaded_files:
-            raise HTTPException(status_code=500, detail="Download fallito: file non trovato")
-        
-        filename = downloaded_files[0].name
+        entry, cached = await fetch_video(request.url)
+        return to_download_response(entry, cached)
+    except Exception as e:
+        raise to_http_error(e)
+
+async def bulk_download_item(index: int, url: str) -> dict:
+    """Scarica un URL del bulk rispettando i limiti, con backoff sui rate limit"""
+    host = host_key(canonicalize_url(url))
+    for attempt in range(BULK_DOWNLOAD_RETRIES + 1):
+        try:
+            async with bulk_limiter.slot(url):
+                entry, cached = await fetch_video(url)
+            return {"index": index, "url": url, "status": "done", **to_download_response(entry, cached).dict()}
+        except Exception as e:
+            if attempt < BULK_DOWNLOAD_RETRIES and is_retryable(e):
+                delay = backoff_delay(attempt)
+                print(f"[Bulk] {host} rallenta ({e}), riprovo tra {delay:.1f}s")
+                bulk_limiter.penalize(host, delay)
+                continue
+            error = to_http_error(e)
+            return {"index": index, "url": url, "status": "error", "status_code": error.status_code, "detail": error.detail}
+
+@router.post("/bulk")
+async def bulk_download(request: BulkDownloadRequest):
+    """
+    Scarica una lista di URL in parallelo (con limiti globali e per piattaforma).
+    Risposta in streaming NDJSON: una riga per URL appena termina, poi un riepilogo.
+    """
+    if not request.urls:
+        raise HTTPException(status_code=400, detail="Nessun URL")
+    if len(request.urls) > BULK_DOWNLOAD_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"Massimo {BULK_DOWNLOAD_MAX_URLS} URL per richiesta")
+    
+    async def _stream():
+        results: asyncio.Queue = asyncio.Queue()
         
-        return DownloadResponse(
-            success=True,
-            video_id=video_id,
-            filename=filename,
-            duration=info.get('duration'),
-            thumbnail=info.get('thumbnail'),
-            title=info.get('title', 'Video'),
-            message="Video scaricato con successo!"
-        )
+        async def _run(index: int, url: str):
+            await results.put(await bulk_download_item(index, url))
         
-    except yt_dlp.DownloadError as e:
-        error_msg = str(e)
-        if "Sign in" in error_msg or "login" in error_msg.lower():
-            raise HTTPException(status_code=400, detail="Questo video richiede login. Prova con un video pubblico.")
-        raise HTTPException(status_code=400, detail=f"Errore download: {error_msg}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore: {str(e)}")
+        tasks = [asyncio.create_task(_run(i, url)) for i, url in enumerate(request.urls)]
+        done, failed = 0, 0
+        try:
+            yield json.dumps({"status": "started", "total": len(tasks)}) + "\n"
+            for _ in range(len(tasks)):
+                item = await results.get()
+                if item["status"] == "done":
+                    done += 1
+                else:
+                    failed += 1
+                yield json.dumps(item) + "\n"
+            yield json.dumps({"status": "finished", "total": len(tasks), "done": done, "failed": failed}) + "\n"
+        finally:
+            # Client disconnesso: annulla i download ancora in attesa
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
 
 @router.get("/preview/{video_id}")
-async def get_video_preview(video_id: str):
-    """Serve il file video per l'anteprima"""
+async def get_video_preview(video_id: str, original: bool = False):
+    """
+    Serve il video per l'anteprima: il proxy a bassa risoluzione se pronto,
+    altrimenti l'originale (original=true forza l'originale).
+    """
     from fastapi.responses import FileResponse
     
     # Cerca il file con qualsiasi estensione
-    files = list(TEMP_DIR.glob(f"{video_id}.*"))
-    if not files:
+    file_path = storage.source(video_id)
+    if file_path is None:
         raise HTTPException(status_code=404, detail="Video non trovato")
     
-    file_path = files[0]
+    proxy_path = None if original else proxy_manager.get_proxy(video_id)
+    if proxy_path is None and not original:
+        # Proxy mancante (es. dopo un riavvio o un'eviction): rigeneralo in background
+        proxy_manager.schedule(video_id, file_path)
+    storage.touch(proxy_path or file_path)
+    
     return FileResponse(
-        path=str(file_path),
+        path=str(proxy_path or file_path),
         media_type="video/mp4",
         filename=file_path.name
     )
 
+@router.get("/poster/{video_id}")
+async def get_video_poster(video_id: str):
+    """Poster frame (JPEG) del video, disponibile dopo l'ingest"""
+    from fastapi.responses import FileResponse
+    
+    poster_path = proxy_manager.get_poster(video_id)
+    if poster_path is None:
+        raise HTTPException(status_code=404, detail="Poster non ancora disponibile")
+    storage.touch(poster_path)
+    return FileResponse(path=str(poster_path), media_type="image/jpeg")
+
+@router.get("/filmstrip/{video_id}")
+async def get_video_filmstrip(video_id: str, frames: int = 20, height: int = 160, fast: bool = False):
+    """
+    Indice del filmstrip per la timeline del trim: N frame equidistanti in
+    un unico sprite sheet (tempo e posizione di ogni frame). fast=true usa
+    solo i keyframe (più veloce, tempi approssimati).
+    """
+    if not 1 <= frames <= MAX_FRAMES:
+        raise HTTPException(status_code=400, detail=f"frames deve essere tra 1 e {MAX_FRAMES}")
+    if not 16 <= height <= MAX_TILE_HEIGHT:
+        raise HTTPException(status_code=400, detail=f"height deve essere tra 16 e {MAX_TILE_HEIGHT}")
+
+    file_path = storage.source(video_id)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Video non trovato")
+
+    index = filmstrip_cache.load(video_id, frames, height, fast)
+    if index is None:
+        try:
+            media = await media_index.get(video_id, file_path)
+            # Il proxy (se pronto) ha le stesse proporzioni ed è molto più veloce da decodificare
+            source_path = proxy_manager.get_proxy(video_id) or file_path
+            index = await filmstrip_cache.get(video_id, source_path, media, frames, height, fast)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Errore generazione filmstrip: {str(e)}")
+
+    return {
+        **index,
+        "sprite_url": f"/api/download/filmstrip/{video_id}/sprite?frames={frames}&height={height}&fast={str(fast).lower()}",
+    }
+
+@router.get("/filmstrip/{video_id}/sprite")
+async def get_video_filmstrip_sprite(video_id: str, frames: int = 20, height: int = 160, fast: bool = False):
+    """Sprite sheet (JPEG) già generato dall'endpoint dell'indice"""
+    from fastapi.responses import FileResponse
+    
+    sprite_path = filmstrip_cache.sprite_path(video_id, frames, height, fast)
+    if not sprite_path.exists():
+        raise HTTPException(status_code=404, detail="Filmstrip non ancora generato")
+    storage.touch(sprite_path)
+    return FileResponse(
+        path=str(sprite_path),
+        media_type="image/jpeg",
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
+
 @router.get("/info")
 async def get_video_info(url: str):
     """Ottiene info sul video"""
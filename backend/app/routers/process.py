@@ -1,26 +1,88 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Awaitable, Callable, Optional, List, Dict, Tuple, Union
 import subprocess
+import shutil
 import os
 import uuid
 import json
+import time
 from pathlib import Path
-import shutil
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
-router = APIRouter()
+from app.services.jobs import JobQueue, Job, QueueFullError, JOB_DONE, JOB_FAILED, JOB_CANCELLED, FINAL_STATES
+from app.services.render_cache import render_cache, compute_key
+from app.services.ffmpeg import FFMPEG_PATH, run_with_progress, write_concat_list, build_concat_command
+from app.services.overlay_cache import overlay_cache, key_mode, key_filter, overlay_source_width, KEY_GREEN
+from app.services.key_detect import key_detector, KEY_DETECT_VERSION
+from app.services.text_layers import text_layers, TEXT_LAYER_VERSION
+from app.services.smart_cut import smart_cut, SmartCutUnavailable
+from app.services.media_index import media_index, DEFAULT_WIDTH, DEFAULT_HEIGHT
+from app.services.download_cache import download_cache
+from app.services.ingest import on_video_ingested, on_video_removed
+from app.services.resources import render_budget, select_profile, estimate_render, RENDER_CPUS
+from app.services.segment_render import (
+    plan_segments, overlay_visible, ProcessGroup,
+    PARALLEL_RENDER_ENABLED, PARALLEL_RENDER_SEGMENTS, PARALLEL_RENDER_MIN_SECONDS,
+)
+from app.services.metrics import Trace
+from app.services.storage import storage
+from app.services.render_broker import render_broker
+from app.services.filtergraph import FilterGraph, Filter, Input, Stream
+from app.services.asset_catalog import asset_catalog, KIND_OVERLAYS, KIND_AUDIO
+from app.services.uploads import stream_upload, MB, MAX_VIDEO_UPLOAD_MB
+from app.services.upload_sessions import upload_sessions
 
-# FFmpeg path - su Render/Linux usa "ffmpeg", su Windows usa il path assoluto
-import platform
-if platform.system() == "Windows":
-    FFMPEG_PATH = r"C:\Users\39351\AppData\Local\Microsoft\WinGet\Packages\Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe\ffmpeg-8.0.1-full_build\bin\ffmpeg.exe"
-else:
-    FFMPEG_PATH = "ffmpeg"
+router = APIRouter()
 
 TEMP_DIR = Path("temp")
 OUTPUT_DIR = Path("output")
-ASSETS_DIR = Path("assets")
+
+# Numero di render FFmpeg in parallelo (1 su Render free tier 512MB)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "1"))
+# Massimo numero di render in attesa prima di rispondere 503
+RENDER_QUEUE_MAX = int(os.environ.get("RENDER_QUEUE_MAX", "50"))
+
+# Render eseguiti in questo processo (tutti, o solo i batch se c'è un broker)
+render_queue = JobQueue("render", workers=RENDER_WORKERS, max_queued=RENDER_QUEUE_MAX)
+# Con un broker (RENDER_BROKER) i remix girano sui worker: i job locali
+# aspettano soltanto, quindi hanno una coda a parte e possono essere tutti in
+# esecuzione insieme senza occupare i posti dei render locali
+remix_queue = (JobQueue("remix", workers=RENDER_QUEUE_MAX, max_queued=RENDER_QUEUE_MAX)
+               if render_broker else render_queue)
+# Intervallo (secondi) tra due letture dello stato di un job nel broker
+BROKER_POLL_SECONDS = float(os.environ.get("BROKER_POLL_SECONDS", "1.0"))
+
+# Executor dedicato: al massimo un thread per worker, mai più encode dei worker
+_ffmpeg_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="ffmpeg")
+# Pool dei processi FFmpeg dei render a segmenti (uno per core)
+_segment_executor = ThreadPoolExecutor(max_workers=max(1, RENDER_CPUS), thread_name_prefix="segment")
+
+# Intervallo (secondi) tra due eventi di avanzamento SSE
+JOB_EVENTS_INTERVAL = float(os.environ.get("JOB_EVENTS_INTERVAL", "1.0"))
+
+# Massimo numero di varianti in un singolo batch (un solo processo FFmpeg)
+MAX_BATCH_VARIANTS = int(os.environ.get("MAX_BATCH_VARIANTS", "10"))
+
+# Job di remix in corso per chiave di cache: richieste identiche condividono lo stesso job
+_shared_remix_jobs: Dict[str, Job] = {}
+
+
+class RenderClaim:
+    """Chiave di cache presa da un render; chi la prende dopo attende che finisca"""
+
+    def __init__(self, previous: Optional["RenderClaim"]):
+        self.previous = previous
+        self.done = asyncio.Event()
+
+
+# Render in corso per chiave di cache (remix singoli e varianti di batch):
+# un solo render alla volta scrive remix_<key>.part.mp4
+_inflight_renders: Dict[str, RenderClaim] = {}
 
 class OverlayItem(BaseModel):
     """Singolo overlay da applicare al video"""
@@ -30,6 +92,12 @@ class OverlayItem(BaseModel):
     scale: float = 0.25  # % della larghezza video
     remove_green_screen: bool = True
     remove_black_screen: bool = False
+    auto_key: bool = True  # Green screen con colore/tolleranze rilevati sull'overlay
+    # Finestra in secondi dell'output (dopo trim e velocità), end None = fino alla fine
+    start: float = 0
+    end: Optional[float] = None
+    # hold: a fine clip resta l'ultimo frame, once: sparisce, loop: la clip riparte
+    loop: str = "hold"
 
 class ProcessRequest(BaseModel):
     video_id: str
@@ -50,6 +118,8 @@ class ProcessRequest(BaseModel):
     text_x: Optional[float] = None  # Percentuale 0-100
     text_y: Optional[float] = None  # Percentuale 0-100
     text_font_size: int = 48
+    text_start: float = 0  # Secondi dell'output in cui compare il testo
+    text_end: Optional[float] = None  # None = fino alla fine
     # Video editing
     trim_start: float = 0  # Secondi dall'inizio
     trim_end: Optional[float] = None  # Secondi, None = fine video
@@ -58,11 +128,74 @@ class ProcessRequest(BaseModel):
     saturation: int = 0  # -50 a 50
     playback_speed: float = 1.0  # 0.5 a 2.0
 
+class VariantSpec(BaseModel):
+    """Singola variante di un batch: tutto tranne sorgente, trim e velocità (condivisi)"""
+    name: Optional[str] = None
+    overlays: Optional[List[OverlayItem]] = None
+    audio_id: Optional[str] = None
+    remove_original_audio: bool = False
+    text_overlay: Optional[str] = None
+    text_position: str = "top-center"
+    text_x: Optional[float] = None
+    text_y: Optional[float] = None
+    text_font_size: int = 48
+    text_start: float = 0  # Secondi dell'output in cui compare il testo
+    text_end: Optional[float] = None  # None = fino alla fine
+    brightness: int = 0
+    contrast: int = 0
+    saturation: int = 0
+
+class BatchRemixRequest(BaseModel):
+    video_id: str
+    trim_start: float = 0
+    trim_end: Optional[float] = None
+    playback_speed: float = 1.0
+    variants: List[VariantSpec]
+    
+    def to_requests(self) -> List["ProcessRequest"]:
+        """Una ProcessRequest completa per variante (usata per cache e filtri)"""
+        return [
+            ProcessRequest(
+                video_id=self.video_id,
+                trim_start=self.trim_start,
+                trim_end=self.trim_end,
+                playback_speed=self.playback_speed,
+                **variant.dict(exclude={"name"})
+            )
+            for variant in self.variants
+        ]
+
 class ProcessResponse(BaseModel):
     success: bool
     output_filename: str
     output_url: str
     message: str
+    cached: bool = False
+
+class VariantResult(BaseModel):
+    name: Optional[str] = None
+    output_filename: str
+    output_url: str
+    cached: bool = False
+
+class BatchResponse(BaseModel):
+    success: bool
+    results: List[VariantResult]
+    message: str
+
+class JobSubmitResponse(BaseModel):
+    success: bool
+    job_id: str
+    status: str
+    queue_position: Optional[int] = None
+    message: str
+    # Token del client per DELETE /jobs/{job_id}?token=... (job condivisi da richieste identiche)
+    token: Optional[str] = None
+
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int  # Byte totali del file
+    sha256: Optional[str] = None  # Se presente viene verificato alla chiusura
 
 def get_position_filter(position: str, video_w: str = "main_w", video_h: str = "main_h", overlay_w: str = "overlay_w", overlay_h: str = "overlay_h", margin: int = 20):
     """Calcola la posizione FFmpeg per l'overlay (fallback)"""
@@ -83,118 +216,172 @@ def get_position_from_percent(x_percent: float, y_percent: float):
     return f"{x}:{y}"
 
 def get_text_position_filter(position: str):
-    """Posizione del testo"""
+    """Posizione del layer di testo nel filtro overlay"""
     positions = {
-        "top-left": "x=20:y=40",
-        "top-center": "x=(w-text_w)/2:y=40",
-        "top-right": "x=w-text_w-20:y=40",
-        "center": "x=(w-text_w)/2:y=(h-text_h)/2",
-        "bottom-center": "x=(w-text_w)/2:y=h-text_h-40",
+        "top-left": "20:40",
+        "top-center": "(main_w-overlay_w)/2:40",
+        "top-right": "main_w-overlay_w-20:40",
+        "center": "(main_w-overlay_w)/2:(main_h-overlay_h)/2",
+        "bottom-center": "(main_w-overlay_w)/2:main_h-overlay_h-40",
     }
     return positions.get(position, positions["top-center"])
 
-def get_video_dimensions(video_path: str) -> tuple:
-    """Ottiene le dimensioni del video usando ffprobe"""
-    try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "v:0",
-             "-show_entries", "stream=width,height", "-of", "csv=p=0", video_path],
-            capture_output=True, text=True
-        )
-        if result.returncode == 0 and result.stdout.strip():
-            parts = result.stdout.strip().split(',')
-            return int(parts[0]), int(parts[1])
-    except Exception as e:
-        print(f"[WARN] Could not get video dimensions: {e}")
-    return 1080, 1920  # Default 9:16 portrait
+# Chiave di prepare_overlays per il layer di testo (gli overlay usano il loro indice)
+TEXT_LAYER = -1
 
-async def run_ffmpeg(cmd: List[str]):
-    """Esegue FFmpeg in modo asincrono"""
-    # Log comando per debug
-    print(f"[FFmpeg CMD] {' '.join(cmd)}")
-    
-    def _run():
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True
-        )
-        return result
-    
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(None, _run)
-    
-    if result.returncode != 0:
-        print(f"[FFmpeg ERROR] {result.stderr}")
-        raise Exception(f"FFmpeg error: {result.stderr}")
-    
-    return result
+OVERLAY_LOOP_MODES = ("hold", "once", "loop")
+# Overlay di un solo frame: nessun decode da limitare, conta solo la finestra
+STILL_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp']
 
-@router.post("/remix", response_model=ProcessResponse)
-async def process_video(request: ProcessRequest):
+def window_enable(start: float, end: Optional[float]) -> Optional[str]:
+    """Espressione enable del filtro overlay per la finestra [start, end) (None = sempre attivo)"""
+    if end is not None:
+        return f"between(t,{start:g},{end:g})"
+    if start > 0:
+        return f"gte(t,{start:g})"
+    return None
+
+def overlay_timing(overlay_item: OverlayItem, is_still: bool) -> Tuple[List[str], List[Filter], Dict[str, str]]:
     """
-    Processa il video con overlay, audio e testo.
+    Finestra temporale di un overlay: (opzioni dell'input, filtri di timing
+    per la catena dell'overlay, opzioni del filtro overlay).
+    I video vengono letti e decodificati solo per la durata della finestra e
+    spostati al suo inizio: prima e dopo il filtro overlay passa i frame base.
     """
-    output_id = str(uuid.uuid4())[:8]
-    output_filename = f"remix_{output_id}.mp4"
-    output_path = OUTPUT_DIR / output_filename
+    start, end = overlay_item.start, overlay_item.end
+    enable = window_enable(start, end)
+    if is_still:
+        return [], [], {"eof_action": "repeat", **({"enable": enable} if enable else {})}
     
-    # Trova il video sorgente
-    source_files = list(TEMP_DIR.glob(f"{request.video_id}.*"))
-    if not source_files:
-        raise HTTPException(status_code=404, detail="Video sorgente non trovato")
+    input_args = []
+    if overlay_item.loop == "loop":
+        input_args.extend(["-stream_loop", "-1"])
+    if end is not None:
+        input_args.extend(["-t", f"{end - start:g}"])
+    timing = [Filter("setpts", f"PTS-STARTPTS+{start:g}/TB")] if start > 0 else []
     
-    source_path = source_files[0]
-    
-    # Ottieni dimensioni video per calcolare scala overlay
-    video_width, video_height = get_video_dimensions(str(source_path))
-    print(f"[DEBUG] Video dimensions: {video_width}x{video_height}")
+    if overlay_item.loop == "hold":
+        # L'ultimo frame resta fino a end (o alla fine del video)
+        options = {"eof_action": "repeat", **({"enable": enable} if end is not None else {})}
+    elif overlay_item.loop == "loop" and end is None:
+        # Clip infinita: l'output finisce con il video base
+        options = {"eof_action": "pass", "shortest": 1}
+    else:
+        options = {"eof_action": "pass"}
+    return input_args, timing, options
+
+def validate_windows(request: ProcessRequest):
+    """Verifica finestre temporali e modalità di loop di overlay e testo"""
+    windows = [(f"dell'overlay {i}", item.start, item.end) for i, item in enumerate(get_overlay_list(request))]
+    windows.append(("del testo", request.text_start, request.text_end))
+    for name, start, end in windows:
+        if start < 0:
+            raise HTTPException(status_code=400, detail=f"start {name} non può essere negativo")
+        if end is not None and end <= start:
+            raise HTTPException(status_code=400, detail=f"end {name} deve essere maggiore di start")
+    for item in get_overlay_list(request):
+        if item.loop not in OVERLAY_LOOP_MODES:
+            raise HTTPException(status_code=400, detail=f"loop deve essere uno tra: {', '.join(OVERLAY_LOOP_MODES)}")
+
+async def run_ffmpeg(cmd: List[str], job: Optional[Job] = None, expected_duration: Optional[float] = None,
+                     trace: Optional[Trace] = None, group: Optional[ProcessGroup] = None, segment: int = 0):
+    """
+    Esegue FFmpeg in modo asincrono sull'executor limitato dei render.
+    L'avanzamento (frame, fps, speed, percentuale) viene scritto in job.progress,
+    tempo CPU, RSS di picco e velocità di encode nel trace.
+    group: processi di un render a segmenti (pool dedicato, avanzamento combinato).
+    """
+    # Log comando per debug
+    print(f"[FFmpeg CMD] {' '.join(cmd)}")
     
-    # Costruisci il comando FFmpeg
-    cmd = [FFMPEG_PATH, "-y"]
+    def _on_start(process):
+        if group is not None:
+            group.add(process)
+        elif job is not None:
+            # Permette a cancel_job di terminare l'encode
+            job.process = process
     
-    # Trim: seek to start
-    if request.trim_start > 0:
-        cmd.extend(["-ss", str(request.trim_start)])
+    last_progress = {}
     
-    cmd.extend(["-i", str(source_path)])
+    def _on_progress(progress: dict):
+        # Il blocco finale (progress=end) può non avere speed: tieni gli ultimi valori noti
+        last_progress.update({k: v for k, v in progress.items() if v is not None})
+        if job is not None:
+            job.progress = group.update(segment, progress) if group is not None else progress
     
-    # Calcola durata trim (applicata alla fine)
-    trim_duration = None
-    if request.trim_end and request.trim_end > request.trim_start:
-        trim_duration = request.trim_end - request.trim_start
+    def _on_usage(usage: dict):
+        if trace is not None:
+            trace.record_ffmpeg(usage, last_progress)
     
-    filter_complex = []
-    current_stream = "[0:v]"
+    def _run():
+        if job is not None and job.cancel_requested:
+            return subprocess.CompletedProcess(cmd, -1, "", "cancelled"), False
+        returncode, stderr_tail, stalled = run_with_progress(
+            cmd, _on_progress, _on_start, expected_duration=expected_duration, on_usage=_on_usage
+        )
+        return subprocess.CompletedProcess(cmd, returncode, "", stderr_tail), stalled
     
-    # Video filters (brightness, contrast, saturation, speed)
-    video_filters = []
+    loop = asyncio.get_event_loop()
+    executor = _segment_executor if group is not None else _ffmpeg_executor
+    result, stalled = await loop.run_in_executor(executor, _run)
     
-    # Brightness/Contrast/Saturation usando eq filter
-    if request.brightness != 0 or request.contrast != 0 or request.saturation != 0:
-        # FFmpeg eq: brightness va da -1 a 1, contrast da 0.5 a 1.5, saturation da 0 a 3
-        brightness = request.brightness / 100  # -0.5 a 0.5
-        contrast = 1 + (request.contrast / 100)  # 0.5 a 1.5
-        saturation = 1 + (request.saturation / 50)  # 0 a 2
-        video_filters.append(f"eq=brightness={brightness}:contrast={contrast}:saturation={saturation}")
+    if job is not None and job.cancel_requested:
+        raise Exception("Render annullato")
     
-    # Playback speed
-    if request.playback_speed != 1.0:
-        video_filters.append(f"setpts={1/request.playback_speed}*PTS")
+    if stalled:
+        print(f"[FFmpeg ERROR] Encode bloccato, terminato. {result.stderr}")
+        raise Exception(f"FFmpeg bloccato (nessun avanzamento): {result.stderr}")
     
-    # Applica filtri video base
-    if video_filters:
-        combined = ",".join(video_filters)
-        filter_complex.append(f"[0:v]{combined}[vbase]")
-        current_stream = "[vbase]"
+    if result.returncode != 0:
+        print(f"[FFmpeg ERROR] {result.stderr}")
+        raise Exception(f"FFmpeg error: {result.stderr}")
     
-    # Prepara lista overlay (supporta sia array che singolo per retrocompatibilità)
-    overlay_list = []
+    return result
+
+async def get_video_dimensions(video_id: str, source_path: Path) -> tuple:
+    """Dimensioni di visualizzazione del video dall'indice dei metadati"""
+    try:
+        media = await media_index.get(video_id, source_path)
+        if media.get("width") and media.get("height"):
+            return media["width"], media["height"]
+    except Exception as e:
+        print(f"[WARN] Could not get video dimensions: {e}")
+    return DEFAULT_WIDTH, DEFAULT_HEIGHT  # Default 9:16 portrait
+
+async def expected_output_duration(request: ProcessRequest, source_path: Path) -> Optional[float]:
+    """Durata attesa dell'output (trim e velocità), per la percentuale di avanzamento"""
+    try:
+        media = await media_index.get(request.video_id, source_path)
+    except Exception:
+        return None
+    duration = media.get("duration")
+    if not duration:
+        return None
+    end = request.trim_end if request.trim_end and request.trim_end > request.trim_start else duration
+    return max(0.0, min(end, duration) - request.trim_start) / (request.playback_speed or 1.0)
+
+async def validate_trim(request: ProcessRequest, source_path: Path):
+    """Verifica trim_start/trim_end rispetto alla durata del video"""
+    if request.trim_start < 0:
+        raise HTTPException(status_code=400, detail="trim_start non può essere negativo")
+    if request.trim_end is not None and request.trim_end <= request.trim_start:
+        raise HTTPException(status_code=400, detail="trim_end deve essere maggiore di trim_start")
+    try:
+        media = await media_index.get(request.video_id, source_path)
+    except Exception:
+        # Senza metadati lasciamo decidere a FFmpeg
+        return
+    duration = media.get("duration")
+    if duration and request.trim_start >= duration:
+        raise HTTPException(status_code=400, detail=f"trim_start oltre la durata del video ({duration:.2f}s)")
+
+def get_overlay_list(request: ProcessRequest) -> List[OverlayItem]:
+    """Lista overlay della richiesta (converte il singolo overlay legacy)"""
     if request.overlays:
-        overlay_list = request.overlays
-    elif request.overlay_id:
+        return request.overlays
+    if request.overlay_id:
         # Legacy: converti singolo overlay in lista
-        overlay_list = [OverlayItem(
+        return [OverlayItem(
             id=request.overlay_id,
             x=request.overlay_x if request.overlay_x is not None else 70,
             y=request.overlay_y if request.overlay_y is not None else 70,
@@ -202,181 +389,1078 @@ async def process_video(request: ProcessRequest):
             remove_green_screen=request.remove_green_screen,
             remove_black_screen=request.remove_black_screen
         )]
+    return []
+
+def resolve_overlay_path(overlay_id: str) -> Optional[Path]:
+    """Trova il file di un overlay dall'id (con o senza estensione) nel catalogo"""
+    return asset_catalog.resolve(KIND_OVERLAYS, overlay_id)
+
+def resolve_audio_path(audio_id: str) -> Optional[Path]:
+    """Trova il file di una traccia audio dall'id nel catalogo"""
+    return asset_catalog.resolve(KIND_AUDIO, audio_id)
+
+def uses_auto_key(overlay_item: OverlayItem, mode: str) -> bool:
+    return mode == KEY_GREEN and overlay_item.auto_key
+
+def find_source_video(video_id: str) -> Path:
+    """Trova il video sorgente in temp/ (qualsiasi estensione) dall'indice dei file"""
+    source_path = storage.source(video_id)
+    if source_path is None:
+        raise HTTPException(status_code=404, detail="Video sorgente non trovato")
+    return source_path
+
+# Output settings - ottimizzato per bassa memoria (Render free tier 512MB)
+OUTPUT_ENCODE_ARGS = [
+    "-threads", "1",
+    "-c:v", "libx264",
+    "-pix_fmt", "yuv420p",
+    "-preset", "ultrafast",
+    "-crf", "28",
+    "-maxrate", "2M",
+    "-bufsize", "1M",
+    "-movflags", "+faststart",
+    "-c:a", "aac",
+    "-b:a", "96k",
+]
+
+# Varianti senza filtri video: il video viene copiato, si codifica solo l'audio
+COPY_ENCODE_ARGS = [
+    "-c:v", "copy",
+    "-movflags", "+faststart",
+    "-c:a", "aac",
+    "-b:a", "96k",
+]
+
+def output_encode_args(profile: Optional[dict] = None) -> List[str]:
+    """OUTPUT_ENCODE_ARGS con thread, preset e lookahead del profilo encoder"""
+    if profile is None:
+        return OUTPUT_ENCODE_ARGS
+    args = list(OUTPUT_ENCODE_ARGS)
+    args[args.index("-threads") + 1] = str(profile["threads"])
+    args[args.index("-preset") + 1] = profile["preset"]
+    return args + ["-x264-params", f"rc-lookahead={profile['rc_lookahead']}"]
+
+def build_variant_filters(request: ProcessRequest, graph: FilterGraph, stream: Stream, video_width: int,
+                          prepared_overlays: Optional[Dict[int, Path]] = None) -> Stream:
+    """
+    Filtri di una variante a partire da stream: eq, overlay e testo.
+    Overlay e testo diventano input del grafo (indici assegnati dal compilatore).
+    Ritorna lo stream di uscita.
+    """
+    # Brightness/Contrast/Saturation con eq (neutro = rimosso dal compilatore)
+    # FFmpeg eq: brightness va da -1 a 1, contrast da 0.5 a 1.5, saturation da 0 a 3
+    stream = graph.apply(stream, Filter(
+        "eq",
+        brightness=request.brightness / 100,  # -0.5 a 0.5
+        contrast=1 + (request.contrast / 100),  # 0.5 a 1.5
+        saturation=1 + (request.saturation / 50),  # 0 a 2
+    ), label="eq")
+    
+    # Prepara lista overlay (supporta sia array che singolo per retrocompatibilità)
+    overlay_list = get_overlay_list(request)
     
     # Processa ogni overlay
-    overlay_input_idx = 1  # Indice input FFmpeg (0 è il video principale)
     for idx, overlay_item in enumerate(overlay_list):
         # Trova il file overlay
-        overlay_path = ASSETS_DIR / "overlays" / overlay_item.id
-        if not overlay_path.exists():
-            for ext in ['.mov', '.mp4', '.webm', '.gif', '.png']:
-                test_path = ASSETS_DIR / "overlays" / f"{overlay_item.id}{ext}"
-                if test_path.exists():
-                    overlay_path = test_path
-                    break
-            if not overlay_path.exists():
-                for file in (ASSETS_DIR / "overlays").iterdir():
-                    if file.stem == overlay_item.id:
-                        overlay_path = file
-                        break
+        overlay_path = resolve_overlay_path(overlay_item.id)
+        if not overlay_path:
+            continue
         
-        if overlay_path.exists():
-            cmd.extend(["-i", str(overlay_path)])
-            
-            overlay_ext = overlay_path.suffix.lower()
-            has_native_alpha = overlay_ext in ['.webm', '.mov', '.png', '.gif']
-            
-            print(f"[DEBUG] Overlay {idx}: {overlay_path.name}, pos: ({overlay_item.x}, {overlay_item.y}), scale: {overlay_item.scale}")
-            
-            overlay_target_width = int(video_width * overlay_item.scale)
-            input_ref = f"[{overlay_input_idx}:v]"
-            scaled_name = f"overlay_scaled_{idx}"
-            
-            # Scala overlay con gestione trasparenza
-            if overlay_item.remove_green_screen:
-                chroma_name = f"chroma_{idx}"
-                filter_complex.append(f"{input_ref}chromakey=0x00FF00:0.3:0.1,format=rgba[{chroma_name}]")
-                filter_complex.append(f"[{chroma_name}]scale={overlay_target_width}:-1:flags=lanczos[{scaled_name}]")
-            elif overlay_item.remove_black_screen:
-                colorkey_name = f"colorkey_{idx}"
-                filter_complex.append(f"{input_ref}colorkey=0x000000:0.3:0.2,format=rgba[{colorkey_name}]")
-                filter_complex.append(f"[{colorkey_name}]scale={overlay_target_width}:-1:flags=lanczos[{scaled_name}]")
-            elif has_native_alpha:
-                filter_complex.append(f"{input_ref}format=rgba,scale={overlay_target_width}:-1:flags=lanczos[{scaled_name}]")
-            else:
-                filter_complex.append(f"{input_ref}scale={overlay_target_width}:-1:flags=lanczos[{scaled_name}]")
-            
-            # Posizione overlay
-            pos = get_position_from_percent(overlay_item.x, overlay_item.y)
-            output_name = f"overlaid_{idx}"
-            overlay_filter = f"{current_stream}[{scaled_name}]overlay={pos}:eof_action=repeat:format=auto[{output_name}]"
-            filter_complex.append(overlay_filter)
-            current_stream = f"[{output_name}]"
-            overlay_input_idx += 1
-    
-    # Testo overlay
+        prepared_path = (prepared_overlays or {}).get(idx)
+        print(f"[DEBUG] Overlay {idx}: {overlay_path.name}, pos: ({overlay_item.x}, {overlay_item.y}), scale: {overlay_item.scale}")
+        
+        # Finestra temporale: decode, key e scala solo mentre l'overlay è a schermo
+        timing_args, timing, overlay_options = overlay_timing(
+            overlay_item, overlay_path.suffix.lower() in STILL_EXTENSIONS)
+        
+        if prepared_path:
+            # Intermedio già keyato e scalato: basta l'overlay
+            overlay_input = graph.input(prepared_path, timing_args)
+            chain = timing
+        else:
+            overlay_input = graph.input(overlay_path, timing_args, overlay_source_width(overlay_path))
+            mode = key_mode(overlay_path, overlay_item.remove_green_screen, overlay_item.remove_black_screen)
+            # Parametri rilevati già in memoria (calcolati da prepare_overlays)
+            key = key_detector.lookup(overlay_path) if uses_auto_key(overlay_item, mode) else None
+            # Il compilatore porta la scala prima del key quando riduce l'overlay
+            chain = timing + Filter.parse_chain(key_filter(mode, key)) + [
+                Filter("scale", int(video_width * overlay_item.scale), -1, flags="lanczos")]
+        overlay_stream = graph.apply(overlay_input.stream("v"), *chain, label=f"overlay_scaled_{idx}")
+        
+        # Posizione overlay
+        x, y = get_position_from_percent(overlay_item.x, overlay_item.y).split(":")
+        stream = graph.node([stream, overlay_stream], [
+            Filter("overlay", x, y, **overlay_options, format="auto")
+        ], label=f"overlaid_{idx}").output
+    
+    # Testo: PNG pre-renderizzato (una volta sola) composto come un overlay
     if request.text_overlay:
         # Usa coordinate custom se fornite, altrimenti usa preset
         if request.text_x is not None and request.text_y is not None:
-            text_pos = f"x=(w*{request.text_x/100}-text_w/2):y=(h*{request.text_y/100}-text_h/2)"
+            text_pos = f"(main_w*{request.text_x/100}-overlay_w/2):(main_h*{request.text_y/100}-overlay_h/2)"
         else:
             text_pos = get_text_position_filter(request.text_position)
         
-        # Escape caratteri speciali per FFmpeg
-        escaped_text = request.text_overlay.replace("'", "'\\''").replace(":", "\\:")
-        text_filter = (
-            f"{current_stream}drawtext="
-            f"text='{escaped_text}':"
-            f"fontsize={request.text_font_size}:"
-            f"fontcolor=white:"
-            f"borderw=3:"
-            f"bordercolor=black:"
-            f"{text_pos}"
-            f"[texted]"
-        )
-        filter_complex.append(text_filter)
-        current_stream = "[texted]"
-    
-    # Applica filtri
-    if filter_complex:
-        # Rinomina l'ultimo stream in output
-        last_filter = filter_complex[-1]
-        # Rimuovi il nome dello stream di output dall'ultimo filtro
-        last_output_name = last_filter.split("[")[-1].rstrip("]")
-        cmd.extend(["-filter_complex", ";".join(filter_complex)])
-        cmd.extend(["-map", f"[{last_output_name}]"])
-    else:
-        cmd.extend(["-c:v", "copy"])
+        text_path = (prepared_overlays or {}).get(TEXT_LAYER) or text_layers.render(
+            request.text_overlay, request.text_font_size, video_width)
+        text_input = graph.input(text_path)
+        enable = window_enable(request.text_start, request.text_end)
+        x, y = text_pos.split(":")
+        stream = graph.node([stream, text_input.stream("v")], [
+            Filter("overlay", x, y, eof_action="repeat", **({"enable": enable} if enable else {}), format="auto")
+        ], label="texted").output
     
-    # Gestione audio
-    audio_filter = None
+    return stream
+
+def build_audio_args(request: ProcessRequest, graph: FilterGraph, source: Input) -> List[Union[str, Stream]]:
+    """Opzioni audio di un output (mappa l'audio originale o aggiunge l'audio custom al grafo)"""
+    audio_path = resolve_audio_path(request.audio_id) if request.audio_id else None
+    if audio_path:
+        # Usa l'audio custom invece dell'originale
+        return ["-map", graph.input(audio_path).stream("a"), "-shortest"]
+    if request.remove_original_audio:
+        return ["-an"]
+    args = ["-map", source.stream("a?")]
     if request.playback_speed != 1.0:
         # Modifica velocità audio per matchare il video
-        audio_filter = f"atempo={request.playback_speed}"
-    
-    if request.audio_id:
-        audio_path = ASSETS_DIR / "audio" / request.audio_id
-        if audio_path.exists():
-            cmd.extend(["-i", str(audio_path)])
-            # Usa l'audio custom invece dell'originale
-            audio_input_index = 2 if request.overlay_id else 1
-            cmd.extend(["-map", f"{audio_input_index}:a"])
-            cmd.extend(["-shortest"])
-        elif not request.remove_original_audio:
-            cmd.extend(["-map", "0:a?"])
-            if audio_filter:
-                cmd.extend(["-af", audio_filter])
-    elif request.remove_original_audio:
-        cmd.extend(["-an"])
+        args.extend(["-af", f"atempo={request.playback_speed}"])
+    return args
+
+def build_multi_remix_command(requests: List[ProcessRequest], source_path: Path, output_paths: List[Path], video_width: int,
+                              video_height: int, prepared_overlays: Optional[List[Dict[int, Path]]] = None,
+                              profile: Optional[dict] = None, time_offset: float = 0.0,
+                              video_only: bool = False) -> List[str]:
+    """
+    Comando FFmpeg con un solo decode del sorgente e un output per variante.
+    Trim e velocità vengono presi dalla prima richiesta (condivisi da tutte).
+    prepared_overlays: per ogni variante, indice overlay -> intermedio preparato.
+    profile: profilo encoder (thread di decode/filtri/encode); None = lowmem.
+    time_offset: secondi di output prima del trim (segmenti di un render
+    parallelo): finestre e clip degli overlay restano allineate al video intero.
+    video_only: niente audio (lo aggiunge il concat dei segmenti).
+    """
+    shared = requests[0]
+    global_args = ["-y"]
+    if profile is not None:
+        # Thread di filtri e decoder allineati al profilo (default: tutti i core)
+        global_args.extend(["-filter_complex_threads", str(profile["threads"]), "-threads", str(profile["threads"])])
+    graph = FilterGraph(global_args)
+    # Trim: seek to start
+    source = graph.input(source_path, ["-ss", str(shared.trim_start)] if shared.trim_start > 0 else [])
+    
+    # Playback speed (condiviso, prima dello split) e tempo di output del segmento
+    pts = f"{1/shared.playback_speed}*PTS" if shared.playback_speed != 1.0 else "PTS"
+    offset = f"+{time_offset:g}/TB" if time_offset else ""
+    base_stream = graph.apply(source.stream("v"), Filter("setpts", f"{pts}{offset}"), label="vbase")
+    
+    # Senza cambio di velocità né offset le varianti senza filtri video copiano il video
+    can_copy = shared.playback_speed == 1.0 and not time_offset
+    copied = [can_copy and not has_video_filters(request) for request in requests]
+    
+    # Un solo decode: split dello stream base in un ramo per variante filtrata
+    filtered = copied.count(False)
+    branches = iter(graph.split(base_stream, filtered, label="base_v") if filtered else [])
+    
+    for request, copy_video, output_path, prepared in zip(
+            requests, copied, output_paths, prepared_overlays or [None] * len(requests)):
+        if copy_video:
+            out_stream = source.stream("v")
+        else:
+            out_stream = build_variant_filters(request, graph, next(branches), video_width, prepared)
+        if time_offset:
+            # Il segmento riparte da 0 per il concat
+            out_stream = graph.apply(out_stream, Filter("setpts", "PTS-STARTPTS"), label="segment")
+        
+        args = ["-map", out_stream]
+        args.extend(["-an"] if video_only else build_audio_args(request, graph, source))
+        args.extend(COPY_ENCODE_ARGS if copy_video else output_encode_args(profile))
+        
+        # Trim duration (dell'output, quindi dopo la velocità) - DEVE essere prima dell'output file
+        if shared.trim_end and shared.trim_end > shared.trim_start:
+            trim_duration = (shared.trim_end - shared.trim_start) / shared.playback_speed
+            args.extend(["-t", str(trim_duration)])
+            print(f"[DEBUG] Trim duration: {trim_duration}s")
+        
+        graph.output(output_path, args)
+    
+    return graph.compile()
+
+def build_remix_command(request: ProcessRequest, source_path: Path, output_path: Path, video_width: int, video_height: int,
+                        prepared_overlays: Optional[Dict[int, Path]] = None, profile: Optional[dict] = None) -> List[str]:
+    """
+    Costruisce il comando FFmpeg per il remix (overlay, audio, testo, editing).
+    prepared_overlays: indice overlay -> intermedio già keyato e scalato.
+    """
+    return build_multi_remix_command(
+        [request], source_path, [output_path], video_width, video_height,
+        [prepared_overlays] if prepared_overlays else None, profile
+    )
+
+async def plan_render(requests: List[ProcessRequest], source_path: Path) -> dict:
+    """
+    Profilo encoder e stima di memoria/CPU per un render (una o più varianti
+    dello stesso sorgente, come build_multi_remix_command).
+    """
+    shared = requests[0]
+    video_width, video_height = await get_video_dimensions(shared.video_id, source_path)
+    try:
+        fps = (await media_index.get(shared.video_id, source_path)).get("fps")
+    except Exception:
+        fps = None
+    overlays = sum(len(get_overlay_list(r)) for r in requests)
+    filters = sum(
+        (1 if r.brightness != 0 or r.contrast != 0 or r.saturation != 0 else 0) + (1 if r.text_overlay else 0)
+        for r in requests
+    ) + (1 if shared.playback_speed != 1.0 else 0)
+    duration = await expected_output_duration(shared, source_path)
+    
+    # Un remix senza filtri video è uno stream copy: niente segmenti
+    segments = (await plan_parallel_segments(shared, source_path)
+                if len(requests) == 1 and not can_smart_cut(shared) else None)
+    while segments:
+        # N processi insieme, ognuno con la sua quota di core e memoria
+        profile = select_profile(video_width, video_height, RENDER_WORKERS * len(segments), 1, overlays, filters)
+        # Il segmento più lungo determina la durata del render
+        source_seconds = sum(end - start for start, end in segments)
+        longest = max(end - start for start, end in segments) / source_seconds * duration if duration else None
+        per_segment = estimate_render(video_width, video_height, longest, fps, profile, 1, overlays, filters)
+        fit = int(render_budget.budget_mb // per_segment["memory_mb"]) if per_segment["memory_mb"] else len(segments)
+        if fit >= len(segments):
+            break
+        # Meno segmenti (più lunghi): profilo e stima vanno ricalcolati
+        segments = await plan_parallel_segments(shared, source_path, fit) if fit >= 2 else None
+    if segments:
+        total = estimate_render(video_width, video_height, duration, fps, profile, 1, overlays, filters)
+        estimate = {
+            **per_segment,
+            "memory_mb": round(per_segment["memory_mb"] * len(segments), 1),
+            "cpu_seconds": total["cpu_seconds"],
+        }
     else:
-        cmd.extend(["-map", "0:a?"])
-        if audio_filter:
-            cmd.extend(["-af", audio_filter])
-    
-    # Output settings - ottimizzato per bassa memoria (Render free tier 512MB)
-    # Output settings
-    cmd.extend([
-        "-threads", "1",
-        "-c:v", "libx264",
-        "-pix_fmt", "yuv420p",
-        "-preset", "ultrafast",
-        "-crf", "28",
-        "-maxrate", "2M",
-        "-bufsize", "1M",
-        "-movflags", "+faststart",
-        "-c:a", "aac",
-        "-b:a", "96k",
-    ])
-    
-    # Trim duration - DEVE essere prima dell'output file
-    if trim_duration:
-        cmd.extend(["-t", str(trim_duration)])
-        print(f"[DEBUG] Trim duration: {trim_duration}s")
-    
-    cmd.append(str(output_path))
+        segments = None
+        profile = select_profile(video_width, video_height, RENDER_WORKERS, len(requests), overlays, filters)
+        estimate = estimate_render(video_width, video_height, duration, fps, profile, len(requests), overlays, filters)
+    estimate.update({"width": video_width, "height": video_height, "outputs": len(requests),
+                     "segments": len(segments) if segments else 1})
+    return {"profile": profile, "estimate": estimate, "segments": segments}
+
+async def plan_parallel_segments(request: ProcessRequest, source_path: Path,
+                                 count: Optional[int] = None) -> Optional[List[Tuple[float, float]]]:
+    """
+    Segmenti (secondi del sorgente) per il render parallelo, o None se il
+    render resta in un solo processo (disattivato, un solo core per worker,
+    sorgente corto o senza tabella dei keyframe).
+    """
+    if count is None:
+        count = PARALLEL_RENDER_SEGMENTS or RENDER_CPUS // RENDER_WORKERS
+    if not PARALLEL_RENDER_ENABLED or count < 2:
+        return None
+    try:
+        media = await media_index.get(request.video_id, source_path)
+    except Exception:
+        return None
+    duration = media.get("duration")
+    if not duration or not media.get("keyframes"):
+        return None
+    start = request.trim_start
+    end = min(request.trim_end, duration) if request.trim_end and request.trim_end > start else duration
+    if end - start < PARALLEL_RENDER_MIN_SECONDS:
+        return None
+    # -ss conta dall'inizio del file, i keyframe sono timestamp del container
+    start_time = media.get("start_time") or 0
+    keyframes = [k - start_time for k in media["keyframes"]]
+    segments = plan_segments(keyframes, start, end, count)
+    return segments if len(segments) > 1 else None
+
+@asynccontextmanager
+async def admit_render(plan: dict, job: Optional[Job] = None, trace: Optional[Trace] = None):
+    """Attende che il render stia nel budget di memoria (stato visibile nel job)"""
+    memory_mb = plan["estimate"]["memory_mb"]
+    if job is not None and not render_budget.fits(memory_mb):
+        job.progress = {"state": "waiting_memory", "memory_mb": memory_mb}
+        print(f"[Resources] Job {job.id} in attesa di memoria ({memory_mb} MB)")
+    started = time.perf_counter()
+    async with render_budget.reserve(memory_mb):
+        if trace is not None:
+            trace.record("admission", time.perf_counter() - started)
+        yield
+
+def render_cache_key(request: ProcessRequest, source_path: Path) -> str:
+    """
+    Chiave di cache del remix: richiesta normalizzata (senza video_id e con
+    gli overlay legacy convertiti) + hash di sorgente, overlay e audio.
+    """
+    params = request.dict(exclude={"video_id", "overlays", "overlay_id", "overlay_x", "overlay_y",
+                                   "overlay_scale", "remove_green_screen", "remove_black_screen"})
+    overlay_list = get_overlay_list(request)
+    params["overlays"] = [item.dict() for item in overlay_list]
+    # L'id dell'asset non conta, conta il contenuto
+    for item in params["overlays"]:
+        item.pop("id")
+    params.pop("audio_id")
+    
+    files = [source_path]
+    for overlay_item in overlay_list:
+        overlay_path = resolve_overlay_path(overlay_item.id)
+        if overlay_path:
+            files.append(overlay_path)
+            mode = key_mode(overlay_path, overlay_item.remove_green_screen, overlay_item.remove_black_screen)
+            if uses_auto_key(overlay_item, mode):
+                # Un nuovo algoritmo di rilevamento produce un key diverso
+                params["key_detect_version"] = KEY_DETECT_VERSION
+    if request.text_overlay:
+        # Stessa didascalia con un altro font o renderer -> altro render
+        params["text_layer"] = [TEXT_LAYER_VERSION, text_layers.font_id]
+    audio_path = resolve_audio_path(request.audio_id) if request.audio_id else None
+    params["has_custom_audio"] = audio_path is not None
+    if audio_path:
+        files.append(audio_path)
+    return compute_key(params, files)
+
+async def prepare_overlays(request: ProcessRequest, video_width: int) -> Dict[int, Path]:
+    """
+    Recupera (o costruisce) gli intermedi keyati e scalati degli overlay
+    e il PNG del testo (chiave TEXT_LAYER).
+    """
+    prepared = {}
+    if request.text_overlay:
+        prepared[TEXT_LAYER] = await text_layers.ensure(request.text_overlay, request.text_font_size, video_width)
+    for idx, overlay_item in enumerate(get_overlay_list(request)):
+        overlay_path = resolve_overlay_path(overlay_item.id)
+        if not overlay_path:
+            continue
+        mode = key_mode(overlay_path, overlay_item.remove_green_screen, overlay_item.remove_black_screen)
+        width = int(video_width * overlay_item.scale)
+        key = await key_detector.params(overlay_path, _ffmpeg_executor) if uses_auto_key(overlay_item, mode) else None
+        prepared_path = await overlay_cache.ensure(overlay_path, mode, width, _ffmpeg_executor, key)
+        if prepared_path:
+            prepared[idx] = prepared_path
+    return prepared
+
+def has_video_filters(request: ProcessRequest) -> bool:
+    """True se la variante ha filtri video propri (eq, overlay, testo)"""
+    return bool(
+        get_overlay_list(request)
+        or request.text_overlay
+        or request.brightness != 0
+        or request.contrast != 0
+        or request.saturation != 0
+    )
+
+def can_smart_cut(request: ProcessRequest) -> bool:
+    """True se la richiesta è solo trim (ed eventualmente cambio audio): niente filtri video"""
+    return not has_video_filters(request) and request.playback_speed == 1.0
+
+async def try_smart_cut(request: ProcessRequest, source_path: Path, output_path: Path, job: Optional[Job] = None,
+                        trace: Optional[Trace] = None) -> bool:
+    """
+    Trim con stream copy dei GOP interi. Ritorna False se il sorgente non lo
+    permette o lo smart cut fallisce: in quel caso si usa il render completo.
+    """
+    audio_path = resolve_audio_path(request.audio_id) if request.audio_id else None
+    
+    async def _run(cmd: List[str]):
+        return await run_ffmpeg(cmd, job, trace=trace)
     
     try:
-        await run_ffmpeg(cmd)
-        
-        return ProcessResponse(
-            success=True,
-            output_filename=output_filename,
-            output_url=f"/output/{output_filename}",
-            message="Video processato con successo!"
+        media = await media_index.get(request.video_id, source_path)
+        await smart_cut(
+            source_path,
+            output_path,
+            work_dir=TEMP_DIR / f"smartcut_{output_path.stem}",
+            trim_start=request.trim_start,
+            trim_end=request.trim_end,
+            audio_path=audio_path,
+            remove_original_audio=request.remove_original_audio,
+            media=media,
+            run=_run,
         )
+        return True
+    except SmartCutUnavailable as e:
+        print(f"[SmartCut] Non disponibile, render completo: {e}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        if job is not None and job.cancel_requested:
+            raise
+        print(f"[SmartCut] Fallito, render completo: {e}")
+    return False
 
-@router.post("/upload-video")
-async def upload_video(file: UploadFile = File(...)):
-    """Carica un video direttamente invece di scaricarlo da URL"""
-    video_id = str(uuid.uuid4())[:8]
+async def run_traced(pipeline: str, job: Optional[Job], render: Callable[[Trace], Awaitable]):
+    """Esegue un render con un Trace: tempi per fase nel log, nelle metriche e in job.timings"""
+    trace = Trace(pipeline, job.id if job else None)
+    result = "error"
+    try:
+        response = await render(trace)
+        result = "ok"
+        return response
+    except asyncio.CancelledError:
+        result = "cancelled"
+        raise
+    finally:
+        summary = trace.finish(result)
+        if job is not None:
+            job.timings = summary
+
+async def render_remix(request: ProcessRequest, job: Optional[Job] = None, cache_key: Optional[str] = None) -> ProcessResponse:
+    """Esegue un remix completo: probe, costruzione comando e encode"""
+    return await run_traced("remix", job, lambda trace: _render_remix(request, job, cache_key, trace))
+
+async def _render_remix(request: ProcessRequest, job: Optional[Job], cache_key: Optional[str], trace: Trace) -> ProcessResponse:
+    loop = asyncio.get_event_loop()
+    with trace.stage("resolve_assets"):
+        source_path = find_source_video(request.video_id)
+        if cache_key is None:
+            cache_key = await loop.run_in_executor(_ffmpeg_executor, render_cache_key, request, source_path)
     
-    # Mantieni l'estensione originale
-    ext = Path(file.filename).suffix or ".mp4"
-    filename = f"{video_id}{ext}"
-    file_path = TEMP_DIR / filename
+    output_filename = render_cache.filename(cache_key)
+    output_path = render_cache.temp_path(cache_key)
+    
+    # Il sorgente non può essere eliminato dall'eviction finché il render è in corso
+    with storage.in_use(source_path):
+        try:
+            fast_path_done = False
+            if can_smart_cut(request):
+                with trace.stage("smart_cut"):
+                    fast_path_done = await try_smart_cut(request, source_path, output_path, job, trace)
+            
+            if not fast_path_done:
+                with trace.stage("probe"):
+                    # Ottieni dimensioni video (dall'indice) per calcolare scala overlay
+                    video_width, video_height = await get_video_dimensions(request.video_id, source_path)
+                    plan = await plan_render([request], source_path)
+                    expected_duration = await expected_output_duration(request, source_path)
+                print(f"[DEBUG] Video dimensions: {video_width}x{video_height}")
+                print(f"[Resources] {plan['estimate']}")
+                
+                with trace.stage("overlays"):
+                    prepared_overlays = await prepare_overlays(request, video_width)
+                if plan["segments"]:
+                    await render_segmented(request, source_path, output_path, plan, video_width, video_height,
+                                           prepared_overlays, job, trace)
+                else:
+                    with trace.stage("filtergraph"):
+                        cmd = build_remix_command(request, source_path, output_path, video_width, video_height,
+                                                  prepared_overlays, plan["profile"])
+                    async with admit_render(plan, job, trace):
+                        with trace.stage("ffmpeg"), storage.in_use(*prepared_overlays.values()):
+                            await run_ffmpeg(cmd, job, expected_duration, trace)
+            trace.record_output(output_path)
+            render_cache.commit(cache_key, request.video_id)
+        finally:
+            render_cache.discard(cache_key)
+    
+    # Eviction dopo ogni render (quote e TTL di temp/ e output/)
+    await storage.sweep()
+    
+    return ProcessResponse(
+        success=True,
+        output_filename=output_filename,
+        output_url=f"/output/{output_filename}",
+        message="Video processato con successo!"
+    )
+
+async def render_segmented(request: ProcessRequest, source_path: Path, output_path: Path, plan: dict,
+                           video_width: int, video_height: int, prepared_overlays: Dict[int, Path],
+                           job: Optional[Job], trace: Trace):
+    """
+    Render parallelo: lo stesso filtergraph su ogni segmento del sorgente
+    (un FFmpeg per segmento, in parallelo) e concat dei pezzi con l'audio
+    dell'intervallo intero. Ogni segmento include solo gli overlay a schermo.
+    """
+    segments = plan["segments"]
+    speed = request.playback_speed
+    overlay_list = get_overlay_list(request)
+    work_dir = TEMP_DIR / f"segments_{output_path.stem}"
+    work_dir.mkdir(parents=True, exist_ok=True)
     
+    pieces, cmds, durations = [], [], []
+    with trace.stage("filtergraph"):
+        for idx, (seg_start, seg_end) in enumerate(segments):
+            offset = (seg_start - segments[0][0]) / speed
+            duration = (seg_end - seg_start) / speed
+            kept = [i for i, item in enumerate(overlay_list)
+                    if overlay_visible(item.start, item.end, offset, offset + duration)]
+            show_text = overlay_visible(request.text_start, request.text_end, offset, offset + duration)
+            seg_request = request.copy(update={
+                "overlays": [overlay_list[i] for i in kept],
+                "overlay_id": None,
+                "text_overlay": request.text_overlay if show_text else None,
+                "trim_start": seg_start,
+                "trim_end": seg_end,
+            })
+            seg_prepared = {new: prepared_overlays[old] for new, old in enumerate(kept) if old in prepared_overlays}
+            if show_text and TEXT_LAYER in prepared_overlays:
+                seg_prepared[TEXT_LAYER] = prepared_overlays[TEXT_LAYER]
+            piece = work_dir / f"segment_{idx}.mp4"
+            cmds.append(build_multi_remix_command(
+                [seg_request], source_path, [piece], video_width, video_height, [seg_prepared], plan["profile"],
+                time_offset=offset, video_only=True
+            ))
+            pieces.append(piece)
+            durations.append(duration)
+    print(f"[Segments] {len(segments)} segmenti in parallelo: "
+          f"{', '.join(f'{s:.1f}-{e:.1f}s' for s, e in segments)}")
+    
+    group = ProcessGroup(durations)
+    if job is not None:
+        # La cancellazione termina tutti i processi dei segmenti
+        job.process = group
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async with admit_render(plan, job, trace):
+            with trace.stage("ffmpeg"), storage.in_use(*prepared_overlays.values()):
+                try:
+                    await asyncio.gather(*[
+                        run_ffmpeg(cmd, job, duration, trace, group, idx)
+                        for idx, (cmd, duration) in enumerate(zip(cmds, durations))
+                    ])
+                except BaseException:
+                    # Un segmento fallito (o il job annullato): inutile finire gli altri
+                    group.kill()
+                    raise
         
+        list_path = work_dir / "segments.txt"
+        write_concat_list(pieces, list_path)
+        audio_path = resolve_audio_path(request.audio_id) if request.audio_id else None
+        with trace.stage("concat"):
+            await run_ffmpeg(build_concat_command(
+                list_path, source_path, segments[0][0], segments[-1][1],
+                audio_path, request.remove_original_audio, output_path, playback_speed=speed
+            ), job, sum(durations), trace)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def remix_inputs(request: ProcessRequest, source_path: Path) -> dict:
+    """File di cui un worker ha bisogno per il remix (nomi in temp/ e negli asset)"""
+    overlays = [resolve_overlay_path(item.id) for item in get_overlay_list(request)]
+    audio_path = resolve_audio_path(request.audio_id) if request.audio_id else None
+    return {
+        "source": source_path.name,
+        "overlays": sorted({path.name for path in overlays if path is not None}),
+        "audio": [audio_path.name] if audio_path else [],
+    }
+
+async def dispatch_remix(request: ProcessRequest, job: Optional[Job], cache_key: str) -> ProcessResponse:
+    """
+    Remix eseguito da un worker tramite il broker. Il job locale resta quello
+    visto dai client (stato, SSE, annullamento) e rispecchia il job del broker;
+    il worker pubblica l'output direttamente nella cache dei render.
+    """
+    source_path = find_source_video(request.video_id)
+    broker_id = job.id if job is not None else uuid.uuid4().hex[:8]
+    payload = {"request": jsonable_encoder(request), "cache_key": cache_key, "inputs": remix_inputs(request, source_path)}
+    await render_broker.enqueue(broker_id, "remix", payload, job.priority if job is not None else 0)
+    state = None
+    try:
+        # Il sorgente serve ai worker finché il render non è finito
+        with storage.in_use(source_path):
+            while state is None or state["status"] not in FINAL_STATES:
+                await asyncio.sleep(BROKER_POLL_SECONDS)
+                state = await render_broker.get(broker_id)
+                if state is None:
+                    raise Exception("Job non più presente nel broker")
+                if job is not None and state["progress"]:
+                    job.progress = state["progress"]
+    except asyncio.CancelledError:
+        await render_broker.cancel(broker_id)
+        raise
+    if state["status"] == JOB_CANCELLED:
+        raise Exception("Render annullato sul worker")
+    if state["status"] == JOB_FAILED:
+        raise Exception(state["error"] or "Render fallito sul worker")
+    output_path = render_cache.lookup(cache_key, request.video_id)
+    if output_path is None:
+        raise Exception(f"Il worker {state['worker']} non ha pubblicato il render")
+    print(f"[Broker] Job {broker_id} renderizzato da {state['worker']}")
+    return ProcessResponse(**state["result"])
+
+async def submit_remix(request: ProcessRequest, priority: int = 0) -> Tuple[Job, str]:
+    """
+    Valida la richiesta e la mette in coda di render.
+    Se il remix è già in cache ritorna un job già completato; se un remix
+    identico è in corso ritorna quel job invece di crearne un duplicato.
+    Ritorna anche il token con cui questo client può rinunciare al job.
+    """
+    validate_windows(request)
+    source_path = find_source_video(request.video_id)
+    await validate_trim(request, source_path)
+    loop = asyncio.get_event_loop()
+    cache_key = await loop.run_in_executor(None, render_cache_key, request, source_path)
+    
+    shared = _shared_remix_jobs.get(cache_key)
+    if shared is not None and not shared.finished:
+        token = shared.attach()
+        print(f"[RenderCache] Render identico già in corso: job {shared.id} ({len(shared.waiters)} client)")
+        return shared, token
+    
+    cached_path = render_cache.lookup(cache_key, request.video_id)
+    if cached_path:
+        print(f"[RenderCache] Hit: {cached_path.name}")
+        job = remix_queue.add_completed("remix", cached_remix_response(cached_path), payload=request)
+        return job, job.attach()
+    
+    async def _runner(job: Job):
+        try:
+            async with claim_renders([cache_key], request.video_id) as missing:
+                if not missing:
+                    # Renderizzato nel frattempo da un batch con una variante identica
+                    return cached_remix_response(render_cache.lookup(cache_key))
+                if render_broker is not None:
+                    return await dispatch_remix(request, job, cache_key)
+                return await render_remix(request, job, cache_key)
+        finally:
+            if _shared_remix_jobs.get(cache_key) is job:
+                del _shared_remix_jobs[cache_key]
+    
+    try:
+        job = remix_queue.submit("remix", _runner, priority=priority, payload=request)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Troppi render in coda, riprova tra poco ({e})")
+    _shared_remix_jobs[cache_key] = job
+    return job, job.attach()
+
+def cached_remix_response(cached_path: Path) -> ProcessResponse:
+    return ProcessResponse(
+        success=True,
+        output_filename=cached_path.name,
+        output_url=f"/output/{cached_path.name}",
+        cached=True,
+        message="Video processato con successo! (dalla cache)"
+    )
+
+@asynccontextmanager
+async def claim_renders(keys: List[str], video_id: str):
+    """
+    Prende le chiavi di cache per un render, dopo aver atteso i render in
+    corso delle stesse chiavi (remix singoli o batch). Restituisce le chiavi
+    ancora da renderizzare: le altre sono state completate nel frattempo
+    (e diventano anche di video_id).
+    """
+    claims = {}
+    for key in keys:
+        claims[key] = RenderClaim(_inflight_renders.get(key))
+        _inflight_renders[key] = claims[key]
+    try:
+        for claim in claims.values():
+            # Tutta la catena: un render annullato mentre attendeva non libera la chiave
+            previous = claim.previous
+            while previous is not None:
+                await previous.done.wait()
+                previous = previous.previous
+        yield [key for key in keys if render_cache.lookup(key, video_id) is None]
+    finally:
+        for key, claim in claims.items():
+            claim.done.set()
+            if _inflight_renders.get(key) is claim:
+                del _inflight_renders[key]
+
+def active_render_keys() -> List[str]:
+    """Chiavi di cache dei render in corso (singoli e batch)"""
+    return list(_inflight_renders)
+
+async def render_batch(batch: BatchRemixRequest, job: Optional[Job] = None) -> BatchResponse:
+    """
+    Renderizza tutte le varianti con un solo FFmpeg: il sorgente viene
+    decodificato una volta e lo stream base viene splittato per variante.
+    Le varianti già in cache non vengono ricalcolate.
+    """
+    return await run_traced("batch", job, lambda trace: _render_batch(batch, job, trace))
+
+async def _render_batch(batch: BatchRemixRequest, job: Optional[Job], trace: Trace) -> BatchResponse:
+    requests = batch.to_requests()
+    loop = asyncio.get_event_loop()
+    with trace.stage("resolve_assets"):
+        source_path = find_source_video(batch.video_id)
+        keys = [
+            await loop.run_in_executor(_ffmpeg_executor, render_cache_key, request, source_path)
+            for request in requests
+        ]
+    
+    results: List[Optional[VariantResult]] = [None] * len(requests)
+    pending = []
+    for i, key in enumerate(keys):
+        cached_path = render_cache.lookup(key, batch.video_id)
+        if cached_path:
+            results[i] = VariantResult(
+                name=batch.variants[i].name,
+                output_filename=cached_path.name,
+                output_url=f"/output/{cached_path.name}",
+                cached=True
+            )
+        elif key not in [keys[j] for j in pending]:
+            pending.append(i)
+    
+    if pending:
+        async with claim_renders([keys[i] for i in pending], batch.video_id) as missing:
+            # Varianti completate nel frattempo da altri render (remix singoli o batch)
+            pending = [i for i in pending if keys[i] in missing]
+            if pending:
+                await _render_variants(batch.video_id, [requests[i] for i in pending], [keys[i] for i in pending],
+                                       source_path, job, trace)
+        if pending:
+            await storage.sweep()
+    
+    # Varianti identiche nello stesso batch condividono l'output
+    for i, key in enumerate(keys):
+        if results[i] is None:
+            filename = render_cache.filename(key)
+            results[i] = VariantResult(
+                name=batch.variants[i].name,
+                output_filename=filename,
+                output_url=f"/output/{filename}",
+            )
+    
+    return BatchResponse(
+        success=True,
+        results=results,
+        message=f"{len(results)} varianti pronte ({len(pending)} renderizzate)"
+    )
+
+async def _render_variants(video_id: str, requests: List[ProcessRequest], keys: List[str], source_path: Path,
+                           job: Optional[Job], trace: Trace):
+    """Un solo FFmpeg per le varianti da renderizzare (chiavi già prese con claim_renders)"""
+    with trace.stage("probe"):
+        video_width, video_height = await get_video_dimensions(video_id, source_path)
+        plan = await plan_render(requests, source_path)
+        expected_duration = await expected_output_duration(requests[0], source_path)
+    print(f"[Resources] {plan['estimate']}")
+    with trace.stage("overlays"):
+        prepared = [await prepare_overlays(request, video_width) for request in requests]
+    with trace.stage("filtergraph"):
+        cmd = build_multi_remix_command(
+            requests,
+            source_path,
+            [render_cache.temp_path(key) for key in keys],
+            video_width,
+            video_height,
+            prepared,
+            plan["profile"]
+        )
+    overlay_paths = [path for overlays in prepared for path in overlays.values()]
+    try:
+        async with admit_render(plan, job, trace):
+            with trace.stage("ffmpeg"), storage.in_use(source_path, *overlay_paths):
+                await run_ffmpeg(cmd, job, expected_duration, trace)
+        for key in keys:
+            trace.record_output(render_cache.temp_path(key))
+            render_cache.commit(key, video_id)
+    finally:
+        for key in keys:
+            render_cache.discard(key)
+
+def job_queues() -> List[JobQueue]:
+    """Code dei job dell'API (una sola senza broker)"""
+    return [render_queue] if remix_queue is render_queue else [render_queue, remix_queue]
+
+def queue_of(job: Job) -> JobQueue:
+    return remix_queue if job.kind == "remix" else render_queue
+
+def get_job_or_404(job_id: str) -> Job:
+    job = render_queue.get(job_id) or remix_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trovato")
+    return job
+
+async def wait_for_client(job: Job, token: str, http_request: Request):
+    """
+    Attende la fine del job per un client in attesa sulla richiesta HTTP.
+    Se il client si disconnette rinuncia al job: il render si ferma solo
+    se nessun altro client lo sta aspettando.
+    """
+    try:
+        while not job.finished:
+            if await http_request.is_disconnected():
+                print(f"[Jobs] Client disconnesso dal job {job.id}")
+                queue_of(job).cancel(job.id, token)
+                return
+            try:
+                await asyncio.wait_for(job.wait(), timeout=JOB_EVENTS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    except asyncio.CancelledError:
+        queue_of(job).cancel(job.id, token)
+        raise
+
+@router.post("/remix", response_model=ProcessResponse)
+async def process_video(request: ProcessRequest, http_request: Request):
+    """
+    Processa il video con overlay, audio e testo.
+    Passa comunque dalla coda di render e attende il risultato
+    (per client che non usano /jobs).
+    """
+    job, token = await submit_remix(request)
+    await wait_for_client(job, token, http_request)
+    if not job.finished:
+        raise HTTPException(status_code=499, detail="Client disconnesso")
+    
+    if job.status == JOB_DONE:
+        return job.result
+    if job.status == JOB_CANCELLED:
+        raise HTTPException(status_code=409, detail="Render annullato")
+    raise HTTPException(status_code=500, detail=job.error or "Errore durante il render")
+
+@router.post("/jobs", response_model=JobSubmitResponse)
+async def submit_job(request: ProcessRequest, priority: int = 0):
+    """
+    Mette in coda un remix e ritorna subito il job_id.
+    priority: valore più basso = eseguito prima.
+    """
+    job, token = await submit_remix(request, priority=priority)
+    return JobSubmitResponse(
+        success=True,
+        job_id=job.id,
+        status=job.status,
+        queue_position=queue_of(job).position(job),
+        message="Render in coda",
+        token=token
+    )
+
+def job_status(job: Job) -> dict:
+    """Stato serializzabile di un job (con posizione in coda e risultato)"""
+    status = job.to_dict()
+    status["queue_position"] = queue_of(job).position(job)
+    if job.status == JOB_DONE:
+        status["result"] = jsonable_encoder(job.result)
+    return status
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Stato di un job di render"""
+    return job_status(get_job_or_404(job_id))
+
+@router.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """
+    Stato e avanzamento del job (frame, fps, speed, percent, eta) in
+    Server-Sent Events, fino alla fine del job.
+    """
+    job = get_job_or_404(job_id)
+    
+    async def _events():
+        last_payload = None
+        while True:
+            payload = json.dumps(job_status(job))
+            if payload != last_payload:
+                yield f"event: progress\ndata: {payload}\n\n"
+                last_payload = payload
+            if job.finished:
+                yield f"event: end\ndata: {payload}\n\n"
+                return
+            try:
+                await asyncio.wait_for(job.wait(), timeout=JOB_EVENTS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/batch", response_model=JobSubmitResponse)
+async def submit_batch(batch: BatchRemixRequest, priority: int = 0):
+    """
+    Mette in coda N varianti dello stesso video: un solo decode del sorgente,
+    un output per variante. Il risultato (BatchResponse) si legge da /jobs/{job_id}/result.
+    """
+    if not batch.variants:
+        raise HTTPException(status_code=400, detail="Nessuna variante")
+    if len(batch.variants) > MAX_BATCH_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Massimo {MAX_BATCH_VARIANTS} varianti per batch")
+    for request in batch.to_requests():
+        validate_windows(request)
+    source_path = find_source_video(batch.video_id)
+    await validate_trim(batch.to_requests()[0], source_path)
+    
+    async def _runner(job: Job):
+        return await render_batch(batch, job)
+    
+    try:
+        job = render_queue.submit("batch", _runner, priority=priority, payload=batch)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Troppi render in coda, riprova tra poco ({e})")
+    return JobSubmitResponse(
+        success=True,
+        job_id=job.id,
+        status=job.status,
+        queue_position=render_queue.position(job),
+        message=f"Batch di {len(batch.variants)} varianti in coda"
+    )
+
+@router.get("/jobs/{job_id}/result", response_model=Union[ProcessResponse, BatchResponse])
+async def get_job_result(job_id: str):
+    """Risultato di un job completato"""
+    job = get_job_or_404(job_id)
+    if job.status == JOB_DONE:
+        return job.result
+    if job.status == JOB_FAILED:
+        raise HTTPException(status_code=500, detail=job.error or "Errore durante il render")
+    if job.status == JOB_CANCELLED:
+        raise HTTPException(status_code=410, detail="Render annullato")
+    raise HTTPException(status_code=409, detail=f"Render non ancora completato ({job.status})")
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, token: Optional[str] = None):
+    """
+    Annulla un job in coda o in esecuzione. Per un job condiviso da più
+    client serve il token ricevuto alla creazione: ogni token stacca un solo
+    client e il render si ferma quando si stacca l'ultimo.
+    """
+    job = get_job_or_404(job_id)
+    if job.finished:
+        raise HTTPException(status_code=409, detail=f"Job già terminato ({job.status})")
+    if token is not None and token not in job.waiters:
+        raise HTTPException(status_code=403, detail="Token non valido o già usato per questo job")
+    if token is None and len(job.waiters) > 1:
+        raise HTTPException(status_code=409, detail="Job condiviso da più client: annulla con il tuo token")
+    if not queue_of(job).cancel(job_id, token):
+        raise HTTPException(status_code=409, detail=f"Job già terminato ({job.status})")
+    if not job.cancel_requested:
+        return {"success": True, "job_id": job.id, "message": "Render lasciato agli altri client che lo attendono"}
+    return {"success": True, "job_id": job.id, "message": "Render annullato"}
+
+async def estimate_response(requests: List[ProcessRequest], source_path: Path) -> dict:
+    plan = await plan_render(requests, source_path)
+    return {
+        **plan["estimate"],
+        "rc_lookahead": plan["profile"]["rc_lookahead"],
+        "admit_now": render_budget.fits(plan["estimate"]["memory_mb"]),
+        "resources": render_budget.stats(),
+    }
+
+@router.post("/estimate")
+async def estimate_remix(request: ProcessRequest):
+    """
+    Dry run di un remix: profilo encoder scelto, stima di memoria di picco,
+    CPU e durata, e se il render partirebbe subito con il budget attuale.
+    """
+    validate_windows(request)
+    source_path = find_source_video(request.video_id)
+    await validate_trim(request, source_path)
+    return await estimate_response([request], source_path)
+
+@router.post("/batch/estimate")
+async def estimate_batch(batch: BatchRemixRequest):
+    """Dry run di un batch (tutte le varianti in un solo FFmpeg)"""
+    if not batch.variants:
+        raise HTTPException(status_code=400, detail="Nessuna variante")
+    source_path = find_source_video(batch.video_id)
+    return await estimate_response(batch.to_requests(), source_path)
+
+def register_uploaded_video(data_path: Path, digest: str, original_name: Optional[str]) -> dict:
+    """
+    Porta un upload completo (file temporaneo + sha256) nel flusso video_id:
+    stesso contenuto già caricato -> stesso video_id, senza tenere il doppione.
+    """
+    content_key = f"sha256:{digest}"
+    existing = download_cache.lookup(content_key)
+    if existing:
+        data_path.unlink(missing_ok=True)
         return {
             "success": True,
-            "video_id": video_id,
-            "filename": filename,
-            "message": "Video caricato con successo!"
+            "video_id": existing["video_id"],
+            "filename": existing["filename"],
+            "cached": True,
+            "message": "Video già caricato, riutilizzato"
         }
+    
+    # Mantieni l'estensione originale
+    ext = Path(original_name or "").suffix or ".mp4"
+    video_id = str(uuid.uuid4())[:8]
+    filename = f"{video_id}{ext}"
+    file_path = TEMP_DIR / filename
+    os.replace(data_path, file_path)
+    
+    # Probe e proxy di anteprima in background
+    on_video_ingested(video_id, file_path)
+    download_cache.store({
+        "video_id": video_id,
+        "filename": filename,
+        "title": original_name or filename,
+    }, content_key)
+    
+    return {
+        "success": True,
+        "video_id": video_id,
+        "filename": filename,
+        "cached": False,
+        "message": "Video caricato con successo!"
+    }
+
+@router.post("/upload-video")
+async def upload_video(file: UploadFile = File(...)):
+    """
+    Carica un video direttamente invece di scaricarlo da URL.
+    Stesso contenuto (sha256) già caricato -> stesso video_id, senza riscriverlo.
+    """
+    try:
+        part_path, digest, _ = await stream_upload(file, TEMP_DIR, MAX_VIDEO_UPLOAD_MB * MB)
+        return register_uploaded_video(part_path, digest, file.filename)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/uploads")
+async def create_upload_session(request: UploadSessionRequest):
+    """Apre un upload riprendibile: i chunk arrivano poi con PUT /uploads/{session_id}?offset=N"""
+    session = upload_sessions.create(request.filename, request.size, request.sha256)
+    return session.to_dict()
+
+@router.put("/uploads/{session_id}")
+async def upload_chunk(session_id: str, offset: int, request: Request):
+    """Scrive il body (byte grezzi) a partire da offset. I chunk possono arrivare in parallelo e fuori ordine."""
+    session = await upload_sessions.write_chunk(session_id, offset, request.stream())
+    return session.to_dict()
+
+@router.get("/uploads/{session_id}")
+async def get_upload_session(session_id: str):
+    """Intervalli già ricevuti e mancanti, per riprendere dopo un'interruzione"""
+    return upload_sessions.get(session_id).to_dict()
+
+@router.post("/uploads/{session_id}/complete")
+async def complete_upload_session(session_id: str):
+    """Chiude l'upload: il file completo diventa un video_id come per /upload-video"""
+    data_path, digest, session = await upload_sessions.finalize(session_id)
+    try:
+        return register_uploaded_video(data_path, digest, session.filename)
+    finally:
+        upload_sessions.discard(session_id)
+
+@router.delete("/uploads/{session_id}")
+async def abort_upload_session(session_id: str):
+    """Annulla un upload in corso e libera lo spazio"""
+    if upload_sessions.get(session_id).finalizing:
+        raise HTTPException(status_code=409, detail="Upload in chiusura")
+    upload_sessions.discard(session_id)
+    return {"success": True, "message": "Upload annullato"}
+
+@router.get("/media/{video_id}")
+async def get_media_info(video_id: str):
+    """Metadati del video sorgente (durata, fps, codec, keyframe...)"""
+    source_path = find_source_video(video_id)
+    try:
+        return await media_index.get(video_id, source_path)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Probe fallito: {str(e)}")
+
+@router.get("/storage")
+async def get_storage_stats():
+    """Spazio occupato in temp/ e output/ per tipo di file, quote, file in uso e video pinnati"""
+    return storage.stats()
+
+@router.post("/storage/pin/{video_id}")
+async def pin_video(video_id: str):
+    """Esclude dall'eviction automatica il video e tutti i suoi derivati"""
+    find_source_video(video_id)
+    storage.pin(video_id)
+    return {"success": True, "video_id": video_id, "pinned": True}
+
+@router.delete("/storage/pin/{video_id}")
+async def unpin_video(video_id: str):
+    storage.unpin(video_id)
+    return {"success": True, "video_id": video_id, "pinned": False}
+
 @router.delete("/cleanup/{video_id}")
 async def cleanup_video(video_id: str):
-    """Pulisce i file temporanei di un video"""
-    deleted = []
-    for dir_path in [TEMP_DIR, OUTPUT_DIR]:
-        for file_path in dir_path.glob(f"*{video_id}*"):
-            file_path.unlink()
-            deleted.append(str(file_path))
-    
-    return {"deleted": deleted}
+    """Pulisce sorgente, derivati e render di un video (solo i suoi file, dall'indice)"""
+    deleted = on_video_removed(video_id)
+    return {"deleted": [str(path) for path in deleted]}
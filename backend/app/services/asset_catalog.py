@@ -0,0 +1,229 @@
+"""
+Catalogo in memoria degli asset (overlay e tracce audio).
+
+Indice id -> file (nome originale, tipo, dimensione, mtime, metadati del probe) tenuto
+aggiornato dagli hook di upload/eliminazione e da una riconciliazione
+periodica con il disco (per i file copiati a mano). Liste e risoluzione
+degli id non toccano più il filesystem: ogni lookup è un accesso a dict.
+"""
+import asyncio
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.services.uploads import NameStore
+
+ASSET_CATALOG_RESCAN = float(os.environ.get("ASSET_CATALOG_RESCAN", "30"))
+
+KIND_OVERLAYS = "overlays"
+KIND_AUDIO = "audio"
+
+OVERLAY_VIDEO_EXTENSIONS = ['.mov', '.mp4', '.webm', '.gif']
+OVERLAY_EXTENSIONS = OVERLAY_VIDEO_EXTENSIONS + ['.png']
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.m4a', '.aac']
+
+# Estensioni elencate nelle liste per tipo (l'indice contiene comunque tutti i file)
+LIST_EXTENSIONS = {KIND_OVERLAYS: OVERLAY_EXTENSIONS, KIND_AUDIO: AUDIO_EXTENSIONS}
+
+# Priorità quando più file hanno lo stesso nome senza estensione
+STEM_PRIORITY = OVERLAY_EXTENSIONS
+
+
+def _priority(entry: dict, order: List[str]) -> int:
+    ext = Path(entry["file"]).suffix.lower()
+    return order.index(ext) if ext in order else len(order)
+
+
+def make_entry(kind: str, path: Path, stat: os.stat_result, original_name: Optional[str] = None) -> dict:
+    ext = path.suffix.lower()
+    entry = {
+        # Gli overlay si identificano per nome senza estensione, l'audio per nome file
+        "id": path.stem if kind == KIND_OVERLAYS else path.name,
+        # file = nome su disco (hash per gli upload), filename = nome originale da mostrare
+        "file": path.name,
+        "filename": original_name or path.name,
+        "url": f"/assets/{kind}/{path.name}",
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "kind": kind,
+        "probe": None,
+    }
+    if kind == KIND_OVERLAYS:
+        entry["type"] = "video" if ext in OVERLAY_VIDEO_EXTENSIONS else "image"
+    return entry
+
+
+class _KindIndex:
+    """Indice di una cartella: per nome file, per stem (anche case-insensitive) ed ETag"""
+
+    def __init__(self):
+        self.by_name: Dict[str, dict] = {}
+        self.by_stem: Dict[str, List[dict]] = {}
+        self.by_stem_lower: Dict[str, List[dict]] = {}
+        self.listed: List[dict] = []
+        self.etag = '"empty"'
+
+
+class AssetCatalog:
+    """Indice in memoria degli asset sotto root/overlays e root/audio"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._lock = threading.RLock()
+        self._indexes: Dict[str, _KindIndex] = {}
+        self._names: Dict[str, NameStore] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def directory(self, kind: str) -> Path:
+        return self.root / kind
+
+    def names(self, kind: str) -> NameStore:
+        if kind not in self._names:
+            self._names[kind] = NameStore(self.directory(kind))
+        return self._names[kind]
+
+    def reset(self, root: Path):
+        """Cambia la cartella radice e riscansiona (es. benchmark)"""
+        self.root = root
+        with self._lock:
+            self._indexes = {}
+            self._names = {}
+        self.reconcile()
+
+    def _index(self, kind: str) -> _KindIndex:
+        index = self._indexes.get(kind)
+        if index is None:
+            self.reconcile(kind)
+            index = self._indexes[kind]
+        return index
+
+    def _publish(self, kind: str, by_name: Dict[str, dict]):
+        """Ricostruisce gli indici derivati e li sostituisce in blocco (letture senza lock)"""
+        index = _KindIndex()
+        index.by_name = by_name
+        for entry in by_name.values():
+            stem = Path(entry["file"]).stem
+            index.by_stem.setdefault(stem, []).append(entry)
+            index.by_stem_lower.setdefault(stem.lower(), []).append(entry)
+        for entries in list(index.by_stem.values()) + list(index.by_stem_lower.values()):
+            entries.sort(key=lambda e: _priority(e, STEM_PRIORITY))
+        allowed = LIST_EXTENSIONS[kind]
+        index.listed = sorted(
+            (e for e in by_name.values() if Path(e["file"]).suffix.lower() in allowed),
+            key=lambda e: (e["filename"].lower(), e["file"]),
+        )
+        signature = "\n".join(f"{e['file']}:{e['filename']}:{e['size']}:{e['mtime']}" for e in index.listed)
+        index.etag = f'"{hashlib.sha1(signature.encode()).hexdigest()[:16]}"'
+        self._indexes[kind] = index
+
+    def reconcile(self, kind: Optional[str] = None) -> int:
+        """Allinea l'indice al disco (bloccante). Ritorna il numero di cambiamenti."""
+        changes = 0
+        for k in ([kind] if kind else [KIND_OVERLAYS, KIND_AUDIO]):
+            directory = self.directory(k)
+            kind_changes = 0
+            with self._lock:
+                current = self._indexes.get(k)
+                old = current.by_name if current else {}
+                by_name = {}
+                if directory.exists():
+                    with os.scandir(directory) as it:
+                        for item in it:
+                            if item.name.startswith(".") or not item.is_file():
+                                continue
+                            stat = item.stat()
+                            previous = old.get(item.name)
+                            if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+                                by_name[item.name] = previous
+                            else:
+                                by_name[item.name] = make_entry(k, Path(item.path), stat, self.names(k).get(item.name))
+                                kind_changes += 1
+                kind_changes += len(set(old) - set(by_name))
+                if kind_changes or current is None:
+                    self._publish(k, by_name)
+            changes += kind_changes
+        return changes
+
+    def add(self, kind: str, path: Path, original_name: Optional[str] = None) -> dict:
+        """Hook dopo upload/scrittura di un file (original_name: nome da mostrare)"""
+        with self._lock:
+            names = self.names(kind)
+            if original_name and original_name != path.name:
+                names.set(path.name, original_name)
+            entry = make_entry(kind, path, path.stat(), names.get(path.name))
+            by_name = dict(self._index(kind).by_name)
+            by_name[path.name] = entry
+            self._publish(kind, by_name)
+        return entry
+
+    def remove(self, kind: str, path: Path):
+        """Hook dopo l'eliminazione di un file"""
+        with self._lock:
+            self.names(kind).remove(path.name)
+            by_name = dict(self._index(kind).by_name)
+            if by_name.pop(path.name, None) is not None:
+                self._publish(kind, by_name)
+
+    def set_probe(self, kind: str, stored_name: str, probe: dict):
+        entry = self._index(kind).by_name.get(stored_name)
+        if entry is not None:
+            entry["probe"] = probe
+
+    def path(self, entry: dict) -> Path:
+        return self.directory(entry["kind"]) / entry["file"]
+
+    def lookup(self, kind: str, asset_id: str, order: Optional[List[str]] = None,
+               case_insensitive: bool = False) -> Optional[dict]:
+        """
+        Entry per id: nome file esatto, poi stem (il primo secondo order/STEM_PRIORITY),
+        poi stem senza distinzione di maiuscole se richiesto.
+        """
+        index = self._index(kind)
+        entry = index.by_name.get(asset_id)
+        if entry is not None:
+            return entry
+        candidates = index.by_stem.get(asset_id)
+        if not candidates and case_insensitive:
+            candidates = index.by_stem_lower.get(asset_id.lower())
+        if not candidates:
+            return None
+        if order:
+            return min(candidates, key=lambda e: _priority(e, order))
+        return candidates[0]
+
+    def resolve(self, kind: str, asset_id: str) -> Optional[Path]:
+        entry = self.lookup(kind, asset_id)
+        return self.path(entry) if entry else None
+
+    def listing(self, kind: str) -> tuple:
+        """(entry elencabili ordinate per nome, ETag) con una sola lettura coerente"""
+        index = self._index(kind)
+        return index.listed, index.etag
+
+    async def _reconcile_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(ASSET_CATALOG_RESCAN)
+            try:
+                changes = await loop.run_in_executor(None, self.reconcile)
+                if changes:
+                    print(f"[Assets] Catalogo riallineato: {changes} cambiamenti su disco")
+            except Exception as e:
+                print(f"[Assets] Riconciliazione fallita: {e}")
+
+    def start(self):
+        """Scansione iniziale + riconciliazione periodica (startup dell'app)"""
+        self.reconcile()
+        if ASSET_CATALOG_RESCAN > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._reconcile_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+asset_catalog = AssetCatalog(Path("assets"))
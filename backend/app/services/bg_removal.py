@@ -0,0 +1,221 @@
+"""
+Rimozione dello sfondo degli overlay con provider intercambiabili.
+
+- removebg: API remove.bg (o un servizio compatibile su REMOVEBG_API_URL,
+  es. lo stand-in locale in benchmarks/removebg_standin.py), con un solo
+  client httpx condiviso (connessioni riusate) invece di uno per richiesta.
+- local: stesso algoritmo dello stand-in eseguito in-process (colore di key
+  dal bordo, alpha dalla distanza UV), senza rete né quota.
+
+I risultati sono salvati per hash del contenuto dell'overlay in temp/nobg/:
+la stessa immagine non consuma mai due volte la quota di remove.bg.
+"""
+import asyncio
+import os
+import subprocess
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import httpx
+import numpy as np
+from PIL import Image
+
+from app.services.ffmpeg import FFMPEG_PATH
+from app.services.key_detect import analyze, rgb_to_uv, uv_distance
+from app.services.render_cache import file_hash
+from app.services.storage import storage
+
+# Provider: removebg (API remove.bg, gratuita 50 img/mese) o local (chroma key in-process)
+BG_REMOVAL_PROVIDER = os.environ.get("BG_REMOVAL_PROVIDER", "removebg")
+REMOVEBG_API_KEY = os.environ.get("REMOVEBG_API_KEY", "")
+REMOVEBG_API_URL = os.environ.get("REMOVEBG_API_URL", "https://api.remove.bg/v1.0/removebg")
+# Richieste al provider in parallelo (anche nei batch) e timeout per richiesta
+BG_REMOVAL_CONCURRENCY = int(os.environ.get("BG_REMOVAL_CONCURRENCY", "2"))
+BG_REMOVAL_TIMEOUT = float(os.environ.get("BG_REMOVAL_TIMEOUT", "60"))
+
+NOBG_DIR = Path("temp") / "nobg"
+
+VIDEO_EXTENSIONS = ['.mp4', '.mov', '.webm']
+
+
+class BackgroundRemovalError(Exception):
+    """Errore del provider (status_code: codice HTTP da restituire al client)"""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def first_frame_png(path: Path) -> bytes:
+    """Primo frame di un video come PNG, via FFmpeg su pipe (bloccante)"""
+    cmd = [
+        FFMPEG_PATH, "-v", "error", "-i", str(path), "-an",
+        "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "pipe:1",
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0 or not result.stdout:
+        raise Exception(f"FFmpeg error: {result.stderr.decode(errors='replace')[-2000:]}")
+    return result.stdout
+
+
+def read_input(path: Path) -> bytes:
+    """Immagine da inviare al provider: il file stesso o il primo frame se è un video"""
+    if path.suffix.lower() in VIDEO_EXTENSIONS:
+        return first_frame_png(path)
+    return path.read_bytes()
+
+
+def chroma_cutout(image_data: bytes) -> bytes:
+    """
+    Rimozione locale: colore di sfondo dal bordo (come il rilevamento del key)
+    e alpha proporzionale alla distanza UV, con rampa di blend. Ritorna un PNG RGBA.
+    """
+    image = Image.open(BytesIO(image_data)).convert("RGB")
+    pixels = np.asarray(image)
+    key = analyze(pixels[None, ...])
+    key_rgb = np.array([int(key["color"][i:i + 2], 16) for i in (2, 4, 6)], dtype=np.float32)
+    key_u, key_v = rgb_to_uv(key_rgb)
+    u, v = rgb_to_uv(pixels)
+    distance = uv_distance(u, v, key_u, key_v)
+    alpha = np.clip((distance - key["similarity"]) / max(key["blend"], 1e-4), 0, 1) * 255
+    rgba = np.dstack([pixels, alpha.astype(np.uint8)])
+    buffer = BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class BackgroundRemovalProvider:
+    """Interfaccia dei provider: remove() riceve un'immagine e ritorna un PNG con alpha"""
+    name = "base"
+
+    def available(self) -> bool:
+        return True
+
+    async def remove(self, image_data: bytes) -> bytes:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class RemoveBgProvider(BackgroundRemovalProvider):
+    """API remove.bg (o compatibile) con client httpx condiviso"""
+    name = "remove.bg"
+
+    def __init__(self, url: str, api_key: str, concurrency: int, timeout: float):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def available(self) -> bool:
+        return bool(self.api_key)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self._client
+
+    async def remove(self, image_data: bytes) -> bytes:
+        try:
+            response = await self.client.post(
+                self.url,
+                headers={"X-Api-Key": self.api_key},
+                files={"image_file": ("image.png", image_data, "image/png")},
+                data={"size": "auto"},
+            )
+        except httpx.HTTPError as e:
+            raise BackgroundRemovalError(f"{self.name} non raggiungibile: {e}")
+        if response.status_code == 200:
+            return response.content
+        try:
+            error = response.json().get("errors", [{}])[0].get("title", "Errore")
+        except ValueError:
+            error = f"HTTP {response.status_code}"
+        # Quota esaurita / rate limit: il client può riprovare più tardi
+        status = 429 if response.status_code in (402, 429) else 502
+        raise BackgroundRemovalError(f"{self.name}: {error}", status)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class LocalProvider(BackgroundRemovalProvider):
+    """Chroma key in-process (sfondi uniformi: green screen, fondi a tinta unita)"""
+    name = "local"
+
+    async def remove(self, image_data: bytes) -> bytes:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, chroma_cutout, image_data)
+
+
+def create_provider(name: str) -> BackgroundRemovalProvider:
+    if name == "removebg":
+        return RemoveBgProvider(REMOVEBG_API_URL, REMOVEBG_API_KEY, BG_REMOVAL_CONCURRENCY, BG_REMOVAL_TIMEOUT)
+    if name == "local":
+        return LocalProvider()
+    raise ValueError(f"Provider di rimozione sfondo sconosciuto: {name}")
+
+
+class BackgroundRemover:
+    """Cache per contenuto + concorrenza limitata davanti al provider configurato"""
+
+    def __init__(self, provider: BackgroundRemovalProvider, cache_dir: Path, concurrency: int):
+        self.provider = provider
+        self.cache_dir = cache_dir
+        self.concurrency = max(1, concurrency)
+        # Creato al primo uso, dentro il loop dell'app
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def available(self) -> bool:
+        return self.provider.available()
+
+    def cache_path(self, content_hash: str) -> Path:
+        # Provider diversi danno risultati diversi per la stessa immagine
+        return self.cache_dir / f"{content_hash[:16]}_{self.provider.name.replace('.', '')}.png"
+
+    async def _process(self, overlay_path: Path, output_path: Path):
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            input_data = await loop.run_in_executor(None, read_input, overlay_path)
+            output_data = await self.provider.remove(input_data)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        part_path = output_path.with_name(f"part_{output_path.name}")
+        part_path.write_bytes(output_data)
+        os.replace(part_path, output_path)
+        storage.register(output_path)
+        print(f"[BgRemoval] {overlay_path.name}: sfondo rimosso con {self.provider.name}")
+
+    async def remove(self, overlay_path: Path) -> Tuple[Path, bool]:
+        """
+        PNG senza sfondo dell'overlay (in cache). Ritorna (path, dalla cache).
+        Overlay con lo stesso contenuto condividono una sola chiamata al provider.
+        """
+        loop = asyncio.get_event_loop()
+        content_hash = await loop.run_in_executor(None, file_hash, overlay_path)
+        output_path = self.cache_path(content_hash)
+        if output_path.exists():
+            storage.touch(output_path)
+            return output_path, True
+
+        pending = self._pending.get(content_hash)
+        if pending is None:
+            pending = asyncio.ensure_future(self._process(overlay_path, output_path))
+            self._pending[content_hash] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(content_hash, None))
+        await asyncio.shield(pending)
+        return output_path, False
+
+    async def close(self):
+        await self.provider.close()
+
+
+background_remover = BackgroundRemover(create_provider(BG_REMOVAL_PROVIDER), NOBG_DIR, BG_REMOVAL_CONCURRENCY)
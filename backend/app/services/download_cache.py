@@ -0,0 +1,144 @@
+"""
+Cache dei download per URL canonico / id del video sulla piattaforma.
+
+Lo stesso video TikTok/Instagram scaricato da due persone (anche con link
+diversi: tracking params, short link, m.tiktok.com...) viene scaricato una
+sola volta: le richieste successive ricevono lo stesso video_id in temp/ e
+le richieste concorrenti condividono un unico download in corso.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+DOWNLOAD_CACHE_TTL_HOURS = float(os.environ.get("DOWNLOAD_CACHE_TTL_HOURS", "24"))
+
+INDEX_PATH = Path("temp") / "download_index.json"
+
+# Parametri che non identificano il video (tracking/condivisione)
+TRACKING_PARAMS = {
+    "igshid", "igsh", "fbclid", "gclid", "si", "feature", "_r", "_t", "is_from_webapp",
+    "sender_device", "sender_web_id", "share_app_id", "share_link_id", "tt_from", "u_code",
+}
+
+# Pattern (host, regex sul path/query) -> chiave "extractor:id" senza rete
+VIDEO_ID_PATTERNS = [
+    ("tiktok", re.compile(r"tiktok\.com/.*?/video/(\d+)")),
+    ("instagram", re.compile(r"instagram\.com/(?:[^/]+/)?(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)")),
+    ("youtube", re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/)|youtu\.be/)([A-Za-z0-9_-]{11})")),
+]
+
+
+def canonicalize_url(url: str) -> str:
+    """Normalizza un URL: host minuscolo senza www./m., niente fragment e tracking params"""
+    parts = urlsplit(url.strip())
+    scheme = (parts.scheme or "https").lower()
+    if scheme == "http":
+        scheme = "https"
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip("/") or "/"
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=False)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")
+    ]
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ""))
+
+
+def static_video_key(canonical_url: str) -> Optional[str]:
+    """Chiave "extractor:id" ricavabile dal solo URL (senza chiamare la piattaforma)"""
+    for extractor, pattern in VIDEO_ID_PATTERNS:
+        match = pattern.search(canonical_url)
+        if match:
+            return f"{extractor}:{match.group(1)}"
+    return None
+
+
+def info_video_key(info: dict) -> Optional[str]:
+    """Chiave "extractor:id" dalle info di yt-dlp"""
+    extractor = (info.get("extractor_key") or info.get("extractor") or "").lower()
+    video_id = info.get("id")
+    if extractor and video_id:
+        return f"{extractor}:{video_id}"
+    return None
+
+
+class DownloadCache:
+    """Indice chiave -> video già scaricato in temp/, persistito su JSON"""
+
+    def __init__(self, index_path: Path, ttl: float):
+        self.index_path = index_path
+        self.ttl = ttl
+        self._entries: Dict[str, dict] = {}
+        self._loaded = False
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            self._entries = json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _save(self):
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._entries))
+        os.replace(tmp, self.index_path)
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Entry valida (file ancora presente e non scaduta) o None"""
+        self._load()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        file_path = self.index_path.parent / entry["filename"]
+        expired = self.ttl and time.time() - entry.get("created_at", 0) > self.ttl
+        if expired or not file_path.exists():
+            del self._entries[key]
+            self._save()
+            return None
+        return entry
+
+    def store(self, entry: dict, *keys: Optional[str]):
+        """Registra un download sotto una o più chiavi (URL canonico, id piattaforma)"""
+        self._load()
+        entry.setdefault("created_at", time.time())
+        for key in keys:
+            if key:
+                self._entries[key] = entry
+        self._save()
+
+    def forget_video(self, video_id: str):
+        """Rimuove tutte le chiavi che puntano a un video (es. dopo cleanup)"""
+        self._load()
+        stale = [k for k, e in self._entries.items() if e.get("video_id") == video_id]
+        for key in stale:
+            del self._entries[key]
+        if stale:
+            self._save()
+
+    async def run_once(self, key: str, download: Callable[[], Awaitable[dict]]) -> Tuple[dict, bool]:
+        """
+        Esegue download() una sola volta per chiave: le richieste concorrenti
+        attendono lo stesso risultato. Ritorna (entry, condiviso).
+        """
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending), True
+
+        pending = asyncio.ensure_future(download())
+        self._pending[key] = pending
+        pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending), False
+
+
+download_cache = DownloadCache(INDEX_PATH, DOWNLOAD_CACHE_TTL_HOURS * 3600)
@@ -0,0 +1,195 @@
+"""
+Percorsi e utility comuni per FFmpeg/ffprobe.
+"""
+import os
+import platform
+import subprocess
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+# FFmpeg path - su Render/Linux usa "ffmpeg", su Windows usa il path assoluto
+if platform.system() == "Windows":
+    FFMPEG_PATH = r"C:\Users\39351\AppData\Local\Microsoft\WinGet\Packages\Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe\ffmpeg-8.0.1-full_build\bin\ffmpeg.exe"
+else:
+    FFMPEG_PATH = "ffmpeg"
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", FFMPEG_PATH)
+
+
+def _sibling_tool(name: str) -> str:
+    """Path di un tool installato accanto a ffmpeg (es. ffprobe)"""
+    directory = os.path.dirname(FFMPEG_PATH)
+    if not directory:
+        return name
+    ext = ".exe" if FFMPEG_PATH.lower().endswith(".exe") else ""
+    return os.path.join(directory, f"{name}{ext}")
+
+
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", _sibling_tool("ffprobe"))
+
+
+# Righe di stderr conservate per i messaggi d'errore (ring buffer)
+FFMPEG_STDERR_LINES = int(os.environ.get("FFMPEG_STDERR_LINES", "200"))
+# Secondi senza avanzamento dopo i quali un encode è considerato bloccato
+FFMPEG_STALL_TIMEOUT = float(os.environ.get("FFMPEG_STALL_TIMEOUT", "120"))
+
+
+def parse_progress_block(block: Dict[str, str], expected_duration: Optional[float] = None) -> dict:
+    """Converte un blocco -progress (chiave=valore) nei campi esposti al client"""
+    def _number(key, cast=float):
+        value = block.get(key, "").strip().rstrip("x")
+        try:
+            return cast(value)
+        except ValueError:
+            return None
+
+    out_time_us = _number("out_time_us", int)
+    if out_time_us is None:
+        out_time_us = _number("out_time_ms", int)  # storicamente in microsecondi
+    out_time = out_time_us / 1_000_000 if out_time_us is not None and out_time_us >= 0 else None
+    speed = _number("speed")
+
+    progress = {
+        "frame": _number("frame", int),
+        "fps": _number("fps"),
+        "speed": speed,
+        "out_time": out_time,
+        "total_size": _number("total_size", int),
+        "percent": None,
+        "eta": None,
+        "state": block.get("progress"),
+    }
+    if expected_duration and out_time is not None:
+        progress["percent"] = round(min(100.0, out_time / expected_duration * 100), 1)
+        if speed:
+            progress["eta"] = round(max(0.0, expected_duration - out_time) / speed, 1)
+    if block.get("progress") == "end":
+        progress["percent"] = 100.0
+        progress["eta"] = 0.0
+    return progress
+
+
+def run_with_progress(
+    cmd: List[str],
+    on_progress: Optional[Callable[[dict], None]] = None,
+    on_start: Optional[Callable[[subprocess.Popen], None]] = None,
+    expected_duration: Optional[float] = None,
+    stall_timeout: float = FFMPEG_STALL_TIMEOUT,
+    on_usage: Optional[Callable[[dict], None]] = None,
+) -> Tuple[int, str, bool]:
+    """
+    Esegue FFmpeg (bloccante) leggendo l'avanzamento da -progress pipe:1.
+    Lo stderr viene tenuto in un ring buffer di FFMPEG_STDERR_LINES righe.
+    Se non arriva avanzamento per stall_timeout secondi il processo viene ucciso.
+    on_usage riceve le risorse usate dal processo (wall, user, sys, max_rss).
+    Ritorna (returncode, coda dello stderr, bloccato).
+    """
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + cmd[1:]
+    started = time.monotonic()
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+    )
+    if on_start is not None:
+        on_start(process)
+
+    stderr_tail: Deque[str] = deque(maxlen=FFMPEG_STDERR_LINES)
+    last_update = [time.monotonic()]
+    stalled = threading.Event()
+    exited = threading.Event()
+
+    def _read_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line.rstrip("\n"))
+
+    def _watchdog():
+        # Niente poll(): il processo viene raccolto da wait4 per leggerne le risorse
+        while not exited.wait(1):
+            if stall_timeout and time.monotonic() - last_update[0] > stall_timeout:
+                stalled.set()
+                process.kill()
+                return
+
+    stderr_thread = threading.Thread(target=_read_stderr, daemon=True)
+    stderr_thread.start()
+    threading.Thread(target=_watchdog, daemon=True).start()
+
+    block: Dict[str, str] = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        if not key:
+            continue
+        block[key] = value
+        if key == "progress":
+            # Fine di un blocco: frame, fps, out_time, speed... sono completi
+            last_update[0] = time.monotonic()
+            if on_progress is not None:
+                on_progress(parse_progress_block(block, expected_duration))
+            block = {}
+
+    returncode, usage = _wait_with_usage(process)
+    exited.set()
+    stderr_thread.join(timeout=5)
+    if on_usage is not None:
+        usage["wall"] = time.monotonic() - started
+        on_usage(usage)
+    return returncode, "\n".join(stderr_tail), stalled.is_set()
+
+
+def _wait_with_usage(process: subprocess.Popen) -> Tuple[int, dict]:
+    """Attende il processo e ne legge tempo CPU e RSS di picco (solo POSIX)"""
+    if hasattr(os, "wait4"):
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss è in KB su Linux, in byte su macOS
+            max_rss = rusage.ru_maxrss if platform.system() == "Darwin" else rusage.ru_maxrss * 1024
+            return process.returncode, {"user": rusage.ru_utime, "sys": rusage.ru_stime, "max_rss": max_rss}
+        except ChildProcessError:
+            # Già raccolto da un poll() concorrente (es. cancellazione del job)
+            pass
+    return process.wait(), {}
+
+
+def run_ffmpeg_sync(cmd: List[str]) -> subprocess.CompletedProcess:
+    """Esegue un comando FFmpeg breve (bloccante) e solleva in caso di errore"""
+    print(f"[FFmpeg CMD] {' '.join(cmd)}")
+    returncode, stderr_tail, stalled = run_with_progress(cmd)
+    if returncode != 0 or stalled:
+        print(f"[FFmpeg ERROR] {stderr_tail}")
+        raise Exception(f"FFmpeg error: {stderr_tail}")
+    return subprocess.CompletedProcess(cmd, returncode, "", stderr_tail)
+
+
+def write_concat_list(pieces: List[Path], list_path: Path):
+    """Lista per il concat demuxer (percorsi assoluti, da usare con -safe 0)"""
+    list_path.write_text("".join(f"file '{p.resolve().as_posix()}'\n" for p in pieces))
+
+
+def build_concat_command(list_path: Path, source_path: Path, start: float, end: float,
+                         audio_path: Optional[Path], remove_original_audio: bool, output_path: Path,
+                         playback_speed: float = 1.0) -> List[str]:
+    """
+    Unisce pezzi solo video con il concat demuxer (stream copy) e codifica
+    l'audio una volta sola: custom (sostituisce l'originale) o originale
+    tagliato su [start, end), con atempo se la velocità è cambiata.
+    Usato dallo smart cut e dal render a segmenti.
+    """
+    cmd = [FFMPEG_PATH, "-y", "-f", "concat", "-safe", "0", "-i", str(list_path)]
+    if audio_path:
+        cmd.extend(["-i", str(audio_path), "-map", "0:v", "-map", "1:a", "-shortest"])
+    elif not remove_original_audio:
+        cmd.extend(["-ss", f"{start:.6f}", "-t", f"{end - start:.6f}", "-i", str(source_path),
+                    "-map", "0:v", "-map", "1:a?"])
+        if playback_speed != 1.0:
+            cmd.extend(["-af", f"atempo={playback_speed}"])
+    else:
+        cmd.extend(["-map", "0:v", "-an"])
+    cmd.extend(["-c:v", "copy", "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart", str(output_path)])
+    return cmd
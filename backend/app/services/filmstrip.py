@@ -0,0 +1,144 @@
+"""
+Filmstrip (sprite sheet) per la timeline del trim.
+
+N frame equidistanti vengono estratti con un solo passaggio FFmpeg (frame
+raw RGB su pipe), montati in un'unica immagine con Pillow e salvati in
+temp/filmstrip/ insieme all'indice JSON: le riaperture dell'editor leggono
+solo i file in cache.
+"""
+import asyncio
+import json
+import math
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image
+
+from app.services.ffmpeg import FFMPEG_PATH
+from app.services.storage import storage
+
+FILMSTRIP_DIR = Path("temp") / "filmstrip"
+
+MAX_FRAMES = 100
+MAX_TILE_HEIGHT = 360
+SPRITE_COLUMNS = 10
+
+
+class FilmstripCache:
+    """Sprite sheet + indice per (video, numero frame, altezza, modalità)"""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="filmstrip")
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def _name(self, video_id: str, frames: int, height: int, fast: bool) -> str:
+        return f"{video_id}_{frames}_{height}{'_fast' if fast else ''}"
+
+    def sprite_path(self, video_id: str, frames: int, height: int, fast: bool) -> Path:
+        return self.cache_dir / f"{self._name(video_id, frames, height, fast)}.jpg"
+
+    def index_path(self, video_id: str, frames: int, height: int, fast: bool) -> Path:
+        return self.cache_dir / f"{self._name(video_id, frames, height, fast)}.json"
+
+    def build(self, video_id: str, source_path: Path, media: dict, frames: int, height: int, fast: bool) -> dict:
+        """Estrae i frame, crea lo sprite e scrive l'indice (bloccante)"""
+        duration = media.get("duration")
+        width, src_height = media.get("width"), media.get("height")
+        if not duration or not width or not src_height:
+            raise Exception("Metadati del video non disponibili")
+
+        tile_h = height
+        tile_w = max(2, int(round(width * tile_h / src_height / 2)) * 2)
+        frame_bytes = tile_w * tile_h * 3
+
+        cmd = [FFMPEG_PATH, "-v", "error"]
+        if fast:
+            # Decodifica solo i keyframe: i frame vengono "agganciati" al keyframe più vicino
+            cmd.extend(["-skip_frame", "nokey"])
+        cmd.extend([
+            "-i", str(source_path),
+            "-an",
+            "-vf", f"fps={frames}/{duration:.6f},scale={tile_w}:{tile_h}",
+            "-frames:v", str(frames),
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1",
+        ])
+        print(f"[FFmpeg CMD] {' '.join(cmd)}")
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            raise Exception(f"FFmpeg error: {result.stderr.decode(errors='replace')[-2000:]}")
+
+        count = min(frames, len(result.stdout) // frame_bytes)
+        if count == 0:
+            raise Exception("Nessun frame estratto")
+
+        columns = min(SPRITE_COLUMNS, count)
+        rows = math.ceil(count / columns)
+        sprite = Image.new("RGB", (columns * tile_w, rows * tile_h))
+        index = []
+        for i in range(count):
+            tile = Image.frombytes("RGB", (tile_w, tile_h), result.stdout[i * frame_bytes:(i + 1) * frame_bytes])
+            x, y = (i % columns) * tile_w, (i // columns) * tile_h
+            sprite.paste(tile, (x, y))
+            index.append({"index": i, "time": round(i * duration / frames, 3), "x": x, "y": y})
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        sprite_path = self.sprite_path(video_id, frames, height, fast)
+        part_path = sprite_path.with_name(f"part_{sprite_path.name}")
+        sprite.save(part_path, format="JPEG", quality=75, optimize=True)
+        os.replace(part_path, sprite_path)
+
+        data = {
+            "video_id": video_id,
+            "duration": duration,
+            "frame_count": count,
+            "tile_width": tile_w,
+            "tile_height": tile_h,
+            "columns": columns,
+            "rows": rows,
+            "fast": fast,
+            "frames": index,
+        }
+        index_path = self.index_path(video_id, frames, height, fast)
+        index_path.write_text(json.dumps(data))
+        storage.register(sprite_path)
+        storage.register(index_path)
+        return data
+
+    def load(self, video_id: str, frames: int, height: int, fast: bool) -> Optional[dict]:
+        index_path = self.index_path(video_id, frames, height, fast)
+        if not index_path.exists() or not self.sprite_path(video_id, frames, height, fast).exists():
+            return None
+        try:
+            return json.loads(index_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    async def get(self, video_id: str, source_path: Path, media: dict, frames: int, height: int, fast: bool) -> dict:
+        """Indice dello sprite (dalla cache o generandolo, una sola volta per chiave)"""
+        cached = self.load(video_id, frames, height, fast)
+        if cached is not None:
+            return cached
+
+        key = self._name(video_id, frames, height, fast)
+        pending = self._pending.get(key)
+        if pending is None:
+            loop = asyncio.get_event_loop()
+            pending = asyncio.ensure_future(loop.run_in_executor(
+                self._executor, self.build, video_id, source_path, media, frames, height, fast
+            ))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    def remove(self, video_id: str):
+        if not self.cache_dir.exists():
+            return
+        for path in self.cache_dir.glob(f"{video_id}_*"):
+            path.unlink(missing_ok=True)
+
+
+filmstrip_cache = FilmstripCache(FILMSTRIP_DIR)
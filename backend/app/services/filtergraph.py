@@ -0,0 +1,392 @@
+"""
+Filtergraph FFmpeg tipizzato, con un compilatore che lo ottimizza.
+
+I comandi di render non vengono più costruiti concatenando stringhe.
+FilterGraph raccoglie input, nodi di filtri e output; compile() ottimizza il
+grafo e produce l'argv di FFmpeg. Ottimizzazioni:
+- toglie i filtri no-op: setpts=PTS, eq neutro, null, split a un solo ramo,
+  format ripetuti;
+- unisce i nodi lineari in una sola catena e fonde in un unico filtro i
+  setpts e gli eq consecutivi;
+- porta la scala prima del key (chromakey/colorkey) quando riduce
+  l'immagine, così il key lavora su meno pixel;
+- numera gli input in ordine d'uso (solo quelli usati), genera le label e
+  risolve le mappe degli output.
+
+Costruire e verificare un comando non richiede FFmpeg.
+"""
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from app.services.ffmpeg import FFMPEG_PATH
+
+# Filtri che rendono trasparente lo sfondo, pixel per pixel
+KEY_FILTERS = ("chromakey", "colorkey")
+# Filtri che non cambiano le dimensioni dei frame (per risalire alla larghezza dell'input)
+SIZE_PRESERVING = ("setpts", "format", "null", "split", "eq") + KEY_FILTERS
+# Valori neutri di eq
+EQ_NEUTRAL = {"brightness": 0, "contrast": 1, "saturation": 1, "gamma": 1}
+EQ_FOLDABLE = ("brightness", "contrast", "saturation")
+# Espressione setpts che usa solo PTS, TB e costanti (componibile per sostituzione)
+_PURE_PTS = re.compile(r"^(?:PTS|TB|[0-9.eE+\-*/() ])+$")
+_NOOP_PTS = re.compile(r"^(?:1(?:\.0*)?\*)?PTS(?:\+0(?:\.0*)?/TB)?$")
+# k*PTS+c/TB: trasformazione affine del tempo
+_AFFINE_PTS = re.compile(r"^(?:(?P<k>[0-9.]+)\*)?PTS(?:[+-][0-9.]+/TB)?$")
+# Caratteri da proteggere con gli apici nei valori delle opzioni
+_SPECIAL = re.compile(r"[,:;\[\]]")
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        value = round(value, 6)
+        return str(int(value)) if value.is_integer() else repr(value)
+    text = str(value)
+    if _SPECIAL.search(text) and not (text.startswith("'") and text.endswith("'")):
+        return f"'{text}'"
+    return text
+
+
+class Filter:
+    """Un filtro: nome, argomenti posizionali e opzioni con nome (in ordine)"""
+
+    def __init__(self, name: str, *args, **options):
+        self.name = name
+        self.args = list(args)
+        self.options = dict(options)
+
+    def render(self) -> str:
+        params = [format_value(a) for a in self.args]
+        params.extend(f"{k}={format_value(v)}" for k, v in self.options.items())
+        return f"{self.name}={':'.join(params)}" if params else self.name
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Filter) and self.render() == other.render()
+
+    def __repr__(self) -> str:
+        return f"Filter({self.render()!r})"
+
+    @classmethod
+    def parse_chain(cls, text: Optional[str]) -> List["Filter"]:
+        """'chromakey=0x00FF00:0.3:0.1,format=rgba' -> filtri (catene semplici, senza espressioni con virgole)"""
+        filters = []
+        for part in (text or "").split(","):
+            if not part:
+                continue
+            name, _, params = part.partition("=")
+            filter_ = cls(name)
+            for param in params.split(":") if params else []:
+                key, sep, value = param.partition("=")
+                if sep:
+                    filter_.options[key] = value
+                else:
+                    filter_.args.append(param)
+            filters.append(filter_)
+        return filters
+
+
+class Input:
+    """File di input con le opzioni da mettere prima del suo -i; width: larghezza nota (probe)"""
+
+    def __init__(self, path: Path, options: Optional[List[str]] = None, width: Optional[int] = None):
+        self.path = path
+        self.options = list(options or [])
+        self.width = width
+
+    def stream(self, spec: str = "v") -> "InputStream":
+        return InputStream(self, spec)
+
+
+class InputStream:
+    """Stream di un input: spec come in FFmpeg (v, a, a? ...)"""
+
+    def __init__(self, input_: Input, spec: str):
+        self.input = input_
+        self.spec = spec
+
+
+class Node:
+    """Filtri applicati in catena a uno o più stream (il primo filtro riceve tutti gli input)"""
+
+    def __init__(self, inputs: List["Stream"], filters: List[Filter], outputs: int = 1, label: Optional[str] = None):
+        self.inputs = list(inputs)
+        self.filters = list(filters)
+        self.label = label
+        self.outputs = [NodeStream(self, i) for i in range(outputs)]
+
+    @property
+    def output(self) -> "NodeStream":
+        return self.outputs[0]
+
+
+class NodeStream:
+    def __init__(self, node: Node, index: int):
+        self.node = node
+        self.index = index
+
+
+Stream = Union[InputStream, NodeStream]
+
+
+class Output:
+    """File di output; args può contenere stream (es. dopo -map), risolti alla compilazione"""
+
+    def __init__(self, path: Path, args: List[Union[str, Stream]]):
+        self.path = path
+        self.args = list(args)
+
+
+# --- Ottimizzazioni su una catena di filtri ---------------------------------
+
+def is_noop(filter_: Filter) -> bool:
+    if filter_.name == "null":
+        return True
+    if filter_.name == "setpts":
+        return len(filter_.args) == 1 and bool(_NOOP_PTS.match(str(filter_.args[0]).replace(" ", "")))
+    if filter_.name == "eq":
+        if filter_.args:
+            return False
+        return all(
+            name in EQ_NEUTRAL and float(value) == EQ_NEUTRAL[name] for name, value in filter_.options.items()
+        )
+    if filter_.name == "split":
+        return filter_.args in ([], [1], ["1"])
+    return False
+
+
+def fold(first: Filter, second: Filter) -> Optional[Filter]:
+    """Un solo filtro equivalente a first seguito da second, o None se non si possono fondere"""
+    if first.name != second.name:
+        return None
+    if first.name == "format" and first == second:
+        return first
+    if first.name == "setpts" and len(first.args) == len(second.args) == 1:
+        inner, outer = str(first.args[0]).replace(" ", ""), str(second.args[0]).replace(" ", "")
+        affine = _AFFINE_PTS.match(inner)
+        if outer == "PTS-STARTPTS" and affine:
+            # Ripartire da 0 annulla lo spostamento: resta solo il fattore di velocità
+            return Filter("setpts", f"{affine.group('k')}*(PTS-STARTPTS)" if affine.group("k") else outer)
+        # outer(inner(PTS)): sostituzione di PTS, solo se outer non dipende da altro (STARTPTS, N, T...)
+        if not _PURE_PTS.match(outer):
+            return None
+        return Filter("setpts", re.sub(r"\bPTS\b", f"({inner})", outer))
+    if first.name == "eq" and not first.args and not second.args:
+        if not set(first.options) | set(second.options) <= set(EQ_FOLDABLE):
+            return None
+        # eq: y = (x - 0.5) * contrast + 0.5 + brightness (luma), saturation moltiplica la crominanza
+        b1, c1, s1 = (float(first.options.get(k, EQ_NEUTRAL[k])) for k in EQ_FOLDABLE)
+        b2, c2, s2 = (float(second.options.get(k, EQ_NEUTRAL[k])) for k in EQ_FOLDABLE)
+        return Filter("eq", brightness=b1 * c2 + b2, contrast=c1 * c2, saturation=s1 * s2)
+    return None
+
+
+def scale_width(filter_: Filter) -> Optional[int]:
+    if filter_.name != "scale" or not filter_.args:
+        return None
+    try:
+        return int(filter_.args[0])
+    except (TypeError, ValueError):
+        return None
+
+
+def scale_before_key(filters: List[Filter], source_width: Optional[int] = None) -> List[Filter]:
+    """
+    key (+ format) seguito da scale -> scale prima del key, se la scala riduce
+    l'immagine (o la larghezza dell'input non è nota): stesso risultato
+    visivo, key su molti meno pixel.
+    """
+    filters = list(filters)
+    for i, filter_ in enumerate(filters):
+        if filter_.name not in KEY_FILTERS:
+            continue
+        j = i + 1
+        while j < len(filters) and filters[j].name == "format":
+            j += 1
+        target = scale_width(filters[j]) if j < len(filters) else None
+        if target is None or (source_width is not None and source_width <= target):
+            continue
+        filters.insert(i, filters.pop(j))
+    return filters
+
+
+def simplify(filters: List[Filter], keep_first: bool = False) -> List[Filter]:
+    """
+    No-op rimossi e filtri consecutivi fusi.
+    keep_first: il primo filtro riceve più input (es. overlay) e resta com'è.
+    """
+    optimized: List[Filter] = []
+    for filter_ in filters:
+        if is_noop(filter_) and not (keep_first and not optimized):
+            continue
+        folded = fold(optimized[-1], filter_) if optimized and not (keep_first and len(optimized) == 1) else None
+        if folded is not None:
+            optimized[-1] = folded
+            if is_noop(folded):
+                optimized.pop()
+        else:
+            optimized.append(filter_)
+    return optimized
+
+
+def optimize_filters(filters: List[Filter], source_width: Optional[int] = None, keep_first: bool = False) -> List[Filter]:
+    """Scala anticipata al key, poi no-op rimossi e filtri consecutivi fusi"""
+    return simplify(scale_before_key(filters, source_width), keep_first)
+
+
+# --- Grafo -------------------------------------------------------------------
+
+class FilterGraph:
+    """Input, nodi e output di un comando FFmpeg; compile() -> argv"""
+
+    def __init__(self, global_args: Optional[List[str]] = None):
+        self.global_args = list(global_args or [])
+        self.inputs: List[Input] = []
+        self.nodes: List[Node] = []
+        self.outputs: List[Output] = []
+
+    def input(self, path: Path, options: Optional[List[str]] = None, width: Optional[int] = None) -> Input:
+        input_ = Input(path, options, width)
+        self.inputs.append(input_)
+        return input_
+
+    def node(self, inputs: List[Stream], filters: List[Filter], outputs: int = 1, label: Optional[str] = None) -> Node:
+        node = Node(inputs, filters, outputs, label)
+        self.nodes.append(node)
+        return node
+
+    def apply(self, stream: Stream, *filters: Filter, label: Optional[str] = None) -> Stream:
+        """Filtri in catena su uno stream (nessun filtro: lo stream stesso)"""
+        if not filters:
+            return stream
+        return self.node([stream], list(filters), label=label).output
+
+    def split(self, stream: Stream, count: int, label: Optional[str] = None) -> List[Stream]:
+        if count == 1:
+            return [stream]
+        return self.node([stream], [Filter("split", count)], count, label).outputs
+
+    def output(self, path: Path, args: List[Union[str, Stream]]) -> Output:
+        output = Output(path, args)
+        self.outputs.append(output)
+        return output
+
+    # --- Compilazione ---------------------------------------------------------
+
+    def _source_width(self, stream: Stream, resolve) -> Optional[int]:
+        """Larghezza dello stream risalendo i filtri che non la cambiano fino a un input"""
+        stream = resolve(stream)
+        while isinstance(stream, NodeStream):
+            node = stream.node
+            if len(node.inputs) != 1 or any(f.name not in SIZE_PRESERVING for f in node.filters):
+                return None
+            stream = resolve(node.inputs[0])
+        return stream.input.width
+
+    def compile(self, ffmpeg: str = FFMPEG_PATH) -> List[str]:
+        # 1. Ottimizzazione dei singoli nodi; i nodi lineari rimasti vuoti diventano alias del loro input
+        alias: Dict[int, Stream] = {}
+
+        def resolve(stream: Stream) -> Stream:
+            while isinstance(stream, NodeStream) and id(stream.node) in alias:
+                stream = alias[id(stream.node)]
+            return stream
+
+        filters: Dict[int, List[Filter]] = {}
+        for node in self.nodes:
+            width = self._source_width(node.inputs[0], resolve) if len(node.inputs) == 1 else None
+            optimized = optimize_filters(node.filters, width, keep_first=len(node.inputs) > 1)
+            if not optimized and len(node.inputs) == 1:
+                alias[id(node)] = node.inputs[0]
+            else:
+                filters[id(node)] = optimized
+
+        # 2. Nodi e input raggiungibili dagli output (in ordine di costruzione)
+        mapped = [resolve(arg) for output in self.outputs for arg in output.args if not isinstance(arg, str)]
+        live_nodes = set()
+        consumers: Dict[int, int] = {}
+        stack = list(mapped)
+        while stack:
+            stream = stack.pop()
+            if isinstance(stream, NodeStream) and id(stream.node) not in live_nodes:
+                live_nodes.add(id(stream.node))
+                stack.extend(resolve(s) for s in stream.node.inputs)
+        for node in self.nodes:
+            if id(node) in live_nodes:
+                for stream in node.inputs:
+                    stream = resolve(stream)
+                    if isinstance(stream, NodeStream):
+                        consumers[id(stream.node)] = consumers.get(id(stream.node), 0) + 1
+        mapped_nodes = {id(s.node) for s in mapped if isinstance(s, NodeStream)}
+
+        used_inputs = {id(resolve(s).input) for node in self.nodes if id(node) in live_nodes for s in node.inputs
+                       if isinstance(resolve(s), InputStream)}
+        used_inputs |= {id(s.input) for s in mapped if isinstance(s, InputStream)}
+        inputs = [i for i in self.inputs if id(i) in used_inputs]
+        input_index = {id(i): n for n, i in enumerate(inputs)}
+
+        # 3. Catene: un nodo lineare si accoda al produttore se è il suo unico consumatore
+        chains: List[dict] = []
+        chain_of: Dict[int, dict] = {}
+        for node in self.nodes:
+            if id(node) not in live_nodes:
+                continue
+            sources = [resolve(s) for s in node.inputs]
+            producer = sources[0].node if len(sources) == 1 and isinstance(sources[0], NodeStream) else None
+            if (producer is not None and len(producer.outputs) == 1 and consumers.get(id(producer)) == 1
+                    and id(producer) not in mapped_nodes):
+                chain = chain_of[id(producer)]
+                chain["filters"] = simplify(chain["filters"] + filters[id(node)], keep_first=len(chain["sources"]) > 1)
+                chain["node"] = node
+            else:
+                chain = {"sources": sources, "filters": filters[id(node)], "node": node}
+                chains.append(chain)
+            chain_of[id(node)] = chain
+
+        # 4. Label e rendering
+        labels: Dict[tuple, str] = {}
+        taken: Dict[str, int] = {}
+
+        def label_for(stream: NodeStream) -> str:
+            key = (id(stream.node), stream.index)
+            if key not in labels:
+                base = stream.node.label or "v"
+                if len(stream.node.outputs) > 1:
+                    base = f"{base}{stream.index}"
+                count = taken.get(base, 0)
+                taken[base] = count + 1
+                labels[key] = base if count == 0 else f"{base}_{count}"
+            return labels[key]
+
+        def ref(stream: Stream) -> str:
+            stream = resolve(stream)
+            if isinstance(stream, InputStream):
+                return f"[{input_index[id(stream.input)]}:{stream.spec}]"
+            return f"[{label_for(stream)}]"
+
+        def map_spec(stream: Stream) -> str:
+            stream = resolve(stream)
+            if isinstance(stream, InputStream):
+                # Come un pad di filtro: il primo stream video, non tutti
+                spec = f"{stream.spec}:0" if stream.spec == "v" else stream.spec
+                return f"{input_index[id(stream.input)]}:{spec}"
+            return ref(stream)
+
+        graph = []
+        for chain in chains:
+            tail = chain["node"]
+            graph.append(
+                "".join(ref(s) for s in chain["sources"])
+                + ",".join(f.render() for f in chain["filters"] or [Filter("null")])
+                + "".join(f"[{label_for(s)}]" for s in tail.outputs)
+            )
+
+        cmd = [ffmpeg] + self.global_args
+        for input_ in inputs:
+            cmd.extend(input_.options)
+            cmd.extend(["-i", str(input_.path)])
+        if graph:
+            cmd.extend(["-filter_complex", ";".join(graph)])
+        for output in self.outputs:
+            cmd.extend(arg if isinstance(arg, str) else map_spec(arg) for arg in output.args)
+            cmd.append(str(output.path))
+        return cmd
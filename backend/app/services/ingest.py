@@ -0,0 +1,39 @@
+"""
+Pipeline di ingest dei video sorgente (download e upload).
+
+Ogni nuovo file in temp/ passa da qui: probe dei metadati e generazione del
+proxy di anteprima partono in background, senza rallentare la risposta.
+"""
+from pathlib import Path
+from typing import List
+
+from app.services.download_cache import download_cache
+from app.services.media_index import media_index
+from app.services.proxies import proxy_manager
+from app.services.storage import storage
+
+
+def on_video_ingested(video_id: str, source_path: Path):
+    """Avvia le elaborazioni in background per un video appena arrivato"""
+    storage.register(source_path, owner=video_id)
+    # Probe una volta sola all'ingest (durata, fps, keyframe...)
+    media_index.schedule(video_id, source_path)
+    # Proxy a bassa risoluzione + poster per l'editor
+    proxy_manager.schedule(video_id, source_path)
+
+
+def forget_video(video_id: str):
+    """Stato in memoria di un video i cui file non ci sono più"""
+    media_index.remove(video_id)
+    download_cache.forget_video(video_id)
+
+
+def on_video_removed(video_id: str) -> List[Path]:
+    """Elimina sorgente e derivati di un video (proxy, poster, probe, filmstrip, render)"""
+    deleted = storage.remove_owner(video_id)
+    forget_video(video_id)
+    return deleted
+
+
+# Sorgente eliminato per quota/TTL: il video non è più utilizzabile
+storage.on_owner_evicted(forget_video)
@@ -0,0 +1,234 @@
+"""
+Coda di job asincroni con pool di worker limitato.
+
+I job vengono inseriti in una coda a priorità e presi da un numero fisso di
+worker: così un burst di richieste non fa partire N encode in parallelo.
+"""
+import asyncio
+import itertools
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+FINAL_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+
+class QueueFullError(Exception):
+    """La coda ha raggiunto la dimensione massima"""
+
+
+class Job:
+    """Singolo job in coda (es. un render)"""
+
+    def __init__(self, kind: str, runner: Callable[["Job"], Awaitable[Any]], priority: int = 0, payload: Any = None):
+        self.id = str(uuid.uuid4())[:8]
+        self.kind = kind
+        self.runner = runner
+        self.priority = priority
+        self.payload = payload
+        self.status = JOB_QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Processo FFmpeg attivo, usato per la cancellazione
+        self.process = None
+        # Ultimo avanzamento riportato da FFmpeg (frame, fps, speed, percent...)
+        self.progress: Optional[Dict[str, Any]] = None
+        # Tempi per fase del render (dal Trace), disponibili a fine job
+        self.timings: Optional[Dict[str, Any]] = None
+        self.cancel_requested = False
+        # Token dei client che attendono il job (richieste identiche condividono lo stesso job)
+        self.waiters: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINAL_STATES
+
+    def finish(self, status: str, result: Any = None, error: Optional[str] = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+
+    def attach(self) -> str:
+        """Aggiunge un client al job; il token serve per staccarlo (una volta sola)"""
+        token = uuid.uuid4().hex
+        self.waiters.add(token)
+        return token
+
+    def detach(self, token: str) -> bool:
+        """Stacca un client. Ritorna True se non resta nessun client in attesa."""
+        self.waiters.discard(token)
+        return not self.waiters
+
+    async def wait(self):
+        """Attende la fine del job (qualsiasi esito)"""
+        await self._done.wait()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "priority": self.priority,
+            "error": self.error,
+            "progress": self.progress,
+            "timings": self.timings,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Coda a priorità (valore più basso = più urgente) servita da N worker"""
+
+    def __init__(self, name: str, workers: int = 1, max_queued: int = 100, history_ttl: float = 3600):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.history_ttl = history_ttl
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._counter = itertools.count()
+
+    async def start(self):
+        """Avvia i worker (da chiamare allo startup dell'app)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+        print(f"[Jobs] Coda '{self.name}' avviata con {self.workers} worker")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.status == JOB_QUEUED)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.status == JOB_RUNNING)
+
+    def submit(self, kind: str, runner: Callable[[Job], Awaitable[Any]], priority: int = 0, payload: Any = None) -> Job:
+        """Mette in coda un job e ritorna subito"""
+        if self._queue is None:
+            raise RuntimeError(f"Coda '{self.name}' non avviata")
+        self._prune()
+        if self.queued >= self.max_queued:
+            raise QueueFullError(f"Coda '{self.name}' piena ({self.max_queued} job in attesa)")
+
+        job = Job(kind, runner, priority=priority, payload=payload)
+        self.jobs[job.id] = job
+        self._queue.put_nowait((priority, next(self._counter), job))
+        return job
+
+    def add_completed(self, kind: str, result: Any, payload: Any = None) -> Job:
+        """Registra un job già completato (es. risultato servito dalla cache)"""
+        self._prune()
+
+        async def _noop(job: Job):
+            return result
+
+        job = Job(kind, _noop, payload=payload)
+        job.started_at = job.created_at
+        job.finish(JOB_DONE, result=result)
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str, token: Optional[str] = None) -> bool:
+        """
+        Annulla un job in coda o in esecuzione. Ritorna False se già terminato.
+        token: client che rinuncia a un job condiviso; il job viene interrotto
+        solo quando si stacca l'ultimo client.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+
+        if token is not None and not job.detach(token):
+            # Altri client attendono lo stesso job: si stacca solo questo
+            return True
+
+        job.cancel_requested = True
+        if job.status == JOB_QUEUED:
+            # Il worker lo scarterà quando lo estrae dalla coda
+            job.finish(JOB_CANCELLED)
+            return True
+
+        if job.process is not None and job.process.poll() is None:
+            job.process.kill()
+        if job._task is not None:
+            job._task.cancel()
+        return True
+
+    def position(self, job: Job) -> Optional[int]:
+        """Posizione del job in coda (0 = il prossimo ad essere eseguito)"""
+        if job.status != JOB_QUEUED:
+            return None
+        ahead = [
+            j for j in self.jobs.values()
+            if j.status == JOB_QUEUED and (j.priority, j.created_at) < (job.priority, job.created_at)
+        ]
+        return len(ahead)
+
+    def _prune(self):
+        """Rimuove dallo storico i job terminati da più di history_ttl secondi"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished and job.finished_at and now - job.finished_at > self.history_ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def _worker(self, worker_idx: int):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.finished:
+                    continue
+                job.status = JOB_RUNNING
+                job.started_at = time.time()
+                job._task = asyncio.create_task(job.runner(job))
+                try:
+                    result = await job._task
+                    job.finish(JOB_DONE, result=result)
+                except asyncio.CancelledError:
+                    if not job.cancel_requested:
+                        # È il worker stesso ad essere stato cancellato (shutdown)
+                        job.finish(JOB_CANCELLED, error="Server in arresto")
+                        raise
+                    job.finish(JOB_CANCELLED)
+                except Exception as e:
+                    if job.cancel_requested:
+                        job.finish(JOB_CANCELLED)
+                    else:
+                        # HTTPException espone il messaggio in .detail
+                        error = getattr(e, "detail", None) or str(e)
+                        print(f"[Jobs] Job {job.id} fallito: {error}")
+                        job.finish(JOB_FAILED, error=str(error))
+            finally:
+                job.process = None
+                job._task = None
+                self._queue.task_done()
@@ -0,0 +1,215 @@
+"""
+Rilevamento automatico del colore di key degli overlay (green screen).
+
+Alcuni frame dell'overlay vengono campionati con FFmpeg (rawvideo RGB su
+pipe, niente moviepy) in array NumPy. L'istogramma dei pixel del bordo dà il
+colore dello sfondo; le distanze in UV, calcolate come fa il filtro
+chromakey, danno similarity e blend. Il risultato è salvato per contenuto
+dell'asset in temp/keys/, quindi ogni overlay viene analizzato una volta sola.
+"""
+import asyncio
+import json
+import os
+import subprocess
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+from app.services.ffmpeg import FFMPEG_PATH
+from app.services.media_index import probe_media
+from app.services.render_cache import file_hash
+from app.services.storage import storage
+
+KEY_DETECT_ENABLED = os.environ.get("KEY_DETECT_ENABLED", "true").lower() == "true"
+# Frame campionati per overlay e lato (px) a cui vengono ridotti
+KEY_DETECT_FRAMES = int(os.environ.get("KEY_DETECT_FRAMES", "8"))
+KEY_DETECT_SIZE = int(os.environ.get("KEY_DETECT_SIZE", "128"))
+
+KEYS_DIR = Path("temp") / "keys"
+
+# Incrementare se cambia l'algoritmo (invalida sidecar e render in cache)
+KEY_DETECT_VERSION = 1
+
+# Spessore del bordo analizzato (frazione del lato corto)
+BORDER_FRACTION = 0.08
+# Distanza UV massima dal picco per considerare un pixel "sfondo"
+CLUSTER_RADIUS = 0.12
+# Sotto questa copertura del bordo, o con un colore poco saturo, il rilevamento non è affidabile
+MIN_COVERAGE = 0.5
+MIN_CHROMA = 0.08
+
+SIMILARITY_RANGE = (0.02, 0.4)
+BLEND_RANGE = (0.02, 0.2)
+
+
+def rgb_to_uv(rgb: np.ndarray):
+    """Crominanza BT.601 (range limitato), come la conversione del colore di chromakey"""
+    rgb = rgb.astype(np.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    u = 128 + (-37.797 * r - 74.203 * g + 112.0 * b) / 255
+    v = 128 + (112.0 * r - 93.786 * g - 18.214 * b) / 255
+    return u, v
+
+
+def uv_distance(u: np.ndarray, v: np.ndarray, key_u: float, key_v: float) -> np.ndarray:
+    """Distanza normalizzata usata da chromakey per similarity/blend"""
+    return np.sqrt(((u - key_u) ** 2 + (v - key_v) ** 2) / (255.0 * 255.0 * 2))
+
+
+def sample_frames(path: Path, frames: int = KEY_DETECT_FRAMES, size: int = KEY_DETECT_SIZE) -> np.ndarray:
+    """N frame equidistanti dell'overlay come array (N, size, size, 3) uint8 (bloccante)"""
+    try:
+        duration = probe_media(path).get("duration")
+    except Exception:
+        duration = None
+    fps = f"{frames}/{duration:.6f}" if duration else "1"
+    cmd = [
+        FFMPEG_PATH, "-v", "error", "-i", str(path), "-an",
+        "-vf", f"fps={fps},scale={size}:{size}",
+        "-frames:v", str(frames),
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1",
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise Exception(f"FFmpeg error: {result.stderr.decode(errors='replace')[-2000:]}")
+    frame_bytes = size * size * 3
+    count = len(result.stdout) // frame_bytes
+    if count == 0:
+        raise Exception("Nessun frame estratto")
+    data = np.frombuffer(result.stdout[:count * frame_bytes], dtype=np.uint8)
+    return data.reshape(count, size, size, 3)
+
+
+def analyze(frames: np.ndarray) -> dict:
+    """Colore di key, similarity e blend dai frame (N, H, W, 3)"""
+    _, height, width, _ = frames.shape
+    band = max(1, int(round(min(height, width) * BORDER_FRACTION)))
+    mask = np.zeros((height, width), dtype=bool)
+    mask[:band, :] = mask[-band:, :] = True
+    mask[:, :band] = mask[:, -band:] = True
+    border = frames[:, mask].reshape(-1, 3)
+
+    # Istogramma 32x32x32 del bordo: il picco è il colore dello sfondo
+    quantized = (border >> 3).astype(np.int32)
+    bins = (quantized[:, 0] << 10) | (quantized[:, 1] << 5) | quantized[:, 2]
+    peak = np.bincount(bins, minlength=1 << 15).argmax()
+    key_rgb = np.median(border[bins == peak], axis=0)
+
+    key_u, key_v = rgb_to_uv(key_rgb)
+    border_u, border_v = rgb_to_uv(border)
+    border_dist = uv_distance(border_u, border_v, key_u, key_v)
+    background = border_dist[border_dist < CLUSTER_RADIUS]
+    coverage = background.size / border_dist.size
+
+    # Raffina il colore sulla media dello sfondo (il picco è quantizzato)
+    if background.size:
+        key_rgb = border[border_dist < CLUSTER_RADIUS].mean(axis=0)
+        key_u, key_v = rgb_to_uv(key_rgb)
+        background = uv_distance(border_u, border_v, key_u, key_v)
+        background = background[background < CLUSTER_RADIUS]
+
+    # Margine sul 99° percentile per il rumore di compressione dei frame non campionati
+    similarity = float(np.percentile(background, 99)) + 0.03 if background.size else SIMILARITY_RANGE[1]
+    similarity = float(np.clip(similarity, *SIMILARITY_RANGE))
+
+    # Blend: metà dello spazio tra lo sfondo e i pixel del soggetto più vicini al key
+    all_u, all_v = rgb_to_uv(frames[:, ::2, ::2])
+    foreground = uv_distance(all_u, all_v, key_u, key_v)
+    foreground = foreground[foreground >= CLUSTER_RADIUS]
+    gap = float(np.percentile(foreground, 1)) - similarity if foreground.size else 0.2
+    blend = float(np.clip(gap * 0.5, *BLEND_RANGE))
+
+    chroma = float(uv_distance(np.float32(key_u), np.float32(key_v), 128.0, 128.0))
+    r, g, b = (int(round(c)) for c in key_rgb)
+    return {
+        "version": KEY_DETECT_VERSION,
+        "color": f"0x{r:02X}{g:02X}{b:02X}",
+        "similarity": round(similarity, 3),
+        "blend": round(blend, 3),
+        "coverage": round(coverage, 3),
+        "chroma": round(chroma, 3),
+        "reliable": coverage >= MIN_COVERAGE and chroma >= MIN_CHROMA,
+        "frames": int(frames.shape[0]),
+    }
+
+
+class KeyDetector:
+    """Parametri di key per overlay: memoria, poi sidecar temp/keys/<hash>.json, poi analisi"""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self._entries: Dict[str, dict] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def _memo_key(self, path: Path) -> str:
+        stat = path.stat()
+        return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def sidecar_path(self, path: Path) -> Path:
+        return self.cache_dir / f"{file_hash(path)[:16]}.json"
+
+    def load(self, path: Path) -> dict:
+        """Risultato dal sidecar o da una nuova analisi (bloccante)"""
+        sidecar = self.sidecar_path(path)
+        try:
+            result = json.loads(sidecar.read_text())
+            if result.get("version") == KEY_DETECT_VERSION:
+                storage.touch(sidecar)
+                return result
+        except (OSError, ValueError):
+            pass
+
+        result = analyze(sample_frames(path))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = sidecar.with_suffix(".tmp")
+        tmp.write_text(json.dumps(result))
+        os.replace(tmp, sidecar)
+        storage.register(sidecar)
+        print(f"[KeyDetect] {path.name}: key {result['color']} similarity {result['similarity']} "
+              f"blend {result['blend']} (copertura {result['coverage']:.0%})")
+        return result
+
+    async def get(self, path: Path, executor=None) -> dict:
+        """Analisi dell'overlay (una sola per contenuto, richieste concorrenti condivise)"""
+        memo_key = self._memo_key(path)
+        entry = self._entries.get(memo_key)
+        if entry is not None:
+            return entry
+
+        pending = self._pending.get(memo_key)
+        if pending is None:
+            loop = asyncio.get_event_loop()
+            pending = asyncio.ensure_future(loop.run_in_executor(executor, self.load, path))
+            self._pending[memo_key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(memo_key, None))
+        entry = await asyncio.shield(pending)
+        self._entries[memo_key] = entry
+        return entry
+
+    def lookup(self, path: Path) -> Optional[dict]:
+        """Parametri già calcolati (solo memoria) se affidabili, altrimenti None"""
+        try:
+            entry = self._entries.get(self._memo_key(path))
+        except OSError:
+            return None
+        return key_params(entry)
+
+    async def params(self, path: Path, executor=None) -> Optional[dict]:
+        """Parametri per chromakey, o None (disattivato, analisi fallita o non affidabile)"""
+        if not KEY_DETECT_ENABLED:
+            return None
+        try:
+            return key_params(await self.get(path, executor))
+        except Exception as e:
+            print(f"[KeyDetect] Analisi fallita per {path.name}: {e}")
+            return None
+
+
+def key_params(result: Optional[dict]) -> Optional[dict]:
+    if not result or not result.get("reliable"):
+        return None
+    return {"color": result["color"], "similarity": result["similarity"], "blend": result["blend"]}
+
+
+key_detector = KeyDetector(KEYS_DIR)
@@ -0,0 +1,202 @@
+"""
+Indice dei metadati dei video sorgente.
+
+Il probe (ffprobe) viene fatto una volta sola all'ingest (download/upload) e
+salvato come sidecar JSON in temp/probe/<video_id>.json. Remix, validazione
+del trim e smart cut leggono i metadati dal dizionario in memoria senza
+lanciare processi; se il sidecar manca viene ricostruito al primo accesso.
+"""
+import asyncio
+import json
+import os
+import subprocess
+from fractions import Fraction
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.services.ffmpeg import FFPROBE_PATH
+from app.services.storage import storage
+
+PROBE_DIR = Path("temp") / "probe"
+
+# Incrementare se cambia il formato del sidecar
+INDEX_VERSION = 1
+
+# Dimensioni di default se il probe fallisce (9:16 portrait)
+DEFAULT_WIDTH = 1080
+DEFAULT_HEIGHT = 1920
+
+
+def _parse_rate(rate: Optional[str]) -> Optional[float]:
+    try:
+        value = Fraction(rate or "0/1")
+        return float(value) if value else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def _rotation(stream: dict) -> int:
+    """Rotazione del video in gradi (tag rotate o display matrix)"""
+    for side_data in stream.get("side_data_list") or []:
+        if "rotation" in side_data:
+            return int(float(side_data["rotation"])) % 360
+    rotate = (stream.get("tags") or {}).get("rotate")
+    return int(rotate) % 360 if rotate else 0
+
+
+def probe_keyframes(path: Path) -> List[float]:
+    """Timestamp (secondi) dei keyframe del primo stream video (solo demux, niente decode)"""
+    result = subprocess.run(
+        [FFPROBE_PATH, "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", str(path)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return []
+    keyframes = []
+    for line in result.stdout.splitlines():
+        parts = line.strip().split(",")
+        if len(parts) >= 2 and "K" in parts[1] and parts[0] not in ("", "N/A"):
+            keyframes.append(round(float(parts[0]), 6))
+    return sorted(keyframes)
+
+
+def probe_media(path: Path) -> dict:
+    """Esegue ffprobe e ritorna i metadati normalizzati del file"""
+    result = subprocess.run(
+        [FFPROBE_PATH, "-v", "error", "-show_streams", "-show_format", "-of", "json", str(path)],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"ffprobe error: {result.stderr.strip()}")
+
+    data = json.loads(result.stdout or "{}")
+    streams = data.get("streams") or []
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    fmt = data.get("format") or {}
+
+    info = {
+        "duration": float(fmt.get("duration") or 0) or None,
+        "size": int(fmt.get("size") or 0) or path.stat().st_size,
+        "format": fmt.get("format_name"),
+        "has_video": video is not None,
+        "has_audio": audio is not None,
+        "audio_codec": audio.get("codec_name") if audio else None,
+        "keyframes": [],
+    }
+    if video:
+        rotation = _rotation(video)
+        width, height = int(video.get("width") or 0), int(video.get("height") or 0)
+        # Dimensioni di visualizzazione: i video ruotati di 90° hanno w/h invertiti
+        if rotation in (90, 270):
+            width, height = height, width
+        info.update({
+            "width": width or None,
+            "height": height or None,
+            "coded_width": video.get("width"),
+            "coded_height": video.get("height"),
+            "rotation": rotation,
+            "video_codec": video.get("codec_name"),
+            "pix_fmt": video.get("pix_fmt"),
+            "fps": _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate")),
+            "r_frame_rate": video.get("r_frame_rate"),
+            "avg_frame_rate": video.get("avg_frame_rate"),
+            "start_time": float(video["start_time"]) if video.get("start_time") not in (None, "N/A") else None,
+        })
+        info["keyframes"] = probe_keyframes(path)
+    return info
+
+
+class MediaIndex:
+    """Cache in memoria + sidecar su disco dei metadati per video_id"""
+
+    def __init__(self, probe_dir: Path):
+        self.probe_dir = probe_dir
+        self._entries: Dict[str, dict] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def sidecar_path(self, video_id: str) -> Path:
+        return self.probe_dir / f"{video_id}.json"
+
+    def _is_fresh(self, entry: dict, path: Path) -> bool:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        return (
+            entry.get("version") == INDEX_VERSION
+            and entry.get("source") == path.name
+            and entry.get("source_size") == stat.st_size
+            and entry.get("source_mtime") == stat.st_mtime_ns
+        )
+
+    def lookup(self, video_id: str) -> Optional[dict]:
+        """Metadati già indicizzati (solo memoria, O(1)), o None"""
+        return self._entries.get(video_id)
+
+    def build(self, video_id: str, path: Path) -> dict:
+        """Probe + scrittura del sidecar (bloccante)"""
+        entry = probe_media(path)
+        stat = path.stat()
+        entry.update({
+            "version": INDEX_VERSION,
+            "video_id": video_id,
+            "source": path.name,
+            "source_size": stat.st_size,
+            "source_mtime": stat.st_mtime_ns,
+        })
+        self.probe_dir.mkdir(parents=True, exist_ok=True)
+        sidecar = self.sidecar_path(video_id)
+        tmp = sidecar.with_suffix(".tmp")
+        tmp.write_text(json.dumps(entry))
+        os.replace(tmp, sidecar)
+        storage.register(sidecar)
+        return entry
+
+    def load(self, video_id: str, path: Path) -> dict:
+        """Legge il sidecar se valido, altrimenti lo ricostruisce (bloccante)"""
+        sidecar = self.sidecar_path(video_id)
+        if sidecar.exists():
+            try:
+                entry = json.loads(sidecar.read_text())
+                if self._is_fresh(entry, path):
+                    return entry
+            except (OSError, ValueError):
+                pass
+        return self.build(video_id, path)
+
+    async def get(self, video_id: str, path: Path, executor=None) -> dict:
+        """
+        Metadati del video: memoria, poi sidecar, poi ffprobe.
+        Richieste concorrenti per lo stesso video condividono un solo probe.
+        """
+        entry = self._entries.get(video_id)
+        if entry is not None and entry.get("source") == path.name:
+            return entry
+
+        pending = self._pending.get(video_id)
+        if pending is None:
+            loop = asyncio.get_event_loop()
+            pending = asyncio.ensure_future(loop.run_in_executor(executor, self.load, video_id, path))
+            self._pending[video_id] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(video_id, None))
+        entry = await asyncio.shield(pending)
+        self._entries[video_id] = entry
+        return entry
+
+    def schedule(self, video_id: str, path: Path):
+        """Avvia l'indicizzazione in background (ingest) senza attenderla"""
+        async def _index():
+            try:
+                await self.get(video_id, path)
+            except Exception as e:
+                print(f"[MediaIndex] Probe fallito per {video_id}: {e}")
+        asyncio.ensure_future(_index())
+
+    def remove(self, video_id: str):
+        self._entries.pop(video_id, None)
+        self.sidecar_path(video_id).unlink(missing_ok=True)
+
+
+media_index = MediaIndex(PROBE_DIR)
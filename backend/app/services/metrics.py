@@ -0,0 +1,261 @@
+"""
+Metriche in formato Prometheus e tempi per fase delle richieste.
+
+Registro minimale (counter, histogram e gauge calcolati allo scrape) senza
+dipendenze esterne: /metrics in app/main.py rende il testo in formato
+exposition 0.0.4. Trace misura le fasi di una singola richiesta (risoluzione
+asset, probe, filtergraph, FFmpeg...) e le registra negli istogrammi.
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Secondi di validità del calcolo dell'uso disco (os.walk è costoso su cartelle grandi)
+METRICS_DISK_TTL = float(os.environ.get("METRICS_DISK_TTL", "30"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = (1e5, 5e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8)
+SPEED_BUCKETS = (0.1, 0.25, 0.5, 1, 1.5, 2, 3, 5, 10, 20)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_format(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [conteggi per bucket..., somma, conteggio]
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = self.header()
+        for key, state in items:
+            for i, bound in enumerate(self.buckets):
+                le = f'le="{_format(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {state[i]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format(state[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge calcolato allo scrape: fn ritorna un valore o {valori label: valore}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"[Metrics] Gauge {self.name} non disponibile: {e}")
+            return []
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        lines = self.header()
+        for key, v in items:
+            if v is None:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_format(v)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, fn: Callable, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, fn, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "remix_stage_seconds", "Durata delle fasi di una richiesta", ["pipeline", "stage"])
+requests_total = registry.counter(
+    "remix_requests_total", "Richieste completate per pipeline ed esito", ["pipeline", "result"])
+ffmpeg_wall_seconds = registry.histogram(
+    "ffmpeg_wall_seconds", "Tempo reale dei processi FFmpeg", ["pipeline"])
+ffmpeg_cpu_seconds = registry.counter(
+    "ffmpeg_cpu_seconds_total", "Tempo CPU dei processi FFmpeg", ["pipeline", "mode"])
+ffmpeg_peak_rss = registry.histogram(
+    "ffmpeg_peak_rss_bytes", "Memoria residente di picco dei processi FFmpeg", ["pipeline"],
+    buckets=(3.2e7, 6.4e7, 1.28e8, 2.56e8, 5.12e8, 1.024e9, 2.048e9, 4.096e9))
+ffmpeg_speed = registry.histogram(
+    "ffmpeg_encode_speed_ratio", "Velocità di encode (secondi di media per secondo reale)", ["pipeline"],
+    buckets=SPEED_BUCKETS)
+output_bytes = registry.histogram(
+    "remix_output_bytes", "Dimensione dei file prodotti", ["pipeline"], buckets=SIZE_BUCKETS)
+storage_evictions = registry.counter(
+    "storage_evictions_total", "File eliminati dal gestore dello spazio su disco", ["dir", "kind"])
+
+
+class Trace:
+    """Tempi per fase di una richiesta, registrati negli istogrammi a ogni fase"""
+
+    def __init__(self, pipeline: str, request_id: Optional[str] = None):
+        self.pipeline = pipeline
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.info: Dict[str, object] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name: str, seconds: float):
+        # Una fase ripetuta (es. più comandi FFmpeg) si somma
+        self.stages[name] = round(self.stages.get(name, 0) + seconds, 4)
+        stage_seconds.observe(seconds, pipeline=self.pipeline, stage=name)
+
+    def record_ffmpeg(self, usage: dict, progress: Optional[dict] = None):
+        """Tempo reale/user/sys, RSS di picco e velocità di un processo FFmpeg"""
+        if "wall" in usage:
+            ffmpeg_wall_seconds.observe(usage["wall"], pipeline=self.pipeline)
+        for mode in ("user", "sys"):
+            if usage.get(mode) is not None:
+                ffmpeg_cpu_seconds.inc(usage[mode], pipeline=self.pipeline, mode=mode)
+                self.info[f"ffmpeg_{mode}"] = round(self.info.get(f"ffmpeg_{mode}", 0) + usage[mode], 3)
+        if usage.get("max_rss"):
+            ffmpeg_peak_rss.observe(usage["max_rss"], pipeline=self.pipeline)
+            self.info["ffmpeg_peak_rss"] = max(self.info.get("ffmpeg_peak_rss", 0), usage["max_rss"])
+        if progress and progress.get("speed"):
+            ffmpeg_speed.observe(progress["speed"], pipeline=self.pipeline)
+            self.info["encode_speed"] = progress["speed"]
+
+    def record_output(self, path: Path):
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        output_bytes.observe(size, pipeline=self.pipeline)
+        self.info["output_bytes"] = self.info.get("output_bytes", 0) + size
+
+    def finish(self, result: str = "ok") -> dict:
+        total = time.perf_counter() - self.started
+        requests_total.inc(pipeline=self.pipeline, result=result)
+        stage_seconds.observe(total, pipeline=self.pipeline, stage="total")
+        summary = self.to_dict()
+        summary["result"] = result
+        summary["total"] = round(total, 4)
+        print(f"[Trace] {json.dumps(summary)}")
+        return summary
+
+    def to_dict(self) -> dict:
+        return {"pipeline": self.pipeline, "id": self.request_id, "stages": dict(self.stages), **self.info}
+
+
+_disk_cache: Dict[str, object] = {"at": 0.0, "value": {}}
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def disk_usage(dirs: Dict[str, Path]) -> Dict[str, int]:
+    """Byte occupati per cartella, ricalcolati al massimo ogni METRICS_DISK_TTL secondi"""
+    now = time.monotonic()
+    if now - _disk_cache["at"] > METRICS_DISK_TTL:
+        _disk_cache["value"] = {name: dir_size(path) for name, path in dirs.items()}
+        _disk_cache["at"] = now
+    return _disk_cache["value"]
@@ -0,0 +1,184 @@
+"""
+Cache degli overlay preparati (chiave colore + alpha + scala).
+
+Ogni overlay viene keyato, convertito in RGBA e scalato una sola volta per
+(file, modalità di key, larghezza): il remix deve solo decodificare il file
+preparato e fare l'overlay. I video (GIF compresi) diventano MOV qtrle/argb,
+che ha l'alpha e si decodifica molto più velocemente di GIF o VP9.
+"""
+import asyncio
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from app.services.asset_catalog import asset_catalog, KIND_OVERLAYS
+from app.services.ffmpeg import FFMPEG_PATH, run_ffmpeg_sync
+from app.services.filtergraph import Filter, optimize_filters
+from app.services.key_detect import key_detector
+from app.services.render_cache import file_hash
+from app.services.storage import storage
+
+OVERLAY_CACHE_ENABLED = os.environ.get("OVERLAY_CACHE_ENABLED", "true").lower() == "true"
+# Larghezze preparate all'upload (warm-up): 0.25 * 1080 è lo scale di default
+OVERLAY_WARMUP_WIDTHS = [
+    int(w) for w in os.environ.get("OVERLAY_WARMUP_WIDTHS", "270").split(",") if w.strip()
+]
+
+OVERLAY_CACHE_DIR = Path("temp") / "overlay_cache"
+
+KEY_GREEN = "green"
+KEY_BLACK = "black"
+KEY_ALPHA = "alpha"
+KEY_NONE = "none"
+
+IMAGE_EXTENSIONS = ['.png']
+NATIVE_ALPHA_EXTENSIONS = ['.webm', '.mov', '.png', '.gif']
+
+
+def key_filter(mode: str, key: Optional[dict] = None) -> Optional[str]:
+    """
+    Filtro FFmpeg che rende trasparente lo sfondo per la modalità data.
+    key: colore/similarity/blend rilevati sull'overlay (solo green screen).
+    """
+    if mode == KEY_GREEN:
+        if key:
+            return f"chromakey={key['color']}:{key['similarity']}:{key['blend']},format=rgba"
+        return "chromakey=0x00FF00:0.3:0.1,format=rgba"
+    if mode == KEY_BLACK:
+        return "colorkey=0x000000:0.3:0.2,format=rgba"
+    if mode == KEY_ALPHA:
+        return "format=rgba"
+    return None
+
+
+def overlay_source_width(overlay_path: Path) -> Optional[int]:
+    """Larghezza dell'overlay dal probe nel catalogo (None se non ancora disponibile)"""
+    entry = asset_catalog.lookup(KIND_OVERLAYS, overlay_path.name)
+    return ((entry or {}).get("probe") or {}).get("width")
+
+
+def key_mode(overlay_path: Path, remove_green_screen: bool, remove_black_screen: bool) -> str:
+    """Modalità di key per un overlay (stessa priorità del remix)"""
+    if remove_green_screen:
+        return KEY_GREEN
+    if remove_black_screen:
+        return KEY_BLACK
+    if overlay_path.suffix.lower() in NATIVE_ALPHA_EXTENSIONS:
+        return KEY_ALPHA
+    return KEY_NONE
+
+
+def _safe_stem(overlay_path: Path) -> str:
+    return re.sub(r"[^A-Za-z0-9_-]", "_", overlay_path.stem)[:40]
+
+
+def _mode_tag(mode: str, key: Optional[dict]) -> str:
+    """Modalità nel nome dell'intermedio, con i parametri rilevati se presenti"""
+    if not key:
+        return mode
+    return f"{mode}-{key['color'][2:].lower()}-{int(key['similarity'] * 1000)}-{int(key['blend'] * 1000)}"
+
+
+class OverlayCache:
+    """Intermedi degli overlay su disco, costruiti al primo utilizzo"""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self._building: Dict[str, asyncio.Future] = {}
+
+    def entry_path(self, overlay_path: Path, mode: str, width: int, key: Optional[dict] = None) -> Path:
+        # L'hash del contenuto nel nome invalida la entry se l'asset cambia
+        content = file_hash(overlay_path)[:12]
+        is_image = overlay_path.suffix.lower() in IMAGE_EXTENSIONS
+        ext = ".png" if is_image else ".mov"
+        return self.cache_dir / f"{_safe_stem(overlay_path)}__{content}__{_mode_tag(mode, key)}__{width}{ext}"
+
+    def build_command(self, overlay_path: Path, mode: str, width: int, output_path: Path,
+                      key: Optional[dict] = None):
+        # Scala prima del key quando riduce l'overlay (key su meno pixel)
+        filters = optimize_filters(
+            Filter.parse_chain(key_filter(mode, key)) + [Filter("scale", width, -1, flags="lanczos")],
+            overlay_source_width(overlay_path)
+        )
+
+        cmd = [FFMPEG_PATH, "-y", "-i", str(overlay_path), "-vf", ",".join(f.render() for f in filters), "-an"]
+        if output_path.suffix == ".png":
+            cmd.extend(["-frames:v", "1"])
+        else:
+            # qtrle/argb: alpha lossless e decodifica leggera
+            cmd.extend(["-c:v", "qtrle", "-pix_fmt", "argb"])
+        cmd.append(str(output_path))
+        return cmd
+
+    def build(self, overlay_path: Path, mode: str, width: int, key: Optional[dict] = None) -> Path:
+        """Prepara l'intermedio (bloccante). Ritorna il path in cache."""
+        output_path = self.entry_path(overlay_path, mode, width, key)
+        if output_path.exists():
+            return output_path
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Scrivi su file temporaneo e rinomina: mai un intermedio a metà in cache
+        part_path = output_path.with_name(f"part_{output_path.name}")
+        try:
+            run_ffmpeg_sync(self.build_command(overlay_path, mode, width, part_path, key))
+            os.replace(part_path, output_path)
+            storage.register(output_path)
+        finally:
+            part_path.unlink(missing_ok=True)
+        return output_path
+
+    async def ensure(self, overlay_path: Path, mode: str, width: int, executor=None,
+                     key: Optional[dict] = None) -> Optional[Path]:
+        """
+        Ritorna l'intermedio preparato, costruendolo se manca.
+        Build concorrenti dello stesso intermedio vengono unificate.
+        Ritorna None se la preparazione fallisce (il remix userà i filtri inline).
+        """
+        if not OVERLAY_CACHE_ENABLED:
+            return None
+        loop = asyncio.get_event_loop()
+        try:
+            output_path = await loop.run_in_executor(executor, self.entry_path, overlay_path, mode, width, key)
+        except OSError:
+            return None
+        if output_path.exists():
+            storage.touch(output_path)
+            return output_path
+
+        build_key = output_path.name
+        pending = self._building.get(build_key)
+        if pending is None:
+            pending = asyncio.ensure_future(loop.run_in_executor(executor, self.build, overlay_path, mode, width, key))
+            self._building[build_key] = pending
+            pending.add_done_callback(lambda _: self._building.pop(build_key, None))
+        try:
+            return await asyncio.shield(pending)
+        except Exception as e:
+            print(f"[OverlayCache] Preparazione fallita per {overlay_path.name}: {e}")
+            return None
+
+    async def warm_up(self, overlay_path: Path, widths: Iterable[int] = None):
+        """Prepara in anticipo le varianti più usate di un overlay appena caricato"""
+        modes = [KEY_GREEN]
+        native = key_mode(overlay_path, False, False)
+        if native != KEY_NONE:
+            modes.append(native)
+        # Il green screen usa il colore rilevato, come il remix con auto_key (default)
+        green_key = await key_detector.params(overlay_path)
+        for width in widths or OVERLAY_WARMUP_WIDTHS:
+            for mode in modes:
+                await self.ensure(overlay_path, mode, width, key=green_key if mode == KEY_GREEN else None)
+
+    def invalidate(self, overlay_path: Path) -> int:
+        """Elimina tutti gli intermedi di un overlay (upload sovrascritto o delete)"""
+        if not self.cache_dir.exists():
+            return 0
+        removed = 0
+        for entry in self.cache_dir.glob(f"{_safe_stem(overlay_path)}__*"):
+            entry.unlink(missing_ok=True)
+            removed += 1
+        return removed
+
+
+overlay_cache = OverlayCache(OVERLAY_CACHE_DIR)
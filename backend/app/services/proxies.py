@@ -0,0 +1,124 @@
+"""
+Proxy di anteprima a bassa risoluzione e poster frame.
+
+All'ingest di ogni video viene generato in background un MP4 piccolo
+(faststart, bitrate basso) più un JPEG del primo secondo: l'editor li usa
+per lo scrubbing al posto dell'originale ad alta risoluzione.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.services.ffmpeg import FFMPEG_PATH, run_ffmpeg_sync
+from app.services.storage import storage
+
+PROXY_ENABLED = os.environ.get("PROXY_ENABLED", "true").lower() == "true"
+# Proxy generati in parallelo (1 su istanze piccole: non deve rubare CPU ai render)
+PROXY_CONCURRENCY = int(os.environ.get("PROXY_CONCURRENCY", "1"))
+# Lato corto del proxy in pixel
+PROXY_HEIGHT = int(os.environ.get("PROXY_HEIGHT", "540"))
+
+PROXY_DIR = Path("temp") / "proxy"
+
+
+class ProxyManager:
+    """Generazione deduplicata e a concorrenza limitata di proxy e poster"""
+
+    def __init__(self, proxy_dir: Path, concurrency: int):
+        self.proxy_dir = proxy_dir
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="proxy")
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def proxy_path(self, video_id: str) -> Path:
+        return self.proxy_dir / f"{video_id}.mp4"
+
+    def poster_path(self, video_id: str) -> Path:
+        return self.proxy_dir / f"{video_id}.jpg"
+
+    def get_proxy(self, video_id: str) -> Optional[Path]:
+        path = self.proxy_path(video_id)
+        return path if path.exists() else None
+
+    def get_poster(self, video_id: str) -> Optional[Path]:
+        path = self.poster_path(video_id)
+        return path if path.exists() else None
+
+    def _scale_filter(self) -> str:
+        # Riduce il lato corto a PROXY_HEIGHT (mai ingrandire), dimensioni pari per yuv420p
+        return (
+            f"scale='if(gt(iw,ih),-2,min(iw,{PROXY_HEIGHT}))':'if(gt(iw,ih),min(ih,{PROXY_HEIGHT}),-2)'"
+        )
+
+    def build_proxy_command(self, source_path: Path, output_path: Path):
+        return [
+            FFMPEG_PATH, "-y", "-i", str(source_path),
+            "-vf", self._scale_filter(),
+            "-threads", "1",
+            "-c:v", "libx264",
+            "-pix_fmt", "yuv420p",
+            "-preset", "veryfast",
+            "-crf", "30",
+            "-maxrate", "800k",
+            "-bufsize", "800k",
+            # GOP corto: seek rapidi durante lo scrubbing
+            "-g", "30",
+            "-movflags", "+faststart",
+            "-c:a", "aac",
+            "-b:a", "64k",
+            "-f", "mp4",
+            str(output_path),
+        ]
+
+    def build_poster_command(self, source_path: Path, output_path: Path):
+        return [
+            FFMPEG_PATH, "-y", "-ss", "0.5", "-i", str(source_path),
+            "-frames:v", "1", "-vf", self._scale_filter(), "-q:v", "4",
+            "-f", "image2", str(output_path),
+        ]
+
+    def build(self, video_id: str, source_path: Path):
+        """Genera poster e proxy (bloccante). File temporanei rinominati a fine lavoro."""
+        self.proxy_dir.mkdir(parents=True, exist_ok=True)
+        for final_path, build_command in [
+            (self.poster_path(video_id), self.build_poster_command),
+            (self.proxy_path(video_id), self.build_proxy_command),
+        ]:
+            if final_path.exists():
+                continue
+            part_path = final_path.with_name(f"part_{final_path.name}")
+            try:
+                run_ffmpeg_sync(build_command(source_path, part_path))
+                os.replace(part_path, final_path)
+                storage.register(final_path)
+            finally:
+                part_path.unlink(missing_ok=True)
+
+    def schedule(self, video_id: str, source_path: Path) -> Optional[asyncio.Future]:
+        """Avvia (una sola volta per video) la generazione in background"""
+        if not PROXY_ENABLED:
+            return None
+        if video_id in self._pending:
+            return self._pending[video_id]
+        if self.get_proxy(video_id) and self.get_poster(video_id):
+            return None
+
+        loop = asyncio.get_event_loop()
+        future = asyncio.ensure_future(loop.run_in_executor(self._executor, self.build, video_id, source_path))
+        self._pending[video_id] = future
+
+        def _done(fut: asyncio.Future):
+            self._pending.pop(video_id, None)
+            if not fut.cancelled() and fut.exception():
+                print(f"[Proxy] Generazione fallita per {video_id}: {fut.exception()}")
+
+        future.add_done_callback(_done)
+        return future
+
+    def remove(self, video_id: str):
+        for path in (self.proxy_path(video_id), self.poster_path(video_id)):
+            path.unlink(missing_ok=True)
+
+
+proxy_manager = ProxyManager(PROXY_DIR, PROXY_CONCURRENCY)
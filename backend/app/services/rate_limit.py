@@ -0,0 +1,67 @@
+"""
+Limiti di concorrenza globali e per piattaforma (host) con backoff.
+
+Usato dal download massivo: al massimo N download insieme, al massimo M
+per la stessa piattaforma, con un intervallo minimo tra due avvii sullo
+stesso host e una pausa extra quando la piattaforma ci rallenta (429).
+"""
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+
+def host_key(url: str) -> str:
+    """Dominio registrabile dell'URL (vm.tiktok.com e www.tiktok.com -> tiktok.com)"""
+    host = (urlsplit(url).hostname or "").lower()
+    labels = host.split(".")
+    return ".".join(labels[-2:]) if len(labels) >= 2 else host
+
+
+def backoff_delay(attempt: int, base: float = 2.0, cap: float = 60.0) -> float:
+    """Backoff esponenziale con jitter per il tentativo attempt (da 0)"""
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class HostRateLimiter:
+    """Semafori globale e per host + intervallo minimo tra avvii sullo stesso host"""
+
+    def __init__(self, global_limit: int, per_host_limit: int, min_interval: float):
+        self.global_limit = max(1, global_limit)
+        self.per_host_limit = max(1, per_host_limit)
+        self.min_interval = min_interval
+        self._global: Optional[asyncio.Semaphore] = None
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._next_start: Dict[str, float] = {}
+
+    def _host_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.per_host_limit)
+            self._locks[host] = asyncio.Lock()
+        return self._hosts[host]
+
+    def penalize(self, host: str, delay: float):
+        """Nessun nuovo avvio su host per delay secondi (es. dopo un 429)"""
+        self._next_start[host] = max(self._next_start.get(host, 0), time.monotonic() + delay)
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        """Attende un posto libero per l'URL rispettando tutti i limiti"""
+        if self._global is None:
+            self._global = asyncio.Semaphore(self.global_limit)
+        host = host_key(url)
+        host_semaphore = self._host_semaphore(host)
+
+        async with host_semaphore:
+            async with self._global:
+                # Serializza gli avvii sullo stesso host per rispettare l'intervallo
+                async with self._locks[host]:
+                    wait = self._next_start.get(host, 0) - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    self._next_start[host] = time.monotonic() + self.min_interval
+                yield
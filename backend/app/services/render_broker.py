@@ -0,0 +1,399 @@
+"""
+Coda condivisa dei render per worker su più nodi.
+
+L'API (app/main.py) mette i remix serializzati in un broker; i worker
+(python -m app.worker, anche su altre macchine) li prendono, li eseguono
+con la stessa pipeline del render locale e pubblicano il risultato.
+
+Backend:
+- sqlite: un file SQLite (WAL) condiviso; basta per un solo host, per i
+  test e come broker di riferimento ospitato dall'API (app/routers/broker.py).
+- http: adapter di rete per i worker remoti, parla con il broker dell'API.
+
+I worker inviano un heartbeat ogni WORKER_HEARTBEAT_SECONDS; un job il cui
+worker tace da più di WORKER_TIMEOUT_SECONDS torna in coda (fino a
+RENDER_MAX_ATTEMPTS tentativi), così un nodo morto non perde i render.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, List, Optional
+
+import httpx
+
+from app.services.jobs import JOB_QUEUED, JOB_RUNNING, JOB_FAILED, JOB_CANCELLED
+
+# Backend della coda: "" = render nel processo dell'API, sqlite, http (solo worker)
+RENDER_BROKER = os.environ.get("RENDER_BROKER", "").strip().lower()
+RENDER_BROKER_PATH = os.environ.get("RENDER_BROKER_PATH", str(Path("temp") / "render_broker.db"))
+# URL dell'API che ospita il broker (worker remoti) e token condiviso
+RENDER_BROKER_URL = os.environ.get("RENDER_BROKER_URL", "http://127.0.0.1:8000").rstrip("/")
+RENDER_BROKER_TOKEN = os.environ.get("RENDER_BROKER_TOKEN", "")
+WORKER_HEARTBEAT_SECONDS = float(os.environ.get("WORKER_HEARTBEAT_SECONDS", "5"))
+WORKER_TIMEOUT_SECONDS = float(os.environ.get("WORKER_TIMEOUT_SECONDS", "30"))
+RENDER_MAX_ATTEMPTS = int(os.environ.get("RENDER_MAX_ATTEMPTS", "3"))
+
+# Job terminati conservati nel broker (secondi)
+HISTORY_TTL = 3600
+
+
+class BrokerError(Exception):
+    """Broker non raggiungibile o risposta non valida"""
+
+
+class QueueBackend:
+    """
+    Interfaccia dei backend. Lato API: enqueue, get, cancel. Lato worker:
+    claim, heartbeat, finish. Un job è un dict con id, kind, payload,
+    status, worker, attempts, progress, result, error.
+    """
+    name = "base"
+
+    async def enqueue(self, job_id: str, kind: str, payload: dict, priority: int = 0):
+        raise NotImplementedError
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def cancel(self, job_id: str):
+        raise NotImplementedError
+
+    async def claim(self, worker_id: str, info: Optional[dict] = None) -> Optional[dict]:
+        """Prende il prossimo job in coda (priorità, poi ordine di arrivo), o None"""
+        raise NotImplementedError
+
+    async def heartbeat(self, worker_id: str, job_id: Optional[str] = None, progress: Optional[dict] = None,
+                        info: Optional[dict] = None) -> dict:
+        """
+        Segnala che il worker è vivo (e l'avanzamento del job).
+        Ritorna {"cancel": annullamento richiesto, "owned": il job è ancora del worker}.
+        """
+        raise NotImplementedError
+
+    async def finish(self, job_id: str, worker_id: str, status: str, result: Any = None,
+                     error: Optional[str] = None) -> bool:
+        """Chiude il job; False se nel frattempo è stato riassegnato o annullato"""
+        raise NotImplementedError
+
+    async def requeue_stale(self, timeout: float = WORKER_TIMEOUT_SECONDS) -> List[str]:
+        return []
+
+    async def stats(self) -> dict:
+        return {}
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class SqliteQueue(QueueBackend):
+    """Coda in un file SQLite: claim atomico con BEGIN IMMEDIATE, accesso da più processi"""
+    name = "sqlite"
+
+    def __init__(self, path: Path, max_attempts: int = RENDER_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._initialized = False
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._initialized and not self.path.exists():
+            # File eliminato da fuori: si ricrea lo schema invece di fallire a ogni chiamata
+            print(f"[Broker] {self.path} non trovato, ricreo la coda")
+            self._initialized = False
+        if not self._initialized:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit: le transazioni esplicite (BEGIN IMMEDIATE) solo dove servono
+        conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    cancel INTEGER NOT NULL DEFAULT 0,
+                    progress TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    heartbeat_at REAL,
+                    finished_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at);
+                CREATE TABLE IF NOT EXISTS workers (
+                    id TEXT PRIMARY KEY,
+                    info TEXT,
+                    heartbeat_at REAL NOT NULL
+                );
+            """)
+            self._initialized = True
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    async def _run(self, fn, *args):
+        # Operazioni brevi, ma il lock di SQLite può attendere: fuori dal loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
+    @staticmethod
+    def _to_dict(row: Optional[sqlite3.Row]) -> Optional[dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        for field in ("payload", "progress", "result"):
+            job[field] = json.loads(job[field]) if job[field] else None
+        job["cancel"] = bool(job["cancel"])
+        return job
+
+    # --- Lato API ----------------------------------------------------------
+
+    def _enqueue(self, job_id: str, kind: str, payload: dict, priority: int):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, priority, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), priority, JOB_QUEUED, time.time())
+            )
+
+    async def enqueue(self, job_id: str, kind: str, payload: dict, priority: int = 0):
+        await self._run(self._enqueue, job_id, kind, payload, priority)
+
+    def _get(self, job_id: str) -> Optional[dict]:
+        with self._connection() as conn:
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self._run(self._get, job_id)
+
+    def _cancel(self, job_id: str):
+        with self._connection() as conn:
+            # In coda: annullato subito; in esecuzione: il worker lo vede al prossimo heartbeat
+            conn.execute("UPDATE jobs SET status = ?, cancel = 1, finished_at = ? WHERE id = ? AND status = ?",
+                         (JOB_CANCELLED, time.time(), job_id, JOB_QUEUED))
+            conn.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND status = ?", (job_id, JOB_RUNNING))
+
+    async def cancel(self, job_id: str):
+        await self._run(self._cancel, job_id)
+
+    # --- Lato worker -------------------------------------------------------
+
+    def _touch_worker(self, conn: sqlite3.Connection, worker_id: str, info: Optional[dict], now: float):
+        conn.execute(
+            "INSERT INTO workers (id, info, heartbeat_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at, "
+            "info = COALESCE(excluded.info, workers.info)",
+            (worker_id, json.dumps(info) if info is not None else None, now)
+        )
+
+    def _claim(self, worker_id: str, info: Optional[dict]) -> Optional[dict]:
+        with self._connection() as conn:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            self._touch_worker(conn, worker_id, info, now)
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY priority, created_at LIMIT 1", (JOB_QUEUED,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, started_at = ?, "
+                    "heartbeat_at = ?, progress = NULL WHERE id = ?",
+                    (JOB_RUNNING, worker_id, now, now, row["id"])
+                )
+            conn.execute("COMMIT")
+        return self._get(row["id"]) if row is not None else None
+
+    async def claim(self, worker_id: str, info: Optional[dict] = None) -> Optional[dict]:
+        return await self._run(self._claim, worker_id, info)
+
+    def _heartbeat(self, worker_id: str, job_id: Optional[str], progress: Optional[dict],
+                   info: Optional[dict]) -> dict:
+        with self._connection() as conn:
+            now = time.time()
+            self._touch_worker(conn, worker_id, info, now)
+            if job_id is None:
+                return {"cancel": False, "owned": False}
+            if progress is not None:
+                conn.execute("UPDATE jobs SET heartbeat_at = ?, progress = ? WHERE id = ? AND worker = ? AND status = ?",
+                             (now, json.dumps(progress), job_id, worker_id, JOB_RUNNING))
+            else:
+                conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                             (now, job_id, worker_id, JOB_RUNNING))
+            row = conn.execute("SELECT worker, status, cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        owned = row is not None and row["worker"] == worker_id and row["status"] == JOB_RUNNING
+        return {"cancel": bool(row and row["cancel"]), "owned": owned}
+
+    async def heartbeat(self, worker_id: str, job_id: Optional[str] = None, progress: Optional[dict] = None,
+                        info: Optional[dict] = None) -> dict:
+        return await self._run(self._heartbeat, worker_id, job_id, progress, info)
+
+    def _finish(self, job_id: str, worker_id: str, status: str, result: Any, error: Optional[str]) -> bool:
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(),
+                 job_id, worker_id, JOB_RUNNING)
+            )
+            return cursor.rowcount == 1
+
+    async def finish(self, job_id: str, worker_id: str, status: str, result: Any = None,
+                     error: Optional[str] = None) -> bool:
+        return await self._run(self._finish, job_id, worker_id, status, result, error)
+
+    # --- Manutenzione ------------------------------------------------------
+
+    def _requeue_stale(self, timeout: float) -> List[str]:
+        with self._connection() as conn:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            stale = conn.execute(
+                "SELECT id, worker, attempts, cancel FROM jobs WHERE status = ? AND heartbeat_at < ?",
+                (JOB_RUNNING, now - timeout)
+            ).fetchall()
+            for row in stale:
+                if row["cancel"]:
+                    conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?",
+                                 (JOB_CANCELLED, now, row["id"]))
+                elif row["attempts"] >= self.max_attempts:
+                    conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                                 (JOB_FAILED, f"Worker {row['worker']} non più attivo "
+                                              f"({row['attempts']} tentativi)", now, row["id"]))
+                else:
+                    conn.execute("UPDATE jobs SET status = ?, worker = NULL WHERE id = ?", (JOB_QUEUED, row["id"]))
+            conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - HISTORY_TTL,))
+            conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (now - HISTORY_TTL,))
+            conn.execute("COMMIT")
+        for row in stale:
+            print(f"[Broker] Job {row['id']}: worker {row['worker']} non risponde, job rimesso in coda o chiuso")
+        return [row["id"] for row in stale]
+
+    async def requeue_stale(self, timeout: float = WORKER_TIMEOUT_SECONDS) -> List[str]:
+        return await self._run(self._requeue_stale, timeout)
+
+    def _stats(self) -> dict:
+        with self._connection() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            now = time.time()
+            workers = [
+                {"id": row["id"], "info": json.loads(row["info"]) if row["info"] else None,
+                 "last_seen": round(now - row["heartbeat_at"], 1)}
+                for row in conn.execute("SELECT * FROM workers ORDER BY id")
+            ]
+            busy = {row["worker"] for row in conn.execute("SELECT worker FROM jobs WHERE status = ?", (JOB_RUNNING,))}
+        for worker in workers:
+            worker["alive"] = worker["last_seen"] <= WORKER_TIMEOUT_SECONDS
+            worker["busy"] = worker["id"] in busy
+        return {"backend": self.name, "jobs": counts, "workers": workers}
+
+    async def stats(self) -> dict:
+        return await self._run(self._stats)
+
+    async def _reaper_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+            try:
+                await self.requeue_stale()
+            except Exception as e:
+                print(f"[Broker] Controllo dei worker fallito: {e}")
+
+    def start(self):
+        """Riassegnazione periodica dei job dei worker morti"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._reaper_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class HttpQueue(QueueBackend):
+    """Adapter di rete dei worker: claim/heartbeat/finish verso il broker ospitato dall'API"""
+    name = "http"
+
+    def __init__(self, url: str, token: str, timeout: float = 30):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.url}/api/broker", headers={"X-Broker-Token": self.token}, timeout=self.timeout
+            )
+        return self._client
+
+    async def _post(self, path: str, body: dict) -> Any:
+        try:
+            response = await self.client.post(path, json=body)
+        except httpx.HTTPError as e:
+            raise BrokerError(f"Broker non raggiungibile: {e}")
+        if response.status_code != 200:
+            raise BrokerError(f"Broker: HTTP {response.status_code} {response.text[:200]}")
+        return response.json()
+
+    async def claim(self, worker_id: str, info: Optional[dict] = None) -> Optional[dict]:
+        return await self._post("/claim", {"worker": worker_id, "info": info})
+
+    async def heartbeat(self, worker_id: str, job_id: Optional[str] = None, progress: Optional[dict] = None,
+                        info: Optional[dict] = None) -> dict:
+        return await self._post("/heartbeat", {"worker": worker_id, "job_id": job_id, "progress": progress, "info": info})
+
+    async def finish(self, job_id: str, worker_id: str, status: str, result: Any = None,
+                     error: Optional[str] = None) -> bool:
+        body = {"worker": worker_id, "status": status, "result": result, "error": error}
+        return (await self._post(f"/jobs/{job_id}/finish", body))["accepted"]
+
+    async def enqueue(self, job_id: str, kind: str, payload: dict, priority: int = 0):
+        raise NotImplementedError("Il backend http è solo per i worker: l'API usa RENDER_BROKER=sqlite")
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        raise NotImplementedError("Il backend http è solo per i worker: l'API usa RENDER_BROKER=sqlite")
+
+    async def cancel(self, job_id: str):
+        raise NotImplementedError("Il backend http è solo per i worker: l'API usa RENDER_BROKER=sqlite")
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def create_broker(name: str = RENDER_BROKER) -> Optional[QueueBackend]:
+    if not name:
+        return None
+    if name == "sqlite":
+        return SqliteQueue(Path(RENDER_BROKER_PATH))
+    if name == "http":
+        return HttpQueue(RENDER_BROKER_URL, RENDER_BROKER_TOKEN)
+    raise ValueError(f"Broker dei render sconosciuto: {name}")
+
+
+# None = render nel processo dell'API (come sempre)
+render_broker = create_broker()
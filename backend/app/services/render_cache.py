@@ -0,0 +1,101 @@
+"""
+Cache dei render indicizzata per contenuto.
+
+La chiave è l'hash della richiesta normalizzata più gli hash dei file usati
+(sorgente, overlay, audio): due richieste identiche producono lo stesso file
+in output/ e il secondo render non viene mai eseguito.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from app.services.storage import storage
+
+_HASH_CHUNK = 1024 * 1024
+
+# (path, size, mtime_ns) -> sha256, per non rileggere file già visti
+_hash_memo: Dict[Tuple[str, int, int], str] = {}
+_hash_lock = threading.Lock()
+
+
+def file_hash(path: Path) -> str:
+    """SHA-256 del contenuto del file, memorizzato finché size/mtime non cambiano"""
+    stat = path.stat()
+    memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        cached = _hash_memo.get(memo_key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            digest.update(chunk)
+    value = digest.hexdigest()
+
+    with _hash_lock:
+        _hash_memo[memo_key] = value
+    return value
+
+
+def compute_key(params: Dict[str, Any], files: Iterable[Path]) -> str:
+    """Chiave di cache: parametri normalizzati + hash del contenuto dei file"""
+    payload = {
+        "params": params,
+        "files": [file_hash(Path(f)) for f in files],
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class RenderCache:
+    """
+    Render completati in output/. Quote ed età massima sono applicate dal
+    gestore dello spazio (app/services/storage.py) come per gli altri file.
+    """
+
+    def __init__(self, output_dir: Path, prefix: str = "remix_"):
+        self.output_dir = output_dir
+        self.prefix = prefix
+
+    def filename(self, key: str) -> str:
+        return f"{self.prefix}{key[:16]}.mp4"
+
+    def path(self, key: str) -> Path:
+        return self.output_dir / self.filename(key)
+
+    def temp_path(self, key: str) -> Path:
+        """File di lavoro: rinominato nel path finale solo a render riuscito"""
+        return self.output_dir / f"{self.prefix}{key[:16]}.part.mp4"
+
+    def lookup(self, key: str, video_id: Optional[str] = None) -> Optional[Path]:
+        """
+        Ritorna il render in cache (aggiornando l'ultimo accesso) o None.
+        video_id: il render serve anche a questo video (render condivisi tra
+        video con lo stesso contenuto), la pulizia di un altro non lo elimina.
+        """
+        path = self.path(key)
+        if not path.exists():
+            return None
+        storage.touch(path)
+        if video_id:
+            storage.register(path, owner=video_id)
+        return path
+
+    def commit(self, key: str, video_id: Optional[str] = None) -> Path:
+        """Promuove il file di lavoro a entry di cache (video_id: sorgente, per la pulizia)"""
+        final_path = self.path(key)
+        os.replace(self.temp_path(key), final_path)
+        storage.register(final_path, owner=video_id)
+        return final_path
+
+    def discard(self, key: str):
+        temp_path = self.temp_path(key)
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+render_cache = RenderCache(Path("output"))
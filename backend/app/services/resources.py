@@ -0,0 +1,200 @@
+"""
+Modello delle risorse dei render e controllo di ammissione.
+
+Ogni render ha una stima di memoria di picco e di CPU (risoluzione, numero di
+output, overlay, filtri, durata). I render partono solo finché la somma delle
+stime sta nel budget di memoria, e il profilo dell'encoder (thread, preset,
+lookahead) viene scelto in base a core e memoria realmente disponibili:
+sulle istanze piccole resta il profilo "lowmem" di sempre, sulle macchine
+grandi si usano più thread.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+MB = 1024 * 1024
+
+# Profili encoder dal più leggero al più pesante (lowmem = impostazioni storiche)
+ENCODER_PROFILES: List[Dict] = [
+    {"name": "lowmem", "threads": 1, "preset": "ultrafast", "rc_lookahead": 0, "bframes": 0, "refs": 1, "cost": 1.0},
+    {"name": "balanced", "threads": 2, "preset": "superfast", "rc_lookahead": 10, "bframes": 3, "refs": 1, "cost": 1.8},
+    {"name": "throughput", "threads": 4, "preset": "veryfast", "rc_lookahead": 20, "bframes": 3, "refs": 1, "cost": 2.5},
+    {"name": "quality", "threads": 8, "preset": "faster", "rc_lookahead": 30, "bframes": 3, "refs": 2, "cost": 4.0},
+]
+
+# Costanti del modello (stime conservative, calibrate su encode 1080x1920)
+FFMPEG_BASE_MB = 50          # processo, librerie, mux e audio
+DECODER_FRAMES = 8           # DPB h264 + code interne del decoder
+OVERLAY_FRAMES = 4           # conversioni rgba/yuva e blend per overlay
+SAFETY_FACTOR = 1.3
+# Secondi CPU per megapixel per frame con x264 ultrafast su un core
+ENCODE_SEC_PER_MPIX = 0.005
+PARALLEL_EFFICIENCY = 0.8
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        value = Path(path).read_text().split()[0]
+        return None if value == "max" else int(value)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def detect_memory_mb() -> int:
+    """Memoria disponibile al processo: limite del cgroup o RAM fisica"""
+    physical = None
+    try:
+        for line in Path("/proc/meminfo").read_text().splitlines():
+            if line.startswith("MemTotal:"):
+                physical = int(line.split()[1]) * 1024
+                break
+    except (OSError, ValueError):
+        pass
+    limits = [
+        _read_int("/sys/fs/cgroup/memory.max"),
+        _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    ]
+    candidates = [v for v in limits + [physical] if v]
+    # Il limite v1 "illimitato" è un numero enorme: min() lo scarta
+    return int(min(candidates) / MB) if candidates else 512
+
+
+def detect_cpus() -> int:
+    """Core utilizzabili: quota del cgroup, affinity o cpu_count"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        cpus = os.cpu_count() or 1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+# Budget per i render: di default il 75% della memoria (il resto per il backend)
+RENDER_MEMORY_BUDGET_MB = int(os.environ.get("RENDER_MEMORY_BUDGET_MB", "0")) or int(detect_memory_mb() * 0.75)
+RENDER_CPUS = int(os.environ.get("RENDER_CPUS", "0")) or detect_cpus()
+# Forza un profilo encoder (lowmem, balanced, throughput, quality); vuoto = automatico
+RENDER_ENCODER_PROFILE = os.environ.get("RENDER_ENCODER_PROFILE", "").strip().lower()
+
+
+def get_profile(name: str) -> Dict:
+    for profile in ENCODER_PROFILES:
+        if profile["name"] == name:
+            return profile
+    raise ValueError(f"Profilo encoder sconosciuto: {name}")
+
+
+def estimate_render(
+    width: int,
+    height: int,
+    duration: Optional[float],
+    fps: Optional[float],
+    profile: Dict,
+    outputs: int = 1,
+    overlays: int = 0,
+    filters: int = 0,
+) -> Dict:
+    """
+    Stima di picco memoria (MB) e CPU (secondi) di un render.
+    overlays: overlay totali su tutti gli output, filters: altri filtri a
+    frame intero (eq, testo...).
+    """
+    frame_mb = width * height * 1.5 / MB  # frame yuv420p
+    threads = profile["threads"]
+
+    decoder_mb = frame_mb * (DECODER_FRAMES + threads)
+    filters_mb = frame_mb * (OVERLAY_FRAMES * overlays + filters + 2 * (outputs - 1 if outputs > 1 else 0))
+    # x264: lookahead, frame in volo per thread, B-frame e riferimenti (+ copie lowres)
+    encoder_frames = profile["rc_lookahead"] + threads + profile["bframes"] + profile["refs"] + 3
+    encoder_mb = frame_mb * encoder_frames * 1.5 * outputs
+    memory_mb = (FFMPEG_BASE_MB + decoder_mb + filters_mb + encoder_mb) * SAFETY_FACTOR
+
+    frames = (duration or 0) * (fps or 30)
+    mpix = width * height / 1e6
+    work = 0.5 + outputs * profile["cost"] + 0.3 * overlays + 0.2 * filters
+    cpu_seconds = frames * mpix * ENCODE_SEC_PER_MPIX * work
+    wall_seconds = cpu_seconds / max(1.0, threads * PARALLEL_EFFICIENCY)
+
+    return {
+        "profile": profile["name"],
+        "threads": threads,
+        "preset": profile["preset"],
+        "memory_mb": round(memory_mb, 1),
+        "cpu_seconds": round(cpu_seconds, 1),
+        "wall_seconds": round(wall_seconds, 1),
+    }
+
+
+def select_profile(width: int, height: int, workers: int, outputs: int = 1, overlays: int = 0, filters: int = 0) -> Dict:
+    """
+    Profilo più pesante che sta nella quota di un worker (core e memoria
+    divisi per il numero di render paralleli); altrimenti lowmem.
+    """
+    if RENDER_ENCODER_PROFILE:
+        return get_profile(RENDER_ENCODER_PROFILE)
+    workers = max(1, workers)
+    cpu_share = max(1, RENDER_CPUS // workers)
+    memory_share = RENDER_MEMORY_BUDGET_MB / workers
+    chosen = ENCODER_PROFILES[0]
+    for profile in ENCODER_PROFILES[1:]:
+        if profile["threads"] > cpu_share:
+            break
+        estimate = estimate_render(width, height, None, None, profile, outputs, overlays, filters)
+        if estimate["memory_mb"] > memory_share:
+            break
+        chosen = profile
+    return chosen
+
+
+class MemoryBudget:
+    """Ammette i render finché la somma delle stime di memoria sta nel budget"""
+
+    def __init__(self, budget_mb: float):
+        self.budget_mb = budget_mb
+        self.reserved_mb = 0.0
+        self.running = 0
+        self.waiting = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    def fits(self, memory_mb: float) -> bool:
+        # Un render più grande del budget parte comunque, ma da solo
+        return self.running == 0 or self.reserved_mb + memory_mb <= self.budget_mb
+
+    @asynccontextmanager
+    async def reserve(self, memory_mb: float):
+        """Attende che la stima stia nel budget e la tiene riservata fino all'uscita"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            self.waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self.fits(memory_mb))
+            finally:
+                self.waiting -= 1
+            self.reserved_mb += memory_mb
+            self.running += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.reserved_mb -= memory_mb
+                self.running -= 1
+                self._condition.notify_all()
+
+    def stats(self) -> Dict:
+        return {
+            "budget_mb": self.budget_mb,
+            "reserved_mb": round(self.reserved_mb, 1),
+            "running": self.running,
+            "waiting": self.waiting,
+            "cpus": RENDER_CPUS,
+        }
+
+
+render_budget = MemoryBudget(RENDER_MEMORY_BUDGET_MB)
@@ -0,0 +1,97 @@
+"""
+Render parallelo a segmenti.
+
+Un remix è un solo FFmpeg che usa un core (profilo lowmem): su sorgenti
+lunghe il resto della macchina resta fermo. Qui l'intervallo (già tagliato)
+del sorgente viene diviso sui keyframe in N segmenti di durata simile; ogni
+segmento passa per lo stesso filtergraph in un FFmpeg separato (in parallelo)
+e i pezzi vengono uniti con il concat demuxer (stream copy del video,
+build_concat_command in app/services/ffmpeg.py, come per lo smart cut).
+
+Perché i confini non si vedano:
+- i tagli cadono su keyframe, con seek accurato: nessun frame perso o doppio;
+- nel filtergraph di ogni segmento il video base viene spostato al suo tempo
+  di output assoluto, quindi finestre di overlay/testo e clip già iniziate
+  continuano esattamente da dove erano rimaste;
+- l'audio non viene segmentato: è codificato una volta sola nel concat,
+  su tutto l'intervallo.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+PARALLEL_RENDER_ENABLED = os.environ.get("PARALLEL_RENDER_ENABLED", "true").lower() == "true"
+# Massimo segmenti per render (0 = core disponibili per worker)
+PARALLEL_RENDER_SEGMENTS = int(os.environ.get("PARALLEL_RENDER_SEGMENTS", "0"))
+# Sotto questa durata (secondi di sorgente) il render resta in un solo processo
+PARALLEL_RENDER_MIN_SECONDS = float(os.environ.get("PARALLEL_RENDER_MIN_SECONDS", "30"))
+# Durata minima di un segmento: sotto, l'avvio di FFmpeg pesa più del guadagno
+PARALLEL_RENDER_MIN_SEGMENT_SECONDS = float(os.environ.get("PARALLEL_RENDER_MIN_SEGMENT_SECONDS", "8"))
+
+
+def plan_segments(keyframes: List[float], start: float, end: float, count: int,
+                  min_segment: float = PARALLEL_RENDER_MIN_SEGMENT_SECONDS) -> List[Tuple[float, float]]:
+    """
+    Divide [start, end) in al massimo count segmenti di durata simile,
+    tagliando sul keyframe più vicino a ogni punto ideale.
+    """
+    count = min(count, int((end - start) // min_segment)) if min_segment > 0 else count
+    if count < 2:
+        return [(start, end)]
+    target_length = (end - start) / count
+    cuts = [start]
+    for i in range(1, count):
+        target = start + i * target_length
+        candidates = [k for k in keyframes if cuts[-1] + min_segment <= k <= end - min_segment]
+        if not candidates:
+            break
+        cuts.append(min(candidates, key=lambda k: abs(k - target)))
+    cuts.append(end)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def overlay_visible(start: float, end: Optional[float], window_start: float, window_end: float) -> bool:
+    """True se un overlay con finestra [start, end) è a schermo in [window_start, window_end)"""
+    if end is not None and end <= window_start:
+        return False
+    return start < window_end
+
+
+class ProcessGroup:
+    """
+    Processi FFmpeg dei segmenti di un render. Sta in job.process al posto del
+    singolo processo: la cancellazione li termina tutti, l'avanzamento è
+    la somma pesata sulla durata dei segmenti.
+    """
+
+    def __init__(self, durations: List[float]):
+        self.durations = durations
+        self.processes = []
+        self._out_time: Dict[int, float] = {}
+
+    def add(self, process):
+        self.processes.append(process)
+
+    def poll(self):
+        return None if any(p.poll() is None for p in self.processes) else 0
+
+    def kill(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+
+    def update(self, segment: int, progress: dict) -> dict:
+        """Avanzamento combinato a partire da quello di un segmento"""
+        if progress.get("state") == "end":
+            self._out_time[segment] = self.durations[segment]
+        elif progress.get("out_time") is not None:
+            self._out_time[segment] = min(progress["out_time"], self.durations[segment])
+        total = sum(self.durations)
+        done = sum(self._out_time.values())
+        return {
+            **progress,
+            "out_time": round(done, 3),
+            "percent": round(min(100.0, done / total * 100), 1) if total else None,
+            "eta": None,
+            "segment": segment,
+            "segments": len(self.durations),
+        }
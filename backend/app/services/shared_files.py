@@ -0,0 +1,137 @@
+"""
+Storage condiviso tra API e worker dei render.
+
+- local: stesso filesystem (stesso host o volume condiviso, es. NFS): i file
+  sono già dove servono, vanno solo registrati negli indici del worker.
+- http: il worker scarica sorgente e asset dal broker dell'API e ci carica
+  l'output (app/routers/broker.py).
+
+I nomi dei file sono quelli dell'API (temp/<video_id>.<ext>, asset
+content-addressed), quindi un file già scaricato non viene riscaricato.
+"""
+import os
+from pathlib import Path
+from typing import Optional
+
+import aiofiles
+import httpx
+
+from app.services.asset_catalog import asset_catalog, KIND_OVERLAYS, KIND_AUDIO
+from app.services.render_broker import RENDER_BROKER, RENDER_BROKER_URL, RENDER_BROKER_TOKEN, BrokerError
+from app.services.render_cache import render_cache
+from app.services.storage import storage
+
+# local o http (default: http con il broker http, altrimenti local)
+WORKER_SHARED_STORAGE = os.environ.get("WORKER_SHARED_STORAGE") or ("http" if RENDER_BROKER == "http" else "local")
+
+TEMP_DIR = Path("temp")
+ASSET_KINDS = {"overlays": KIND_OVERLAYS, "audio": KIND_AUDIO}
+
+
+class SharedFiles:
+    """fetch: porta in locale gli input di un job; publish: rende l'output visibile all'API"""
+    name = "base"
+
+    def local_path(self, kind: str, name: str) -> Path:
+        if Path(name).name != name:
+            raise BrokerError(f"Nome file non valido: {name}")
+        if kind == "source":
+            return TEMP_DIR / name
+        return asset_catalog.directory(ASSET_KINDS[kind]) / name
+
+    async def download(self, kind: str, name: str, path: Path):
+        raise BrokerError(f"File mancante: {path}")
+
+    async def fetch(self, inputs: dict):
+        """Scarica gli input mancanti e li registra (indice dei file e catalogo asset)"""
+        for kind, names in (("source", [inputs["source"]]), ("overlays", inputs["overlays"]), ("audio", inputs["audio"])):
+            for name in names:
+                path = self.local_path(kind, name)
+                if not path.exists():
+                    await self.download(kind, name, path)
+                if kind == "source":
+                    storage.register(path)
+                else:
+                    asset_catalog.add(ASSET_KINDS[kind], path)
+
+    async def publish(self, job_id: str, worker_id: str, cache_key: str):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LocalSharedFiles(SharedFiles):
+    """API e worker vedono le stesse cartelle: l'output è già nella cache dei render"""
+    name = "local"
+
+
+class HttpSharedFiles(SharedFiles):
+    """Input scaricati dal broker dell'API, output caricato con un PUT in streaming"""
+    name = "http"
+    chunk_size = 1024 * 1024
+
+    def __init__(self, url: str, token: str, timeout: float = 300):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.url}/api/broker", headers={"X-Broker-Token": self.token}, timeout=self.timeout
+            )
+        return self._client
+
+    async def download(self, kind: str, name: str, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(f".download_{name}.part")
+        try:
+            async with self.client.stream("GET", f"/files/{kind}/{name}") as response:
+                if response.status_code != 200:
+                    raise BrokerError(f"Download di {name} fallito: HTTP {response.status_code}")
+                async with aiofiles.open(part_path, "wb") as out:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        await out.write(chunk)
+            os.replace(part_path, path)
+        except httpx.HTTPError as e:
+            raise BrokerError(f"Download di {name} fallito: {e}")
+        finally:
+            part_path.unlink(missing_ok=True)
+        print(f"[Worker] Scaricato {kind}/{name}")
+
+    async def publish(self, job_id: str, worker_id: str, cache_key: str):
+        path = render_cache.path(cache_key)
+
+        async def _chunks():
+            async with aiofiles.open(path, "rb") as source:
+                while True:
+                    chunk = await source.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        try:
+            response = await self.client.put(
+                f"/jobs/{job_id}/output", content=_chunks(),
+                headers={"X-Worker-Id": worker_id, "Content-Length": str(path.stat().st_size)}
+            )
+        except httpx.HTTPError as e:
+            raise BrokerError(f"Upload dell'output fallito: {e}")
+        if response.status_code != 200:
+            raise BrokerError(f"Upload dell'output fallito: HTTP {response.status_code} {response.text[:200]}")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def create_shared_files(name: str = WORKER_SHARED_STORAGE) -> SharedFiles:
+    if name == "local":
+        return LocalSharedFiles()
+    if name == "http":
+        return HttpSharedFiles(RENDER_BROKER_URL, RENDER_BROKER_TOKEN)
+    raise ValueError(f"Storage condiviso sconosciuto: {name}")
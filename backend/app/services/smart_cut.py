@@ -0,0 +1,138 @@
+"""
+Smart cut: trim senza ricodificare tutto il video.
+
+I GOP interi dentro l'intervallo vengono copiati (stream copy); solo i pezzi
+parziali all'inizio e alla fine (prima del primo keyframe e dopo l'ultimo)
+vengono ricodificati con libx264. I pezzi sono scritti in MPEG-TS, che porta
+SPS/PPS in-band, e poi concatenati con il concat demuxer.
+"""
+from fractions import Fraction
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from app.services.ffmpeg import FFMPEG_PATH, build_concat_command, write_concat_list
+
+# Codec/pixel format per cui i pezzi ricodificati sono compatibili con quelli copiati
+SUPPORTED_CODECS = ["h264"]
+SUPPORTED_PIX_FMTS = ["yuv420p", "yuvj420p"]
+
+# Sotto questa distanza (secondi) un taglio è considerato già su keyframe
+CUT_EPSILON = 0.01
+
+# Encoding dei pezzi parziali: brevi, quindi possiamo permetterci più qualità
+PARTIAL_ENCODE_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-threads", "1"]
+
+SEGMENT_ENCODE = "encode"
+SEGMENT_COPY = "copy"
+
+
+class SmartCutUnavailable(Exception):
+    """Il sorgente non permette lo smart cut: usare il render completo"""
+
+
+def check_compatible(media: dict):
+    """Solleva SmartCutUnavailable se codec o timestamp non lo permettono"""
+    if media.get("video_codec") not in SUPPORTED_CODECS:
+        raise SmartCutUnavailable(f"Codec non supportato: {media.get('video_codec')}")
+    if media.get("pix_fmt") not in SUPPORTED_PIX_FMTS:
+        raise SmartCutUnavailable(f"Pixel format non supportato: {media.get('pix_fmt')}")
+    if media.get("rotation"):
+        raise SmartCutUnavailable(f"Video ruotato ({media.get('rotation')}°)")
+    # Frame rate variabile: i pezzi ricodificati non si allineerebbero
+    try:
+        if Fraction(media.get("r_frame_rate") or "0/1") != Fraction(media.get("avg_frame_rate") or "0/1"):
+            raise SmartCutUnavailable("Frame rate variabile")
+    except (ValueError, ZeroDivisionError):
+        raise SmartCutUnavailable("Frame rate non valido")
+    start_time = media.get("start_time")
+    if start_time is not None and abs(start_time) > CUT_EPSILON:
+        raise SmartCutUnavailable(f"Start time non nullo: {start_time}")
+    if not media.get("keyframes"):
+        raise SmartCutUnavailable("Tabella keyframe non disponibile")
+
+
+def plan_segments(keyframes: List[float], start: float, end: float, duration: float) -> List[Tuple[str, float, float]]:
+    """
+    Divide [start, end) in pezzi: ricodifica fino al primo keyframe, copia
+    i GOP interi, ricodifica dall'ultimo keyframe alla fine.
+    """
+    starts = [k for k in keyframes if start - CUT_EPSILON <= k < end - CUT_EPSILON]
+    if not starts:
+        raise SmartCutUnavailable("Nessun keyframe nell'intervallo")
+    first_key = starts[0]
+
+    # La copia deve finire su un keyframe (o alla fine del file)
+    later = [k for k in keyframes if first_key + CUT_EPSILON < k <= end + CUT_EPSILON]
+    if duration and end >= duration - CUT_EPSILON:
+        copy_end = end
+    elif later:
+        copy_end = min(later[-1], end)
+    else:
+        raise SmartCutUnavailable("Nessun GOP intero nell'intervallo")
+
+    segments = []
+    if first_key - start > CUT_EPSILON:
+        segments.append((SEGMENT_ENCODE, start, first_key))
+    segments.append((SEGMENT_COPY, first_key, copy_end))
+    if end - copy_end > CUT_EPSILON:
+        segments.append((SEGMENT_ENCODE, copy_end, end))
+    return segments
+
+
+def build_segment_command(source_path: Path, kind: str, seg_start: float, seg_end: float, output_path: Path) -> List[str]:
+    """Comando FFmpeg per un singolo pezzo (solo video, MPEG-TS)"""
+    cmd = [FFMPEG_PATH, "-y", "-ss", f"{seg_start:.6f}", "-i", str(source_path),
+           "-t", f"{seg_end - seg_start:.6f}", "-map", "0:v:0", "-an"]
+    if kind == SEGMENT_COPY:
+        cmd.extend(["-c:v", "copy", "-bsf:v", "h264_mp4toannexb"])
+    else:
+        cmd.extend(PARTIAL_ENCODE_ARGS + ["-pix_fmt", "yuv420p"])
+    cmd.extend(["-f", "mpegts", str(output_path)])
+    return cmd
+
+
+async def smart_cut(
+    source_path: Path,
+    output_path: Path,
+    work_dir: Path,
+    trim_start: float,
+    trim_end: Optional[float],
+    audio_path: Optional[Path],
+    remove_original_audio: bool,
+    media: dict,
+    run: Callable[[List[str]], Awaitable[object]],
+):
+    """
+    Esegue lo smart cut. media sono i metadati dell'indice (con keyframe),
+    run esegue un comando FFmpeg. Solleva SmartCutUnavailable prima di
+    scrivere l'output se il sorgente non lo permette.
+    """
+    check_compatible(media)
+
+    duration = media.get("duration") or 0
+    start = max(0.0, trim_start)
+    end = trim_end if trim_end and trim_end > start else duration
+    end = min(end, duration) if duration else end
+    if end <= start:
+        raise SmartCutUnavailable("Intervallo di trim vuoto")
+
+    segments = plan_segments(media["keyframes"], start, end, duration)
+
+    work_dir.mkdir(parents=True, exist_ok=True)
+    pieces = []
+    try:
+        for idx, (kind, seg_start, seg_end) in enumerate(segments):
+            piece_path = work_dir / f"piece_{idx}.ts"
+            await run(build_segment_command(source_path, kind, seg_start, seg_end, piece_path))
+            pieces.append(piece_path)
+
+        list_path = work_dir / "pieces.txt"
+        write_concat_list(pieces, list_path)
+        await run(build_concat_command(list_path, source_path, start, end, audio_path, remove_original_audio, output_path))
+    finally:
+        for piece in work_dir.glob("*"):
+            piece.unlink(missing_ok=True)
+        work_dir.rmdir()
+
+    copied = sum(e - s for kind, s, e in segments if kind == SEGMENT_COPY)
+    print(f"[SmartCut] {copied:.2f}s copiati, {end - start - copied:.2f}s ricodificati")
@@ -0,0 +1,488 @@
+"""
+Ciclo di vita dei file in temp/ e output/.
+
+Ogni artefatto (sorgente, proxy, poster, probe, filmstrip, overlay preparato,
+render) è registrato in un indice in memoria con dimensione, ultimo accesso,
+video di appartenenza, contatore d'uso e pin. Un giro periodico applica per
+cartella una TTL e una quota in byte (LRU): gli artefatti usati da un render
+in corso o pinnati non vengono mai eliminati. Eliminare un sorgente elimina
+anche i suoi derivati, e la pulizia di un video legge solo i suoi artefatti
+invece di fare un glob su tutte le cartelle. I render appartengono a tutti i
+video che li usano (temp/storage_owners.json, letto anche dopo un riavvio):
+un render condiviso viene eliminato solo con l'ultimo di questi video.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.services.metrics import storage_evictions
+
+MB = 1024 * 1024
+
+# temp/: sorgenti e derivati (proxy, probe, filmstrip, overlay preparati)
+STORAGE_TEMP_MAX_MB = int(os.environ.get("STORAGE_TEMP_MAX_MB", "4096"))
+STORAGE_TEMP_TTL_HOURS = float(os.environ.get("STORAGE_TEMP_TTL_HOURS", "24"))
+# output/: render in cache (stesse variabili della vecchia eviction della render cache)
+RENDER_CACHE_MAX_MB = int(os.environ.get("RENDER_CACHE_MAX_MB", "2048"))
+RENDER_CACHE_MAX_AGE_HOURS = float(os.environ.get("RENDER_CACHE_MAX_AGE_HOURS", "24"))
+# Secondi tra due giri di eviction e tra due riscansioni complete del disco
+STORAGE_SWEEP_SECONDS = float(os.environ.get("STORAGE_SWEEP_SECONDS", "60"))
+STORAGE_RESCAN_SECONDS = float(os.environ.get("STORAGE_RESCAN_SECONDS", "600"))
+
+KIND_SOURCE = "source"
+KIND_PROXY = "proxy"
+KIND_PROBE = "probe"
+KIND_FILMSTRIP = "filmstrip"
+KIND_OVERLAY = "overlay"
+KIND_KEY = "key"
+KIND_NOBG = "nobg"
+KIND_TEXT = "text"
+KIND_RENDER = "render"
+
+# Sottocartelle di temp/ con artefatti: nome -> tipo
+TEMP_SUBDIRS = {
+    "proxy": KIND_PROXY,
+    "probe": KIND_PROBE,
+    "filmstrip": KIND_FILMSTRIP,
+    "overlay_cache": KIND_OVERLAY,
+    "keys": KIND_KEY,
+    "nobg": KIND_NOBG,
+    "text": KIND_TEXT,
+}
+
+# File di servizio in temp/ che non sono artefatti
+TEMP_RESERVED = {"download_index.json", "storage_pins.json", "storage_owners.json"}
+
+# Database SQLite in temp/ (es. coda del broker dei render) con i file WAL
+_SQLITE_FILE = re.compile(r"\.db(-wal|-shm|-journal)?$")
+
+_FILMSTRIP_NAME = re.compile(r"^(.+)_\d+_\d+(_fast)?$")
+
+
+def _is_transient(name: str) -> bool:
+    """File di lavoro (scritture in corso, poi rinominate): mai tracciati"""
+    return name.startswith((".", "part_")) or ".part" in name or name.endswith(".tmp")
+
+
+class Artifact:
+    __slots__ = ("path", "root", "kind", "owners", "size", "last_access", "refs")
+
+    def __init__(self, path: Path, root: str, kind: str, owners: Iterable[Optional[str]], size: int, last_access: float):
+        self.path = path
+        self.root = root
+        self.kind = kind
+        # Video di appartenenza: più di uno per i render condivisi (stesso contenuto)
+        self.owners: Set[str] = {owner for owner in owners if owner}
+        self.size = size
+        self.last_access = last_access
+        # Render in corso che lo stanno usando
+        self.refs = 0
+
+
+class StorageRoot:
+    def __init__(self, name: str, directory: Path, max_bytes: int, ttl: float):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+
+class StorageManager:
+    """Indice degli artefatti su disco con quote, TTL, contatori d'uso e pin"""
+
+    def __init__(self, temp: StorageRoot, output: StorageRoot, pins_path: Path, owners_path: Path):
+        self.temp = temp
+        self.output = output
+        self.pins_path = pins_path
+        self.owners_path = owners_path
+        self._lock = threading.RLock()
+        self._artifacts: Dict[str, Artifact] = {}
+        self._by_owner: Dict[str, Set[str]] = {}
+        self._bytes: Dict[str, int] = {temp.name: 0, output.name: 0}
+        self._pinned: Optional[Set[str]] = None
+        # Video di appartenenza non deducibili dal nome (render), salvati su disco
+        self._owners: Optional[Dict[str, List[str]]] = None
+        # False nei processi che condividono le cartelle con l'API (vedi start):
+        # niente eviction e niente scritture degli indici su disco
+        self._manage = True
+        self._listeners: List[Callable[[str], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    # --- Classificazione -------------------------------------------------
+
+    def classify(self, path: Path) -> Optional[Tuple[StorageRoot, str, Optional[str]]]:
+        """(cartella, tipo, video) di un file, o None se non è un artefatto gestito"""
+        if _is_transient(path.name):
+            return None
+        parent = path.parent
+        if parent == self.output.directory:
+            return (self.output, KIND_RENDER, None) if path.suffix == ".mp4" else None
+        if parent == self.temp.directory:
+            if path.name in TEMP_RESERVED or _SQLITE_FILE.search(path.name):
+                return None
+            return self.temp, KIND_SOURCE, path.stem
+        if parent.parent == self.temp.directory and parent.name in TEMP_SUBDIRS:
+            kind = TEMP_SUBDIRS[parent.name]
+            if kind in (KIND_OVERLAY, KIND_KEY, KIND_NOBG, KIND_TEXT):
+                return self.temp, kind, None
+            if kind == KIND_FILMSTRIP:
+                match = _FILMSTRIP_NAME.match(path.stem)
+                return self.temp, kind, match.group(1) if match else None
+            return self.temp, kind, path.stem
+        return None
+
+    # --- Indice ----------------------------------------------------------
+
+    def _add(self, artifact: Artifact):
+        key = str(artifact.path)
+        old = self._artifacts.get(key)
+        if old is not None:
+            self._drop(old)
+            artifact.refs = old.refs
+            artifact.owners |= old.owners
+        artifact.owners.update(self._saved_owners().get(key, ()))
+        self._artifacts[key] = artifact
+        self._bytes[artifact.root] += artifact.size
+        for owner in artifact.owners:
+            self._by_owner.setdefault(owner, set()).add(key)
+
+    def _unindex_owner(self, key: str, owner: str):
+        keys = self._by_owner.get(owner)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_owner[owner]
+
+    def _drop(self, artifact: Artifact):
+        key = str(artifact.path)
+        if self._artifacts.pop(key, None) is None:
+            return
+        self._bytes[artifact.root] -= artifact.size
+        for owner in artifact.owners:
+            self._unindex_owner(key, owner)
+
+    def register(self, path: Path, owner: Optional[str] = None) -> Optional[Artifact]:
+        """
+        Hook dopo la creazione di un artefatto. owner: video di appartenenza se
+        non deducibile dal nome (render); si aggiunge a quelli già noti e viene
+        salvato su disco, così sopravvive ai riavvii.
+        """
+        classified = self.classify(path)
+        if classified is None:
+            return None
+        root, kind, inferred_owner = classified
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return None
+        artifact = Artifact(path, root.name, kind, (owner, inferred_owner), size, time.time())
+        with self._lock:
+            self._add(artifact)
+            if owner and owner != inferred_owner:
+                self._save_owners(str(path), artifact.owners - {inferred_owner})
+        return artifact
+
+    def touch(self, path: Path):
+        """
+        Aggiorna l'ultimo accesso, anche come atime su disco così l'LRU sopravvive
+        ai riavvii. L'mtime resta invariato: probe e hash dei file ne dipendono.
+        """
+        now = time.time()
+        with self._lock:
+            artifact = self._artifacts.get(str(path))
+            if artifact is not None:
+                artifact.last_access = now
+        try:
+            os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+        except OSError:
+            pass
+
+    def source(self, video_id: str) -> Optional[Path]:
+        """File sorgente di un video: dall'indice (O(1)), glob in temp/ solo se non registrato"""
+        with self._lock:
+            for key in self._by_owner.get(video_id, ()):
+                artifact = self._artifacts[key]
+                if artifact.kind == KIND_SOURCE:
+                    return artifact.path
+        for path in self.temp.directory.glob(f"{video_id}.*"):
+            if self.register(path) is not None:
+                return path
+        return None
+
+    @contextmanager
+    def in_use(self, *paths: Optional[Path]):
+        """Protegge gli artefatti dall'eviction per la durata di un render"""
+        keys = []
+        with self._lock:
+            for path in paths:
+                if path is None:
+                    continue
+                artifact = self._artifacts.get(str(path)) or self.register(path)
+                if artifact is not None:
+                    artifact.refs += 1
+                    keys.append(str(path))
+        try:
+            yield
+        finally:
+            with self._lock:
+                for key in keys:
+                    artifact = self._artifacts.get(key)
+                    if artifact is not None:
+                        artifact.refs -= 1
+            for key in keys:
+                self.touch(Path(key))
+
+    # --- Pin ---------------------------------------------------------------
+
+    def _pins(self) -> Set[str]:
+        if self._pinned is None:
+            try:
+                self._pinned = set(json.loads(self.pins_path.read_text()))
+            except (OSError, ValueError):
+                self._pinned = set()
+        return self._pinned
+
+    def _save_pins(self):
+        self.pins_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.pins_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(sorted(self._pins())))
+        os.replace(tmp, self.pins_path)
+
+    def pin(self, video_id: str):
+        """Esclude dall'eviction il sorgente e i derivati di un video"""
+        with self._lock:
+            self._pins().add(video_id)
+            self._save_pins()
+
+    def unpin(self, video_id: str):
+        with self._lock:
+            if video_id in self._pins():
+                self._pins().discard(video_id)
+                self._save_pins()
+
+    def is_pinned(self, video_id: str) -> bool:
+        return video_id in self._pins()
+
+    # --- Video di appartenenza salvati --------------------------------------
+
+    def _saved_owners(self) -> Dict[str, List[str]]:
+        if self._owners is None:
+            try:
+                self._owners = json.loads(self.owners_path.read_text())
+            except (OSError, ValueError):
+                self._owners = {}
+        return self._owners
+
+    def _save_owners(self, key: str, owners: Set[str]):
+        saved = self._saved_owners()
+        if sorted(owners) == saved.get(key, []):
+            return
+        if owners:
+            saved[key] = sorted(owners)
+        else:
+            saved.pop(key, None)
+        if not self._manage:
+            return
+        self.owners_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.owners_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(saved))
+        os.replace(tmp, self.owners_path)
+
+    def _evictable(self, artifact: Artifact) -> bool:
+        return artifact.refs == 0 and not (artifact.owners & self._pins())
+
+    # --- Eliminazione ------------------------------------------------------
+
+    def _delete(self, artifact: Artifact) -> int:
+        artifact.path.unlink(missing_ok=True)
+        self._drop(artifact)
+        self._save_owners(str(artifact.path), set())
+        storage_evictions.inc(dir=artifact.root, kind=artifact.kind)
+        return artifact.size
+
+    def _delete_group(self, owner: str) -> Tuple[List[Artifact], bool]:
+        """
+        Elimina gli artefatti liberi di un video. Ritorna (eliminati, tutti eliminati).
+        Un render condiviso con altri video perde solo questo video e resta su disco.
+        """
+        removed, complete = [], True
+        for key in list(self._by_owner.get(owner, ())):
+            artifact = self._artifacts[key]
+            if len(artifact.owners) > 1:
+                artifact.owners.discard(owner)
+                self._unindex_owner(key, owner)
+                self._save_owners(key, set(self._saved_owners().get(key, ())) - {owner})
+                continue
+            if artifact.refs:
+                complete = False
+                continue
+            self._delete(artifact)
+            removed.append(artifact)
+        return removed, complete
+
+    def remove_owner(self, video_id: str) -> List[Path]:
+        """Elimina tutti gli artefatti di un video (pulizia esplicita), tranne quelli in uso"""
+        with self._lock:
+            removed, _ = self._delete_group(video_id)
+            self.unpin(video_id)
+        return [artifact.path for artifact in removed]
+
+    def enforce(self) -> List[str]:
+        """
+        Applica TTL e quote (bloccante). Eliminare un sorgente elimina tutto il
+        suo video. Ritorna i video il cui sorgente è stato eliminato.
+        Non elimina nulla se le cartelle sono gestite da un altro processo (start(evict=False)).
+        """
+        if not self._manage:
+            return []
+        now = time.time()
+        evicted_owners = []
+        removed = {self.temp.name: 0, self.output.name: 0}
+        with self._lock:
+            for root in (self.temp, self.output):
+                candidates = sorted(
+                    (a for a in self._artifacts.values() if a.root == root.name and self._evictable(a)),
+                    key=lambda a: a.last_access,
+                )
+                for artifact in candidates:
+                    expired = root.ttl and now - artifact.last_access > root.ttl
+                    over_quota = root.max_bytes and self._bytes[root.name] > root.max_bytes
+                    if not expired and not over_quota:
+                        # In ordine di accesso: i successivi sono più recenti
+                        break
+                    if str(artifact.path) not in self._artifacts:
+                        continue  # già eliminato con il suo sorgente
+                    if artifact.kind == KIND_SOURCE and artifact.owners:
+                        owner = next(iter(artifact.owners))
+                        group, complete = self._delete_group(owner)
+                        for member in group:
+                            removed[member.root] += 1
+                        if complete:
+                            evicted_owners.append(owner)
+                    else:
+                        self._delete(artifact)
+                        removed[root.name] += 1
+        for name, count in removed.items():
+            if count:
+                print(f"[Storage] Eliminati {count} file da {name}/ "
+                      f"({self._bytes[name] / MB:.0f} MB occupati)")
+        return evicted_owners
+
+    def on_owner_evicted(self, callback: Callable[[str], None]):
+        """Callback (nel loop) quando l'eviction elimina il sorgente di un video"""
+        self._listeners.append(callback)
+
+    # --- Scansione ---------------------------------------------------------
+
+    def _walk(self) -> Iterable[Tuple[Path, os.stat_result]]:
+        directories = [self.temp.directory, self.output.directory]
+        directories += [self.temp.directory / name for name in TEMP_SUBDIRS]
+        for directory in directories:
+            if not directory.exists():
+                continue
+            with os.scandir(directory) as it:
+                for item in it:
+                    if item.is_file():
+                        yield Path(item.path), item.stat()
+
+    def scan(self) -> int:
+        """Allinea l'indice al disco (bloccante): adotta i file non registrati e scarta quelli spariti"""
+        seen = set()
+        adopted = 0
+        with self._lock:
+            for path, stat in self._walk():
+                key = str(path)
+                seen.add(key)
+                existing = self._artifacts.get(key)
+                if existing is not None and existing.size == stat.st_size:
+                    continue
+                classified = self.classify(path)
+                if classified is None:
+                    continue
+                root, kind, owner = classified
+                last_access = existing.last_access if existing else max(stat.st_atime, stat.st_mtime)
+                self._add(Artifact(path, root.name, kind, (owner,), stat.st_size, last_access))
+                adopted += existing is None
+            for key in [k for k in self._artifacts if k not in seen]:
+                self._drop(self._artifacts[key])
+            for key in [k for k in self._saved_owners() if k not in seen]:
+                self._save_owners(key, set())
+        return adopted
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                root.name: {"bytes": self._bytes[root.name], "max_bytes": root.max_bytes, "ttl_seconds": root.ttl}
+                for root in (self.temp, self.output)
+            }
+            kinds: Dict[str, dict] = {}
+            for artifact in self._artifacts.values():
+                entry = kinds.setdefault(artifact.kind, {"files": 0, "bytes": 0})
+                entry["files"] += 1
+                entry["bytes"] += artifact.size
+            stats["kinds"] = kinds
+            stats["in_use"] = sum(1 for a in self._artifacts.values() if a.refs)
+            stats["pinned"] = sorted(self._pins())
+        return stats
+
+    def used_bytes(self) -> Dict[str, int]:
+        return dict(self._bytes)
+
+    # --- Ciclo in background -----------------------------------------------
+
+    async def sweep(self) -> List[str]:
+        """Un giro di eviction nel threadpool + notifica dei video eliminati"""
+        loop = asyncio.get_event_loop()
+        evicted = await loop.run_in_executor(None, self.enforce)
+        for video_id in evicted:
+            for callback in self._listeners:
+                try:
+                    callback(video_id)
+                except Exception as e:
+                    print(f"[Storage] Callback di eviction fallita per {video_id}: {e}")
+        return evicted
+
+    async def _loop(self):
+        loop = asyncio.get_event_loop()
+        last_scan = time.monotonic()
+        while True:
+            await asyncio.sleep(STORAGE_SWEEP_SECONDS)
+            try:
+                if time.monotonic() - last_scan > STORAGE_RESCAN_SECONDS:
+                    await loop.run_in_executor(None, self.scan)
+                    last_scan = time.monotonic()
+                await self.sweep()
+            except Exception as e:
+                print(f"[Storage] Giro di eviction fallito: {e}")
+
+    def start(self, evict: bool = True):
+        """
+        Scansione iniziale + eviction periodica (startup dell'app).
+        evict=False: solo indice, per i processi che condividono le cartelle con
+        l'API (contatori d'uso e pin esistono solo nel processo che li imposta).
+        """
+        self._manage = evict
+        adopted = self.scan()
+        print(f"[Storage] {adopted} file indicizzati in {self.temp.name}/ e {self.output.name}/")
+        if evict and STORAGE_SWEEP_SECONDS > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+storage = StorageManager(
+    temp=StorageRoot("temp", Path("temp"), STORAGE_TEMP_MAX_MB * MB, STORAGE_TEMP_TTL_HOURS * 3600),
+    output=StorageRoot("output", Path("output"), RENDER_CACHE_MAX_MB * MB, RENDER_CACHE_MAX_AGE_HOURS * 3600),
+    pins_path=Path("temp") / "storage_pins.json",
+    owners_path=Path("temp") / "storage_owners.json",
+)
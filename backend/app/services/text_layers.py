@@ -0,0 +1,256 @@
+"""
+Testo dei remix pre-renderizzato con Pillow.
+
+Invece di drawtext (layout e rasterizzazione con bordo a ogni frame, più
+l'escaping di ' e : nel filtergraph) la didascalia viene disegnata una volta
+in un PNG RGBA e composta con un semplice overlay. I PNG sono salvati in
+temp/text/ con chiave (testo, font, dimensione, bordo, larghezza del video).
+
+I font vengono caricati una volta (all'avvio) e tenuti in memoria per
+dimensione. Il primo font di TEXT_FONTS è quello principale, i successivi
+sono fallback usati carattere per carattere per i glifi mancanti (es. emoji
+con Noto Color Emoji, che è un font bitmap a dimensione fissa e viene scalato).
+"""
+import asyncio
+import hashlib
+import json
+import os
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from app.services.storage import storage
+
+DEFAULT_FONTS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf",
+]
+# Font separati da virgola: il primo è il principale, gli altri fallback per glifo
+TEXT_FONTS = [f.strip() for f in os.environ.get("TEXT_FONTS", ",".join(DEFAULT_FONTS)).split(",") if f.strip()]
+# Spessore del bordo nero (px) e margine laterale per l'a capo automatico
+TEXT_BORDER = int(os.environ.get("TEXT_BORDER", "3"))
+TEXT_MARGIN = 20
+
+TEXT_DIR = Path("temp") / "text"
+
+# Incrementare se cambia il rendering (invalida i PNG e i render in cache)
+TEXT_LAYER_VERSION = 1
+
+# Dimensione dei font bitmap a dimensione fissa (Noto Color Emoji)
+BITMAP_FONT_SIZE = 109
+# Interlinea rispetto alla dimensione del font
+LINE_SPACING = 0.2
+# Codepoint non assegnato: il suo glifo è quello "mancante" (.notdef) del font
+MISSING_GLYPH = "\U0010FFFD"
+# Caratteri che non hanno un glifo proprio e seguono il font del carattere precedente
+JOINERS = {"\u200d", "\ufe0e", "\ufe0f"}
+
+
+class FontFace:
+    """Un file di font con le istanze caricate per dimensione"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = Path(path).name
+        # None = scalabile, altrimenti l'unica dimensione disponibile (bitmap)
+        self.fixed_size: Optional[int] = None
+        self._sizes: Dict[int, ImageFont.FreeTypeFont] = {}
+        self._missing: Optional[bytes] = None
+        self._has: Dict[str, bool] = {}
+        try:
+            self.font(48)
+        except OSError:
+            # I font bitmap si aprono solo alla loro dimensione
+            self.fixed_size = BITMAP_FONT_SIZE
+            self.font(48)
+
+    def font(self, size: int) -> ImageFont.FreeTypeFont:
+        size = self.fixed_size or size
+        font = self._sizes.get(size)
+        if font is None:
+            font = ImageFont.truetype(self.path, size)
+            self._sizes[size] = font
+        return font
+
+    def scale(self, size: int) -> float:
+        return size / self.fixed_size if self.fixed_size else 1.0
+
+    def has_glyph(self, char: str) -> bool:
+        """True se il font ha un glifo per char (diverso da quello mancante)"""
+        has = self._has.get(char)
+        if has is None:
+            font = self.font(48)
+            try:
+                # I font a colori si rasterizzano solo in RGBA
+                mode = "RGBA" if self.fixed_size else "L"
+                if self._missing is None:
+                    self._missing = bytes(font.getmask(MISSING_GLYPH, mode))
+                mask = font.getmask(char, mode)
+                has = mask.size != (0, 0) and bytes(mask) != self._missing
+            except (OSError, ValueError):
+                has = False
+            self._has[char] = has
+        return has
+
+
+class TextLayers:
+    """Font in memoria + cache su disco dei PNG delle didascalie"""
+
+    def __init__(self, font_paths: List[str], cache_dir: Path, border: int):
+        self.font_paths = font_paths
+        self.cache_dir = cache_dir
+        self.border = border
+        self.faces: List[FontFace] = []
+        self._loaded = False
+        self._paths: Dict[str, Path] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def load_fonts(self):
+        """Carica i font configurati (una volta sola, all'avvio o al primo testo)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        for path in self.font_paths:
+            try:
+                self.faces.append(FontFace(path))
+            except OSError as e:
+                print(f"[Text] Font non caricato {path}: {e}")
+        if self.faces:
+            print(f"[Text] Font: {', '.join(face.name for face in self.faces)}")
+        else:
+            print("[Text] Nessun font configurato disponibile, uso il font predefinito di Pillow")
+
+    @property
+    def font_id(self) -> str:
+        self.load_fonts()
+        return ",".join(face.name for face in self.faces) or "default"
+
+    def key(self, text: str, font_size: int, width: int) -> str:
+        params = [TEXT_LAYER_VERSION, text, self.font_id, font_size, self.border, width]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()[:16]
+
+    # --- Layout ----------------------------------------------------------
+
+    def _face_for(self, char: str, previous: Optional[FontFace]) -> Optional[FontFace]:
+        if char in JOINERS or char.isspace():
+            return previous or (self.faces[0] if self.faces else None)
+        for face in self.faces:
+            if face.has_glyph(char):
+                return face
+        return self.faces[0] if self.faces else None
+
+    def _runs(self, line: str) -> List[Tuple[str, Optional[FontFace]]]:
+        """Spezza una riga in tratti consecutivi con lo stesso font"""
+        runs: List[Tuple[str, Optional[FontFace]]] = []
+        for char in line:
+            face = self._face_for(char, runs[-1][1] if runs else None)
+            if runs and runs[-1][1] is face:
+                runs[-1] = (runs[-1][0] + char, face)
+            else:
+                runs.append((char, face))
+        return runs
+
+    def _font(self, face: Optional[FontFace], size: int):
+        return face.font(size) if face else ImageFont.load_default(size)
+
+    def _measure(self, line: str, size: int) -> float:
+        return sum(
+            self._font(face, size).getlength(run) * (face.scale(size) if face else 1.0)
+            for run, face in self._runs(line)
+        )
+
+    def wrap(self, text: str, size: int, max_width: float) -> List[str]:
+        """Righe esplicite (\\n) + a capo automatico sulle parole oltre max_width"""
+        lines = []
+        for paragraph in text.replace("\r\n", "\n").split("\n"):
+            line = ""
+            for word in paragraph.split(" "):
+                candidate = f"{line} {word}" if line else word
+                if line and self._measure(candidate, size) > max_width:
+                    lines.append(line.rstrip())
+                    line = word
+                else:
+                    line = candidate
+            lines.append(line.rstrip())
+        return lines
+
+    # --- Rendering -------------------------------------------------------
+
+    def _draw_run(self, canvas: Image.Image, run: str, face: Optional[FontFace], size: int,
+                  x: float, baseline: float):
+        font = self._font(face, size)
+        scale = face.scale(size) if face else 1.0
+        if scale == 1.0:
+            ImageDraw.Draw(canvas).text(
+                (x, baseline), run, font=font, anchor="ls", fill="white", embedded_color=True,
+                stroke_width=self.border, stroke_fill="black"
+            )
+            return
+        # Font bitmap: disegnato alla sua dimensione e scalato (niente bordo sui glifi a colori)
+        ascent, descent = font.getmetrics()
+        run_image = Image.new("RGBA", (max(1, int(font.getlength(run)) + 1), ascent + descent), (0, 0, 0, 0))
+        ImageDraw.Draw(run_image).text((0, ascent), run, font=font, anchor="ls", fill="white", embedded_color=True)
+        scaled = run_image.resize(
+            (max(1, round(run_image.width * scale)), max(1, round(run_image.height * scale))), Image.LANCZOS
+        )
+        canvas.alpha_composite(scaled, (round(x), max(0, round(baseline - ascent * scale))))
+
+    def render_png(self, text: str, font_size: int, width: int) -> bytes:
+        """PNG RGBA della didascalia (righe centrate, bordo nero), bloccante"""
+        self.load_fonts()
+        lines = self.wrap(text, font_size, max(font_size, width - 2 * TEXT_MARGIN))
+        primary = self._font(self.faces[0] if self.faces else None, font_size)
+        ascent, descent = primary.getmetrics()
+        line_height = ascent + descent + round(font_size * LINE_SPACING)
+        widths = [self._measure(line, font_size) for line in lines]
+        pad = self.border + 1
+        canvas = Image.new(
+            "RGBA",
+            (max(1, int(max(widths)) + 2 * pad), max(1, line_height * len(lines) - round(font_size * LINE_SPACING) + 2 * pad)),
+            (0, 0, 0, 0)
+        )
+        for i, (line, line_width) in enumerate(zip(lines, widths)):
+            x = pad + (canvas.width - 2 * pad - line_width) / 2
+            baseline = pad + i * line_height + ascent
+            for run, face in self._runs(line):
+                self._draw_run(canvas, run, face, font_size, x, baseline)
+                x += self._font(face, font_size).getlength(run) * (face.scale(font_size) if face else 1.0)
+        buffer = BytesIO()
+        canvas.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def render(self, text: str, font_size: int, width: int) -> Path:
+        """Path del PNG della didascalia in cache, renderizzato se manca (bloccante)"""
+        key = self.key(text, font_size, width)
+        path = self._paths.get(key)
+        if path is not None and path.exists():
+            storage.touch(path)
+            return path
+        path = self.cache_dir / f"{key}.png"
+        if path.exists():
+            storage.touch(path)
+        else:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            part_path = path.with_name(f"part_{path.name}")
+            part_path.write_bytes(self.render_png(text, font_size, width))
+            os.replace(part_path, path)
+            storage.register(path)
+            print(f"[Text] Layer {key} renderizzato ({len(text)} caratteri, {font_size}px, larghezza {width})")
+        self._paths[key] = path
+        return path
+
+    async def ensure(self, text: str, font_size: int, width: int) -> Path:
+        """render() fuori dal loop; richieste concorrenti per lo stesso testo condivise"""
+        key = self.key(text, font_size, width)
+        pending = self._pending.get(key)
+        if pending is None:
+            loop = asyncio.get_event_loop()
+            pending = asyncio.ensure_future(loop.run_in_executor(None, self.render, text, font_size, width))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+
+text_layers = TextLayers(TEXT_FONTS, TEXT_DIR, TEXT_BORDER)
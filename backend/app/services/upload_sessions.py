@@ -0,0 +1,290 @@
+"""
+Upload riprendibili a chunk per i video sorgente.
+
+Il client crea una sessione dichiarando la dimensione, poi invia i chunk con
+PUT ?offset=N (anche in parallelo e fuori ordine) e infine la chiude.
+I chunk vengono scritti direttamente alla loro posizione in un unico file
+preallocato, quindi alla chiusura basta un rename in temp/, senza copie.
+Gli intervalli ricevuti sono salvati su disco: dopo una connessione caduta
+(o un riavvio) il client chiede cosa manca e riprende da lì.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import aiofiles
+from fastapi import HTTPException
+
+from app.services.uploads import MB, MAX_VIDEO_UPLOAD_MB, too_large
+
+UPLOAD_SESSION_TTL_HOURS = float(os.environ.get("UPLOAD_SESSION_TTL_HOURS", "6"))
+UPLOAD_SESSION_CHUNK_MB = int(os.environ.get("UPLOAD_SESSION_CHUNK_MB", "8"))
+UPLOAD_SESSION_MAX_CHUNK_MB = int(os.environ.get("UPLOAD_SESSION_MAX_CHUNK_MB", "64"))
+
+SESSIONS_DIR = Path("temp") / "uploads"
+
+# Secondi tra due passate di pulizia delle sessioni scadute
+GC_INTERVAL = 600
+HASH_READ_SIZE = 4 * MB
+
+
+def merge_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """Aggiunge [start, end) a una lista ordinata di intervalli disgiunti"""
+    if end <= start:
+        return ranges
+    merged = []
+    for r_start, r_end in ranges:
+        if r_end < start or r_start > end:
+            merged.append([r_start, r_end])
+        else:
+            start, end = min(start, r_start), max(end, r_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+
+def missing_ranges(ranges: List[List[int]], size: int) -> List[List[int]]:
+    missing = []
+    cursor = 0
+    for start, end in ranges:
+        if start > cursor:
+            missing.append([cursor, start])
+        cursor = max(cursor, end)
+    if cursor < size:
+        missing.append([cursor, size])
+    return missing
+
+
+class UploadSession:
+    def __init__(self, session_id: str, filename: str, size: int, sha256: Optional[str] = None,
+                 ranges: Optional[List[List[int]]] = None, created_at: Optional[float] = None,
+                 updated_at: Optional[float] = None):
+        self.id = session_id
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256.lower() if sha256 else None
+        self.ranges = ranges or []
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+        # Chunk in scrittura: la sessione non si chiude finché non finiscono
+        self.writers = 0
+        # Chiusura in corso (verifica e rename): un solo complete per sessione
+        self.finalizing = False
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def complete(self) -> bool:
+        return self.ranges == [[0, self.size]]
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "received": self.received,
+            "complete": self.complete,
+            "ranges": self.ranges,
+            "missing": missing_ranges(self.ranges, self.size),
+            "chunk_size": UPLOAD_SESSION_CHUNK_MB * MB,
+            "expires_at": self.updated_at + UPLOAD_SESSION_TTL_HOURS * 3600,
+        }
+
+    def to_state(self) -> dict:
+        return {
+            "id": self.id, "filename": self.filename, "size": self.size, "sha256": self.sha256,
+            "ranges": self.ranges, "created_at": self.created_at, "updated_at": self.updated_at,
+        }
+
+
+class UploadSessionStore:
+    """Sessioni di upload con stato in directory/<id>.json e dati in directory/<id>.part"""
+
+    def __init__(self, directory: Path, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self._sessions: Dict[str, UploadSession] = {}
+        self._loaded = False
+        self._task: Optional[asyncio.Task] = None
+
+    def data_path(self, session_id: str) -> Path:
+        return self.directory / f"{session_id}.part"
+
+    def _state_path(self, session_id: str) -> Path:
+        return self.directory / f"{session_id}.json"
+
+    def _load(self):
+        """Riprende le sessioni rimaste su disco (es. dopo un riavvio)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.directory.exists():
+            return
+        for state_path in self.directory.glob("*.json"):
+            try:
+                state = json.loads(state_path.read_text())
+                session = UploadSession(state["id"], state["filename"], state["size"], state.get("sha256"),
+                                        state.get("ranges"), state.get("created_at"), state.get("updated_at"))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[Uploads] Sessione illeggibile {state_path.name}: {e}")
+                continue
+            if self.data_path(session.id).exists():
+                self._sessions[session.id] = session
+
+    def _save(self, session: UploadSession):
+        tmp = self._state_path(session.id).with_suffix(".tmp")
+        tmp.write_text(json.dumps(session.to_state()))
+        os.replace(tmp, self._state_path(session.id))
+
+    def create(self, filename: str, size: int, sha256: Optional[str] = None) -> UploadSession:
+        self._load()
+        max_bytes = MAX_VIDEO_UPLOAD_MB * MB
+        if size <= 0:
+            raise HTTPException(status_code=400, detail="Dimensione non valida")
+        if size > max_bytes:
+            raise too_large(max_bytes)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        session = UploadSession(uuid.uuid4().hex, filename, size, sha256)
+        # File sparso della dimensione finale: ogni chunk va direttamente al suo offset
+        with open(self.data_path(session.id), "wb") as f:
+            f.truncate(size)
+        self._sessions[session.id] = session
+        self._save(session)
+        print(f"[Uploads] Sessione {session.id[:8]} creata: {filename} ({size / MB:.1f} MB)")
+        return session
+
+    def get(self, session_id: str) -> UploadSession:
+        self._load()
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Sessione di upload non trovata o scaduta")
+        return session
+
+    async def write_chunk(self, session_id: str, offset: int, chunks: AsyncIterator[bytes]) -> UploadSession:
+        """
+        Scrive il body di un PUT a partire da offset mentre arriva.
+        Anche se la connessione cade a metà, i byte scritti restano registrati.
+        """
+        session = self.get(session_id)
+        if session.finalizing:
+            raise HTTPException(status_code=409, detail="Upload in chiusura")
+        if offset < 0 or offset >= session.size:
+            raise HTTPException(status_code=416, detail=f"Offset fuori dal file (0-{session.size - 1})")
+        max_chunk = UPLOAD_SESSION_MAX_CHUNK_MB * MB
+        position = offset
+        session.writers += 1
+        try:
+            async with aiofiles.open(self.data_path(session_id), "r+b") as out:
+                await out.seek(offset)
+                async for data in chunks:
+                    if not data:
+                        continue
+                    if position + len(data) > session.size:
+                        raise HTTPException(status_code=416, detail="Il chunk va oltre la dimensione dichiarata")
+                    if position + len(data) - offset > max_chunk:
+                        raise too_large(max_chunk)
+                    await out.write(data)
+                    position += len(data)
+        finally:
+            session.writers -= 1
+            if position > offset:
+                session.ranges = merge_range(session.ranges, offset, position)
+                session.updated_at = time.time()
+                self._save(session)
+        return session
+
+    def _hash(self, path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    async def finalize(self, session_id: str) -> Tuple[Path, str, UploadSession]:
+        """
+        Verifica che il file sia completo (ed eventualmente lo sha256 dichiarato).
+        Ritorna (file dati, sha256, sessione): il chiamante lo sposta con un rename
+        e poi chiama discard(). Un complete concorrente della stessa sessione
+        riceve 409 finché la chiusura non finisce.
+        """
+        session = self.get(session_id)
+        if session.finalizing:
+            raise HTTPException(status_code=409, detail="Upload già in chiusura")
+        if session.writers:
+            raise HTTPException(status_code=409, detail="Chunk ancora in scrittura")
+        if not session.complete:
+            raise HTTPException(status_code=409, detail={
+                "message": "Upload incompleto",
+                "missing": missing_ranges(session.ranges, session.size),
+            })
+        # Controllo e marcatura senza await in mezzo: nessun altro complete può passare
+        session.finalizing = True
+        try:
+            data_path = self.data_path(session_id)
+            loop = asyncio.get_event_loop()
+            digest = await loop.run_in_executor(None, self._hash, data_path)
+            if session.sha256 and digest != session.sha256:
+                # Contenuto corrotto: si riparte da zero con la stessa sessione
+                session.ranges = []
+                self._save(session)
+                raise HTTPException(status_code=422, detail="sha256 non corrispondente, ricarica il file")
+        except BaseException:
+            session.finalizing = False
+            raise
+        return data_path, digest, session
+
+    def discard(self, session_id: str):
+        """Elimina stato e dati di una sessione (chiusa, annullata o scaduta)"""
+        self._sessions.pop(session_id, None)
+        for path in (self.data_path(session_id), self._state_path(session_id)):
+            path.unlink(missing_ok=True)
+
+    def collect_expired(self) -> int:
+        """Rimuove le sessioni ferme da più di ttl secondi, e i file orfani"""
+        self._load()
+        now = time.time()
+        expired = [
+            s.id for s in self._sessions.values()
+            if not s.writers and not s.finalizing and now - s.updated_at > self.ttl
+        ]
+        for session_id in expired:
+            self.discard(session_id)
+        if self.directory.exists():
+            for path in self.directory.iterdir():
+                session_id = path.name.split(".")[0]
+                if session_id not in self._sessions and now - path.stat().st_mtime > self.ttl:
+                    path.unlink(missing_ok=True)
+                    expired.append(session_id)
+        if expired:
+            print(f"[Uploads] Rimosse {len(expired)} sessioni di upload scadute")
+        return len(expired)
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(GC_INTERVAL)
+            try:
+                self.collect_expired()
+            except Exception as e:
+                print(f"[Uploads] Pulizia sessioni fallita: {e}")
+
+    def start(self):
+        """Pulizia iniziale + periodica delle sessioni scadute (startup dell'app)"""
+        self.collect_expired()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._gc_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+upload_sessions = UploadSessionStore(SESSIONS_DIR, UPLOAD_SESSION_TTL_HOURS * 3600)
@@ -0,0 +1,183 @@
+"""
+Upload in streaming e content-addressed.
+
+I file caricati vengono copiati a chunk con aiofiles (niente copyfileobj
+bloccante nel loop), con sha256 calcolato al volo, e salvati con il nome
+derivato dall'hash: ricaricare lo stesso file non occupa altro disco e
+restituisce lo stesso id. Il nome originale resta come metadato.
+
+UploadSizeLimit è un middleware ASGI che rifiuta con 413 le richieste che
+superano il limite mentre il body arriva (Content-Length o byte contati),
+prima che il multipart venga scritto tutto su disco.
+"""
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import aiofiles
+from fastapi import HTTPException, UploadFile
+
+MB = 1024 * 1024
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_KB", "1024")) * 1024
+MAX_OVERLAY_UPLOAD_MB = int(os.environ.get("MAX_OVERLAY_UPLOAD_MB", "200"))
+MAX_AUDIO_UPLOAD_MB = int(os.environ.get("MAX_AUDIO_UPLOAD_MB", "50"))
+MAX_VIDEO_UPLOAD_MB = int(os.environ.get("MAX_VIDEO_UPLOAD_MB", "500"))
+
+# Margine sul limite del body per boundary e header del multipart
+MULTIPART_OVERHEAD = MB
+
+# Lunghezza del prefisso dell'hash usato come nome file / id
+HASH_NAME_LENGTH = 16
+
+
+def too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"File troppo grande (massimo {max_bytes // MB} MB)")
+
+
+async def stream_upload(upload: UploadFile, directory: Path, max_bytes: int) -> Tuple[Path, str, int]:
+    """
+    Copia l'upload a chunk in un file temporaneo nascosto di directory.
+    Ritorna (file temporaneo, sha256, dimensione); 413 appena si supera max_bytes.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    part_path = directory / f".upload_{uuid.uuid4().hex[:12]}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(part_path, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise too_large(max_bytes)
+                digest.update(chunk)
+                await out.write(chunk)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    if size == 0:
+        part_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="File vuoto")
+    return part_path, digest.hexdigest(), size
+
+
+async def store_content_addressed(upload: UploadFile, directory: Path, ext: str, max_bytes: int) -> Tuple[Path, str, bool]:
+    """
+    Salva l'upload come directory/<hash><ext>. Ritorna (path, sha256, creato):
+    creato=False se lo stesso contenuto c'era già (il temporaneo viene scartato).
+    """
+    part_path, digest, _ = await stream_upload(upload, directory, max_bytes)
+    final_path = directory / f"{digest[:HASH_NAME_LENGTH]}{ext}"
+    if final_path.exists():
+        part_path.unlink(missing_ok=True)
+        return final_path, digest, False
+    os.replace(part_path, final_path)
+    return final_path, digest, True
+
+
+class NameStore:
+    """Nomi originali dei file content-addressed (directory/.names.json)"""
+
+    def __init__(self, directory: Path):
+        self.path = directory / ".names.json"
+        self._names: Optional[Dict[str, str]] = None
+
+    def _load(self) -> Dict[str, str]:
+        if self._names is None:
+            try:
+                self._names = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self._names = {}
+        return self._names
+
+    def get(self, stored_name: str) -> Optional[str]:
+        return self._load().get(stored_name)
+
+    def set(self, stored_name: str, original_name: str):
+        names = self._load()
+        if names.get(stored_name) == original_name:
+            return
+        names[stored_name] = original_name
+        self._save()
+
+    def remove(self, stored_name: str):
+        if self._load().pop(stored_name, None) is not None:
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._names))
+        os.replace(tmp, self.path)
+
+
+class UploadSizeLimit:
+    """Middleware ASGI: 413 se il body di un upload supera il limite (+ overhead multipart) del suo path"""
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        max_bytes = self.limits.get(scope.get("path", "")) if scope["type"] == "http" else None
+        if not max_bytes:
+            await self.app(scope, receive, send)
+            return
+        limit = max_bytes + MULTIPART_OVERHEAD
+
+        headers = dict(scope.get("headers") or [])
+        try:
+            declared = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            declared = 0
+        if declared > limit:
+            await self._reject(send, max_bytes)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        class _TooLarge(Exception):
+            pass
+
+        async def _receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise _TooLarge()
+            return message
+
+        async def _send(message):
+            nonlocal response_started
+            if exceeded:
+                # La risposta d'errore dell'app (body non leggibile) viene sostituita dal 413
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, _receive, _send)
+        except _TooLarge:
+            pass
+        if exceeded and not response_started:
+            await self._reject(send, max_bytes)
+
+    async def _reject(self, send, max_bytes: int):
+        body = json.dumps({"detail": too_large(max_bytes).detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,182 @@
+"""
+Worker dei render: esegue i remix messi in coda dall'API su un altro
+processo o un'altra macchina.
+
+Prende i job dal broker (RENDER_BROKER=sqlite sullo stesso host, http verso
+l'API), porta in locale sorgente e asset (WORKER_SHARED_STORAGE), esegue la
+stessa pipeline del render locale e pubblica l'output nella cache dei
+render dell'API. Durante il render invia heartbeat con l'avanzamento: se il
+worker muore il job torna in coda, se l'API annulla il job il render viene
+interrotto.
+
+Uso (dalla cartella backend/):
+    RENDER_BROKER=sqlite python -m app.worker
+    RENDER_BROKER=http RENDER_BROKER_URL=http://api:8000 RENDER_BROKER_TOKEN=... python -m app.worker
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+from app.routers.process import render_remix, ProcessRequest, ProcessResponse, RENDER_WORKERS
+from app.services.asset_catalog import asset_catalog
+from app.services.jobs import Job, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+from app.services.render_broker import (
+    QueueBackend, BrokerError, render_broker, WORKER_HEARTBEAT_SECONDS,
+)
+from app.services.render_cache import render_cache
+from app.services.resources import RENDER_CPUS
+from app.services.shared_files import SharedFiles, create_shared_files
+from app.services.storage import storage
+from app.services.text_layers import text_layers
+
+# Attesa (secondi) tra due richieste al broker quando la coda è vuota
+WORKER_POLL_SECONDS = float(os.environ.get("WORKER_POLL_SECONDS", "2"))
+# Render contemporanei su questo worker
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", str(RENDER_WORKERS)))
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class RenderWorker:
+    """Slot di render che prendono job dal broker finché il processo non viene fermato"""
+
+    def __init__(self, broker: QueueBackend, files: SharedFiles, worker_id: str, concurrency: int):
+        self.broker = broker
+        self.files = files
+        self.worker_id = worker_id
+        self.concurrency = max(1, concurrency)
+        self.info = {"host": socket.gethostname(), "pid": os.getpid(), "slots": self.concurrency, "cpus": RENDER_CPUS}
+
+    async def run(self):
+        print(f"[Worker] {self.worker_id}: broker {self.broker.name}, storage {self.files.name}, "
+              f"{self.concurrency} render alla volta")
+        self.broker.start()
+        try:
+            await asyncio.gather(*(self._slot() for _ in range(self.concurrency)))
+        finally:
+            await self.broker.stop()
+            await self.files.close()
+
+    async def _slot(self):
+        while True:
+            try:
+                claimed = await self.broker.claim(self.worker_id, self.info)
+            except BrokerError as e:
+                print(f"[Worker] {e}")
+                claimed = None
+            if claimed is None:
+                await asyncio.sleep(WORKER_POLL_SECONDS)
+                continue
+            await self.execute(claimed)
+
+    async def execute(self, claimed: dict):
+        """Esegue un job del broker e ne riporta l'esito"""
+        payload = claimed["payload"]
+        request = ProcessRequest(**payload["request"])
+        job = Job(claimed["kind"], runner=None, priority=claimed["priority"], payload=request)
+        job.id = claimed["id"]
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        print(f"[Worker] Job {job.id} (tentativo {claimed['attempts']}): remix di {request.video_id}")
+
+        render = asyncio.create_task(self._render(job, request, payload))
+        job._task = render
+        beat = asyncio.create_task(self._heartbeat(job, render))
+        status, result, error = JOB_DONE, None, None
+        try:
+            result = jsonable_encoder(await render)
+        except asyncio.CancelledError:
+            if not job.cancel_requested:
+                # Worker in arresto: il job tornerà in coda quando scade l'heartbeat
+                raise
+            status = JOB_CANCELLED
+        except Exception as e:
+            # HTTPException espone il messaggio in .detail
+            error = str(getattr(e, "detail", None) or e)
+            status = JOB_CANCELLED if job.cancel_requested else JOB_FAILED
+        finally:
+            beat.cancel()
+            await asyncio.gather(beat, return_exceptions=True)
+
+        try:
+            accepted = await self.broker.finish(job.id, self.worker_id, status, result, error)
+        except BrokerError as e:
+            print(f"[Worker] Job {job.id}: esito non inviato ({e}), tornerà in coda")
+            return
+        outcome = status if accepted else f"{status} (ignorato: job riassegnato o annullato)"
+        print(f"[Worker] Job {job.id} {outcome}" + (f": {error}" if error else ""))
+
+    async def _render(self, job: Job, request: ProcessRequest, payload: dict) -> ProcessResponse:
+        cache_key = payload["cache_key"]
+        await self.files.fetch(payload["inputs"])
+        cached_path = render_cache.lookup(cache_key)
+        if cached_path is None:
+            response = await render_remix(request, job, cache_key)
+        else:
+            # Già renderizzato da questo worker (es. tentativo precedente con upload fallito)
+            response = ProcessResponse(
+                success=True,
+                output_filename=cached_path.name,
+                output_url=f"/output/{cached_path.name}",
+                message="Video processato con successo!"
+            )
+        await self.files.publish(job.id, self.worker_id, cache_key)
+        return response
+
+    async def _heartbeat(self, job: Job, render: asyncio.Task):
+        """Avanzamento al broker; interrompe il render se il job è annullato o riassegnato"""
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+            try:
+                state = await self.broker.heartbeat(self.worker_id, job.id, job.progress, self.info)
+            except BrokerError as e:
+                print(f"[Worker] Heartbeat del job {job.id} non inviato: {e}")
+                continue
+            if state["cancel"] or not state["owned"]:
+                reason = "annullato" if state["cancel"] else "riassegnato a un altro worker"
+                print(f"[Worker] Job {job.id} {reason}, interrompo il render")
+                job.cancel_requested = True
+                if job.process is not None and job.process.poll() is None:
+                    job.process.kill()
+                render.cancel()
+                return
+
+
+async def serve(worker_id: str, concurrency: int):
+    if render_broker is None:
+        raise SystemExit("RENDER_BROKER non impostato (sqlite o http)")
+    for dir_path in [Path("temp"), Path("output"), Path("assets") / "overlays", Path("assets") / "audio"]:
+        dir_path.mkdir(parents=True, exist_ok=True)
+    files = create_shared_files()
+    # Con lo storage local le cartelle sono quelle dell'API: l'eviction la fa solo l'API
+    storage.start(evict=files.name != "local")
+    asset_catalog.start()
+    text_layers.load_fonts()
+    worker = RenderWorker(render_broker, files, worker_id, concurrency)
+    try:
+        await worker.run()
+    finally:
+        await asset_catalog.stop()
+        await storage.stop()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Worker dei render (coda condivisa RENDER_BROKER)")
+    parser.add_argument("--id", default=WORKER_ID, help="identificativo del worker nel broker")
+    parser.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY, help="render contemporanei")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.id, args.concurrency))
+    except KeyboardInterrupt:
+        print("[Worker] Arresto")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Stand-in locale dell'API remove.bg per load test e CI senza rete.
+
+Espone POST /v1.0/removebg con la stessa interfaccia usata dal backend
+(multipart image_file, header X-Api-Key, PNG in risposta, errori JSON
+{"errors": [{"title": ...}]}) e rimuove lo sfondo con lo stesso chroma key
+del provider "local". La latenza simulata e il limite di richieste
+contemporanee permettono di verificare pool di connessioni e concorrenza.
+
+Uso (dalla cartella backend/):
+    python -m benchmarks.removebg_standin --port 8100 --latency 0.5
+    REMOVEBG_API_URL=http://127.0.0.1:8100/v1.0/removebg REMOVEBG_API_KEY=test uvicorn app.main:app
+"""
+import argparse
+import asyncio
+import sys
+from typing import List, Optional
+
+from fastapi import FastAPI, File, Header, UploadFile
+from fastapi.responses import JSONResponse, Response
+
+from app.services.bg_removal import chroma_cutout
+
+
+def error(status_code: int, title: str) -> JSONResponse:
+    return JSONResponse(status_code=status_code, content={"errors": [{"title": title}]})
+
+
+def create_app(latency: float = 0.0, max_concurrent: int = 0, api_key: Optional[str] = None) -> FastAPI:
+    """
+    latency: secondi di attesa per richiesta; max_concurrent: oltre questo numero
+    di richieste in corso risponde 429 (0 = nessun limite); api_key: chiave
+    accettata (None = qualunque chiave non vuota).
+    """
+    app = FastAPI(title="remove.bg stand-in")
+    stats = {"requests": 0, "in_flight": 0, "peak_in_flight": 0, "rejected": 0}
+
+    @app.post("/v1.0/removebg")
+    async def removebg(image_file: UploadFile = File(...), x_api_key: str = Header("")):
+        if not x_api_key or (api_key is not None and x_api_key != api_key):
+            return error(403, "API Key invalid")
+        if max_concurrent and stats["in_flight"] >= max_concurrent:
+            stats["rejected"] += 1
+            return error(429, "Rate limit exceeded")
+
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        try:
+            if latency:
+                await asyncio.sleep(latency)
+            data = await image_file.read()
+            loop = asyncio.get_event_loop()
+            try:
+                output = await loop.run_in_executor(None, chroma_cutout, data)
+            except Exception as e:
+                return error(400, f"Immagine non valida: {e}")
+            return Response(content=output, media_type="image/png")
+        finally:
+            stats["in_flight"] -= 1
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Stand-in locale dell'API remove.bg")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.0, help="latenza simulata per richiesta (secondi)")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="richieste contemporanee prima del 429 (0 = illimitate)")
+    parser.add_argument("--api-key", help="unica chiave accettata (default: qualunque)")
+    args = parser.parse_args(argv)
+
+    uvicorn.run(create_app(args.latency, args.max_concurrent, args.api_key), host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+Benchmark riproducibile della pipeline di remix.
+
+Genera sorgenti e overlay sintetici deterministici con le sorgenti lavfi di
+FFmpeg (video di test, overlay green screen / sfondo nero / alpha / PNG,
+traccia audio), esegue una matrice di ProcessRequest con il vero costruttore
+del comando (build_remix_command) e registra tempo, fps di encode, RSS di
+picco e dimensione dell'output in JSON, confrontandoli con una baseline.
+
+Uso (dalla cartella backend/):
+    python -m benchmarks.render_bench --quick
+    python -m benchmarks.render_bench --save-baseline
+    python -m benchmarks.render_bench --baseline benchmarks/baseline.json --fail-on-regression
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.routers.process import ProcessRequest, OverlayItem, build_remix_command
+from app.services.ffmpeg import FFMPEG_PATH, run_with_progress
+from app.services.resources import get_profile
+from app.services.asset_catalog import asset_catalog
+
+BENCH_DIR = Path("temp") / "bench"
+RESULTS_PATH = Path("benchmarks") / "results" / "latest.json"
+BASELINE_PATH = Path("benchmarks") / "baseline.json"
+
+# Sorgenti: (nome, larghezza, altezza, durata in secondi)
+SOURCES = [
+    ("720p_5s", 720, 1280, 5),
+    ("1080p_5s", 1080, 1920, 5),
+    ("1080p_15s", 1080, 1920, 15),
+]
+QUICK_SOURCES = ["720p_5s"]
+SOURCE_FPS = 30
+
+# Overlay sintetici: (id, filtro lavfi, estensione, argomenti di encode)
+OVERLAYS = [
+    ("bench_green", "color=c=0x00FF00:s=400x400:r=30,drawbox=x=100:y=100:w=200:h=200:c=red:t=fill",
+     ".mp4", ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"]),
+    ("bench_black", "color=c=black:s=400x400:r=30,drawbox=x=120:y=120:w=160:h=160:c=white:t=fill",
+     ".mp4", ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"]),
+    ("bench_alpha", "testsrc2=s=400x400:r=30,format=rgba,colorchannelmixer=aa=0.5",
+     ".mov", ["-c:v", "qtrle", "-pix_fmt", "argb"]),
+]
+PNG_OVERLAY = ("bench_logo", "testsrc2=s=300x300,format=rgba,colorchannelmixer=aa=0.8")
+AUDIO_ID = "bench_audio.m4a"
+
+# Overlay usati dai casi con N overlay, nell'ordine
+OVERLAY_SEQUENCE = [
+    OverlayItem(id="bench_green", x=10, y=10, scale=0.3),
+    OverlayItem(id="bench_alpha", x=60, y=10, scale=0.25, remove_green_screen=False),
+    OverlayItem(id="bench_black", x=10, y=60, scale=0.3, remove_green_screen=False, remove_black_screen=True),
+    OverlayItem(id="bench_logo", x=60, y=60, scale=0.2, remove_green_screen=False),
+    OverlayItem(id="bench_green", x=35, y=35, scale=0.4),
+]
+
+
+def build_cases() -> Dict[str, dict]:
+    """Matrice di forme di ProcessRequest (campi oltre a video_id)"""
+    cases = {
+        "plain": {},
+        "trim": {"trim_start": 1.0, "trim_end": 4.0},
+        "speed": {"playback_speed": 1.5},
+        "eq": {"brightness": 10, "contrast": 15, "saturation": 20},
+        "text": {"text_overlay": "Benchmark: remix", "text_font_size": 64},
+        "audio_swap": {"audio_id": AUDIO_ID},
+    }
+    for count in range(1, len(OVERLAY_SEQUENCE) + 1):
+        cases[f"overlays_{count}"] = {"overlays": OVERLAY_SEQUENCE[:count]}
+    cases["full"] = {
+        "overlays": OVERLAY_SEQUENCE[:3],
+        "text_overlay": "Benchmark: remix",
+        "brightness": 10,
+        "contrast": 15,
+        "playback_speed": 1.25,
+        "trim_start": 0.5,
+        "trim_end": 4.5,
+        "audio_id": AUDIO_ID,
+    }
+    return cases
+
+
+QUICK_CASES = ["plain", "trim", "eq", "text", "overlays_1", "overlays_3", "full"]
+
+
+def run_quiet(cmd: List[str]):
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"FFmpeg error: {result.stderr[-2000:]}")
+
+
+def lavfi_cmd(graph: str, duration: Optional[float], output: Path, encode_args: List[str]) -> List[str]:
+    cmd = [FFMPEG_PATH, "-y", "-v", "error", "-f", "lavfi", "-i", graph]
+    if duration:
+        cmd.extend(["-t", str(duration)])
+    # bitexact: stessi byte a ogni generazione
+    return cmd + ["-fflags", "+bitexact", "-flags:v", "+bitexact"] + encode_args + [str(output)]
+
+
+def generate_media(sources: List[tuple], regenerate: bool = False) -> Dict[str, Path]:
+    """Crea (una volta) sorgenti, overlay e audio sintetici in temp/bench"""
+    overlays_dir = BENCH_DIR / "assets" / "overlays"
+    audio_dir = BENCH_DIR / "assets" / "audio"
+    for dir_path in (BENCH_DIR / "sources", overlays_dir, audio_dir):
+        dir_path.mkdir(parents=True, exist_ok=True)
+    max_duration = max(duration for _, _, _, duration in sources)
+
+    def _make(output: Path, cmd: List[str]):
+        if regenerate or not output.exists():
+            print(f"[Bench] Genero {output}")
+            run_quiet(cmd)
+        if not output.exists():
+            # Senza il file il costruttore salterebbe overlay/audio e il caso non sarebbe quello atteso
+            raise RuntimeError(f"Media sintetico non generato: {output}")
+
+    paths = {}
+    for name, width, height, duration in sources:
+        path = BENCH_DIR / "sources" / f"{name}.mp4"
+        cmd = [FFMPEG_PATH, "-y", "-v", "error",
+               "-f", "lavfi", "-i", f"testsrc2=s={width}x{height}:r={SOURCE_FPS}",
+               "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+               "-t", str(duration), "-fflags", "+bitexact", "-flags:v", "+bitexact",
+               "-c:v", "libx264", "-preset", "ultrafast", "-g", str(SOURCE_FPS * 2), "-pix_fmt", "yuv420p",
+               "-c:a", "aac", "-b:a", "96k", "-shortest", str(path)]
+        _make(path, cmd)
+        paths[name] = path
+
+    for overlay_id, graph, ext, encode_args in OVERLAYS:
+        _make(overlays_dir / f"{overlay_id}{ext}", lavfi_cmd(graph, max_duration, overlays_dir / f"{overlay_id}{ext}", encode_args))
+    png_id, png_graph = PNG_OVERLAY
+    _make(overlays_dir / f"{png_id}.png", lavfi_cmd(png_graph, None, overlays_dir / f"{png_id}.png", ["-frames:v", "1"]))
+    _make(audio_dir / AUDIO_ID, lavfi_cmd("sine=frequency=660:sample_rate=44100", max_duration,
+                                          audio_dir / AUDIO_ID, ["-c:a", "aac", "-b:a", "96k"]))
+    return paths
+
+
+def run_case(cmd: List[str], output: Path) -> dict:
+    """Esegue un comando con il runner della pipeline e misura tempo, fps, CPU e RSS"""
+    peak = {"frame": 0}
+    usage = {}
+
+    def _on_progress(progress: dict):
+        peak["frame"] = progress.get("frame") or peak["frame"]
+
+    output.unlink(missing_ok=True)
+    started = time.perf_counter()
+    returncode, stderr_tail, stalled = run_with_progress(cmd, _on_progress, on_usage=usage.update)
+    wall = time.perf_counter() - started
+
+    if returncode != 0 or stalled:
+        return {"returncode": returncode, "error": stderr_tail[-2000:]}
+    return {
+        "returncode": 0,
+        "wall_seconds": round(wall, 3),
+        "frames": peak["frame"],
+        "encode_fps": round(peak["frame"] / wall, 2) if wall > 0 else None,
+        "user_seconds": round(usage["user"], 3) if "user" in usage else None,
+        "sys_seconds": round(usage["sys"], 3) if "sys" in usage else None,
+        "peak_rss_mb": round(usage["max_rss"] / (1024 * 1024), 1) if usage.get("max_rss") else None,
+        "output_bytes": output.stat().st_size if output.exists() else None,
+    }
+
+
+def ffmpeg_version() -> Optional[str]:
+    try:
+        out = subprocess.run([FFMPEG_PATH, "-version"], capture_output=True, text=True).stdout
+        return out.splitlines()[0] if out else None
+    except OSError:
+        return None
+
+
+def run_benchmark(source_names: List[str], case_names: List[str], repeat: int, profile_name: Optional[str],
+                  regenerate: bool) -> dict:
+    sources = [s for s in SOURCES if s[0] in source_names]
+    source_paths = generate_media(sources, regenerate)
+    # Gli overlay e l'audio vengono risolti dal costruttore del comando tramite il catalogo
+    asset_catalog.reset(BENCH_DIR / "assets")
+    profile = get_profile(profile_name) if profile_name else None
+    cases = build_cases()
+    output_dir = BENCH_DIR / "out"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    for name, width, height, duration in sources:
+        for case_name in case_names:
+            request = ProcessRequest(video_id=name, **cases[case_name])
+            output = output_dir / f"{name}__{case_name}.mp4"
+            cmd = build_remix_command(request, source_paths[name], output, width, height, None, profile)
+            runs = [run_case(cmd, output) for _ in range(repeat)]
+            failed = next((r for r in runs if r["returncode"] != 0), None)
+            entry = {"id": f"{name}/{case_name}", "source": name, "case": case_name,
+                     "width": width, "height": height, "duration": duration, "command": cmd}
+            if failed:
+                entry.update(failed)
+                print(f"[Bench] {entry['id']}: ERRORE {failed['error'][-300:]}")
+            else:
+                # Mediana delle ripetizioni per il tempo, massimo per la memoria
+                entry.update(runs[-1])
+                entry["wall_seconds"] = round(statistics.median(r["wall_seconds"] for r in runs), 3)
+                entry["encode_fps"] = round(entry["frames"] / entry["wall_seconds"], 2) if entry["wall_seconds"] else None
+                rss = [r["peak_rss_mb"] for r in runs if r["peak_rss_mb"] is not None]
+                entry["peak_rss_mb"] = max(rss) if rss else None
+                print(f"[Bench] {entry['id']}: {entry['wall_seconds']}s, {entry['encode_fps']} fps, "
+                      f"{entry['peak_rss_mb']} MB, {entry['output_bytes']} bytes")
+            results.append(entry)
+
+    return {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ffmpeg": ffmpeg_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "profile": profile_name or "default",
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """Confronta con la baseline: ritorna le regressioni oltre la soglia (es. 0.15 = +15%)"""
+    previous = {r["id"]: r for r in baseline.get("results", [])}
+    regressions = []
+    print(f"\n{'caso':<28}{'tempo':>10}{'Δ tempo':>10}{'RSS MB':>10}{'Δ RSS':>10}{'Δ size':>10}")
+    for entry in current["results"]:
+        old = previous.get(entry["id"])
+        if old is None or entry.get("returncode") or old.get("returncode"):
+            continue
+        deltas = {}
+        for metric in ("wall_seconds", "peak_rss_mb", "output_bytes"):
+            if entry.get(metric) and old.get(metric):
+                deltas[metric] = entry[metric] / old[metric] - 1
+        print(f"{entry['id']:<28}{entry['wall_seconds']:>10.2f}{deltas.get('wall_seconds', 0):>+10.1%}"
+              f"{entry.get('peak_rss_mb') or 0:>10.1f}{deltas.get('peak_rss_mb', 0):>+10.1%}"
+              f"{deltas.get('output_bytes', 0):>+10.1%}")
+        for metric in ("wall_seconds", "peak_rss_mb"):
+            if deltas.get(metric, 0) > threshold:
+                regressions.append(f"{entry['id']}: {metric} {deltas[metric]:+.1%}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark della pipeline di remix")
+    parser.add_argument("--quick", action="store_true", help="solo sorgente 720p e casi principali")
+    parser.add_argument("--sources", help="sorgenti separate da virgola (default: tutte)")
+    parser.add_argument("--cases", help="casi separati da virgola (default: tutti)")
+    parser.add_argument("--repeat", type=int, default=1, help="ripetizioni per caso (mediana del tempo)")
+    parser.add_argument("--profile", help="profilo encoder (lowmem, balanced, throughput, quality)")
+    parser.add_argument("--output", type=Path, default=RESULTS_PATH)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="salva i risultati come nuova baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="regressione tollerata (0.15 = +15%%)")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--regenerate", action="store_true", help="rigenera i media sintetici")
+    args = parser.parse_args(argv)
+
+    all_cases = list(build_cases())
+    source_names = [s[0] for s in SOURCES]
+    case_names = all_cases
+    if args.quick:
+        source_names, case_names = QUICK_SOURCES, QUICK_CASES
+    if args.sources:
+        source_names = args.sources.split(",")
+    if args.cases:
+        case_names = args.cases.split(",")
+    unknown = [c for c in case_names if c not in all_cases] + [s for s in source_names if s not in [x[0] for x in SOURCES]]
+    if unknown:
+        parser.error(f"Casi/sorgenti sconosciuti: {', '.join(unknown)}")
+
+    current = run_benchmark(source_names, case_names, max(1, args.repeat), args.profile, args.regenerate)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(current, indent=2))
+    print(f"[Bench] Risultati in {args.output}")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(current, indent=2))
+        print(f"[Bench] Baseline salvata in {args.baseline}")
+        return 0
+
+    if args.baseline.exists():
+        regressions = compare(current, json.loads(args.baseline.read_text()), args.threshold)
+        if regressions:
+            print("\n[Bench] Regressioni:\n  " + "\n  ".join(regressions))
+            if args.fail_on_regression:
+                return 1
+    else:
+        print(f"[Bench] Nessuna baseline in {args.baseline} (usa --save-baseline)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Compilazione dei filtergraph: argv esatto senza eseguire FFmpeg.
+
+Uso (dalla cartella backend/):
+    python -m pytest tests
+"""
+from pathlib import Path
+
+from app.routers.process import ProcessRequest, build_remix_command, build_multi_remix_command
+from app.services.filtergraph import FilterGraph, Filter, fold, is_noop, scale_before_key
+
+GREEN_KEY = "chromakey=0x00FF00:0.3:0.1,format=rgba"
+
+
+def filter_complex(cmd):
+    return cmd[cmd.index("-filter_complex") + 1] if "-filter_complex" in cmd else None
+
+
+def input_paths(cmd):
+    return [cmd[i + 1] for i, arg in enumerate(cmd) if arg == "-i"]
+
+
+def keyed_overlay_graph(overlay_width):
+    graph = FilterGraph()
+    source = graph.input(Path("src.mp4"))
+    overlay = graph.input(Path("ov.png"), ["-loop", "1"], overlay_width)
+    keyed = graph.apply(overlay.stream("v"), *Filter.parse_chain(GREEN_KEY),
+                        Filter("scale", 320, -1, flags="lanczos"), label="ov")
+    out = graph.node([source.stream("v"), keyed], [Filter("overlay", "10", "20", format="auto")],
+                     label="overlaid").output
+    graph.output(Path("out.mp4"), ["-map", out])
+    return graph.compile("ffmpeg")
+
+
+def test_trim_speed_eq_single_chain():
+    graph = FilterGraph(["-y"])
+    source = graph.input(Path("src.mp4"), ["-ss", "2.0"])
+    stream = graph.apply(source.stream("v"), Filter("setpts", "0.5*PTS"), label="vbase")
+    stream = graph.apply(stream, Filter("eq", brightness=0.1, contrast=1.2, saturation=1), label="eq")
+    graph.output(Path("out.mp4"), ["-map", stream, "-map", source.stream("a?"), "-t", "3.0"])
+    assert graph.compile("ffmpeg") == [
+        "ffmpeg", "-y", "-ss", "2.0", "-i", "src.mp4",
+        "-filter_complex", "[0:v]setpts=0.5*PTS,eq=brightness=0.1:contrast=1.2:saturation=1[eq]",
+        "-map", "[eq]", "-map", "0:a?", "-t", "3.0", "out.mp4",
+    ]
+
+
+def test_noop_filters_are_dropped():
+    graph = FilterGraph()
+    source = graph.input(Path("src.mp4"))
+    stream = graph.apply(source.stream("v"), Filter("setpts", "PTS"), label="vbase")
+    stream = graph.apply(stream, Filter("eq", brightness=0.0, contrast=1.0, saturation=1.0), label="eq")
+    graph.output(Path("out.mp4"), ["-map", stream, "-c:v", "copy"])
+    assert graph.compile("ffmpeg") == ["ffmpeg", "-i", "src.mp4", "-map", "0:v:0", "-c:v", "copy", "out.mp4"]
+
+
+def test_scale_moves_before_key_when_downscaling():
+    expected = ("[1:v]scale=320:-1:flags=lanczos,chromakey=0x00FF00:0.3:0.1,format=rgba[ov];"
+                "[0:v][ov]overlay=10:20:format=auto[overlaid]")
+    # Larghezza sconosciuta o maggiore del target: scala prima del key
+    assert filter_complex(keyed_overlay_graph(None)) == expected
+    assert filter_complex(keyed_overlay_graph(1920)) == expected
+
+
+def test_scale_stays_after_key_when_upscaling():
+    assert filter_complex(keyed_overlay_graph(100)) == (
+        "[1:v]chromakey=0x00FF00:0.3:0.1,format=rgba,scale=320:-1:flags=lanczos[ov];"
+        "[0:v][ov]overlay=10:20:format=auto[overlaid]"
+    )
+
+
+def test_segment_offset_folds_into_startpts():
+    graph = FilterGraph()
+    source = graph.input(Path("src.mp4"))
+    stream = graph.apply(source.stream("v"), Filter("setpts", "0.5*PTS+3/TB"), label="vbase")
+    stream = graph.apply(stream, Filter("setpts", "PTS-STARTPTS"), label="segment")
+    graph.output(Path("out.mp4"), ["-map", stream, "-an"])
+    assert filter_complex(graph.compile("ffmpeg")) == "[0:v]setpts=0.5*(PTS-STARTPTS)[segment]"
+
+
+def test_unused_inputs_dropped_and_renumbered():
+    graph = FilterGraph()
+    source = graph.input(Path("src.mp4"))
+    unused = graph.input(Path("unused.png"))
+    graph.apply(unused.stream("v"), Filter("scale", 10, -1))
+    audio = graph.input(Path("audio.mp3"))
+    branches = graph.split(source.stream("v"), 2, label="base_v")
+    adjusted = graph.apply(branches[0], Filter("eq", brightness=0.1), Filter("eq", contrast=1.5), label="eq")
+    graph.output(Path("a.mp4"), ["-map", adjusted, "-map", audio.stream("a")])
+    graph.output(Path("b.mp4"), ["-map", branches[1], "-map", source.stream("a?")])
+    cmd = graph.compile("ffmpeg")
+    assert input_paths(cmd) == ["src.mp4", "audio.mp3"]
+    assert filter_complex(cmd) == (
+        "[0:v]split=2[base_v0][base_v1];"
+        "[base_v0]eq=brightness=0.15:contrast=1.5:saturation=1[eq]"
+    )
+    assert cmd[cmd.index("a.mp4") - 4:cmd.index("a.mp4")] == ["-map", "[eq]", "-map", "1:a"]
+
+
+def test_fold_and_noop_rules():
+    assert is_noop(Filter("setpts", "1.0*PTS"))
+    assert not is_noop(Filter("setpts", "PTS-STARTPTS"))
+    assert fold(Filter("setpts", "2*PTS"), Filter("setpts", "0.5*PTS")).render() == "setpts=0.5*(2*PTS)"
+    # STARTPTS dipende dallo stream: niente sostituzione generica
+    assert fold(Filter("setpts", "PTS-STARTPTS"), Filter("setpts", "PTS-STARTPTS")) is None
+    assert fold(Filter("format", "rgba"), Filter("format", "rgba")) == Filter("format", "rgba")
+    assert fold(Filter("format", "rgba"), Filter("format", "yuv420p")) is None
+
+
+def test_scale_before_key_ignores_chains_without_key():
+    chain = [Filter("setpts", "PTS"), Filter("scale", 320, -1)]
+    assert scale_before_key(chain) == chain
+
+
+def test_remix_command_trim_speed_eq():
+    request = ProcessRequest(video_id="v", trim_start=2, trim_end=8, playback_speed=2.0, brightness=10, contrast=20)
+    cmd = build_remix_command(request, Path("src.mp4"), Path("out.mp4"), 1280, 720)
+    assert input_paths(cmd) == ["src.mp4"]
+    assert cmd[cmd.index("-i") - 2:cmd.index("-i")] == ["-ss", "2.0"]
+    assert filter_complex(cmd) == "[0:v]setpts=0.5*PTS,eq=brightness=0.1:contrast=1.2:saturation=1[eq]"
+    assert ["-af", "atempo=2.0"] == cmd[cmd.index("-af"):cmd.index("-af") + 2]
+    assert cmd[-3:] == ["-t", "3.0", "out.mp4"]
+
+
+def test_remix_command_without_video_filters_copies_video():
+    request = ProcessRequest(video_id="v", remove_original_audio=True)
+    cmd = build_remix_command(request, Path("src.mp4"), Path("out.mp4"), 1280, 720)
+    assert filter_complex(cmd) is None
+    assert cmd[cmd.index("-map"):cmd.index("-map") + 4] == ["-map", "0:v:0", "-an", "-c:v"]
+    assert cmd[cmd.index("-c:v") + 1] == "copy"
+
+
+def test_batch_copies_only_unfiltered_variants():
+    requests = [ProcessRequest(video_id="v"), ProcessRequest(video_id="v", saturation=5)]
+    cmd = build_multi_remix_command(requests, Path("src.mp4"), [Path("a.mp4"), Path("b.mp4")], 1280, 720)
+    # Una sola variante filtrata: nessuno split
+    assert filter_complex(cmd) == "[0:v]eq=brightness=0:contrast=1:saturation=1.1[eq]"
+    first = cmd[cmd.index("-filter_complex") + 2:cmd.index("a.mp4")]
+    assert first[:2] == ["-map", "0:v:0"] and first[first.index("-c:v") + 1] == "copy"
+    second = cmd[cmd.index("a.mp4") + 1:cmd.index("b.mp4")]
+    assert second[:2] == ["-map", "[eq]"] and second[second.index("-c:v") + 1] == "libx264"
@@ -1,10 +1,29 @@
 'use client'
 
+import { useState } from 'react'
 import { Wand2, Loader2, AlertCircle } from 'lucide-react'
 import toast from 'react-hot-toast'
 import type { VideoState, EditSettings } from '@/app/page'
 import { apiUrl } from '@/lib/api'
 
+// Segue lo stato del job via Server-Sent Events fino alla fine
+const waitForJob = (jobId: string, onProgress: (percent: number | null) => void): Promise<any> =>
+  new Promise((resolve, reject) => {
+    const events = new EventSource(apiUrl(`/api/process/jobs/${jobId}/events`))
+    events.addEventListener('progress', (event) => {
+      const job = JSON.parse((event as MessageEvent).data)
+      onProgress(job.progress?.percent ?? null)
+    })
+    events.addEventListener('end', (event) => {
+      events.close()
+      resolve(JSON.parse((event as MessageEvent).data))
+    })
+    events.onerror = () => {
+      events.close()
+      reject(new Error('Connessione persa durante il processing'))
+    }
+  })
+
 interface ProcessButtonProps {
   video: VideoState
   settings: EditSettings
@@ -20,6 +39,7 @@ export default function ProcessButton({
   setIsProcessing,
   setOutputUrl,
 }: ProcessButtonProps) {
+  const [progress, setProgress] = useState<number | null>(null)
   const hasVideo = !!video.videoId
   const hasVideoEdits = settings.trimStart > 0 || settings.trimEnd > 0 || settings.brightness !== 0 || settings.contrast !== 0 || settings.saturation !== 0 || settings.playbackSpeed !== 1
   const hasEdits = settings.overlayId || settings.audioId || settings.textOverlay || settings.removeOriginalAudio || hasVideoEdits
@@ -32,9 +52,10 @@ export default function ProcessButton({
 
     setIsProcessing(true)
     setOutputUrl(null)
+    setProgress(null)
 
     try {
-      const response = await fetch(apiUrl('/api/process/remix'), {
+      const response = await fetch(apiUrl('/api/process/jobs'), {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -78,7 +99,14 @@ export default function ProcessButton({
         throw new Error(data.detail || 'Errore durante il processing')
       }
 
-      setOutputUrl(data.output_url)
+      // Il render è in coda: segui l'avanzamento finché non termina
+      const job = await waitForJob(data.job_id, setProgress)
+
+      if (job.status !== 'done') {
+        throw new Error(job.error || 'Render annullato')
+      }
+
+      setOutputUrl(job.result.output_url)
       toast.success('Video remixato con successo! 🎉')
     } catch (error: any) {
       toast.error(error.message || 'Errore durante il processing')
@@ -114,8 +142,12 @@ export default function ProcessButton({
         {isProcessing ? (
           <>
             <Loader2 className="w-5 h-5 sm:w-6 sm:h-6 animate-spin" />
-            <span className="hidden sm:inline">Sto remixando il video...</span>
-            <span className="sm:hidden">Remixando...</span>
+            <span className="hidden sm:inline">
+              Sto remixando il video...{progress !== null && ` ${Math.round(progress)}%`}
+            </span>
+            <span className="sm:hidden">
+              Remixando...{progress !== null && ` ${Math.round(progress)}%`}
+            </span>
           </>
         ) : (
           <>